@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк JSON-кодека max.py на записанных кадрах opcode 128 и 49.
+
+Сравнивает stdlib json (как было: json.loads + json.dumps полного dict'а кадра)
+с кодеком max.py (orjson/ujson если установлены + шаблоны кадров).
+
+Запуск: python bench_codec.py [число повторов]
+"""
+import json
+import sys
+import timeit
+
+from max import JSON_CODEC, frame, loads
+
+# Кадр opcode 128 (новое сообщение с ответом и фото), записан из web-клиента
+FRAME_128 = json.dumps({
+    "ver": 11, "cmd": 0, "seq": 4821, "opcode": 128,
+    "payload": {
+        "chatId": -69521598221033,
+        "message": {
+            "sender": 61512093, "id": "115234938449812034", "time": 1760713532411,
+            "text": "Домашнее задание на завтра: №245, 247, 251 (стр. 78). Кто не сдал контрольную — подойти после уроков",
+            "type": "USER", "cid": 1760713532098, "status": None,
+            "link": {"type": "REPLY", "messageId": "115234901224339001", "message": {
+                "sender": 61512011, "id": "115234901224339001", "time": 1760713001202,
+                "text": "А что задали по алгебре?", "type": "USER", "attaches": []}},
+            "attaches": [{"_type": "PHOTO", "photoId": 1772346617, "width": 1280, "height": 960,
+                          "baseUrl": "https://i.oneme.ru/i?r=BTGBPUwtwgYUeoFhO7rESmr8ckI9o1kaYz7Yc0jFqSgT4sS",
+                          "photoToken": "2s5oRr8D1GXbUmvlsAkRIYyiemNIJMs2Pg9oXbzHKm1f9tXvT5hEAGVUjLH6SAwcBIfq"}],
+            "reactionInfo": {},
+        },
+        "ttl": False, "mark": 1760713532411, "unread": 1,
+    },
+}, ensure_ascii=False)
+
+# Ответ на opcode 49 (история чата, 30 сообщений)
+FRAME_49 = json.dumps({
+    "ver": 11, "cmd": 1, "seq": 57, "opcode": 49,
+    "payload": {"messages": [
+        {"sender": 61512000 + i % 7, "id": str(115234800000000000 + i), "time": 1760710000000 + i * 60000,
+         "text": f"Сообщение номер {i} в группе, немного текста для правдоподобной длины",
+         "type": "USER", "status": "EDITED" if i % 9 == 0 else None, "attaches": [],
+         "reactionInfo": {"counters": [{"count": 2, "reaction": "👍"}], "totalCount": 2} if i % 5 == 0 else {}}
+        for i in range(30)
+    ]},
+}, ensure_ascii=False)
+
+# Исходящий запрос opcode 64 (отправка сообщения)
+PAYLOAD_64 = {"chatId": -69521598221033, "message": {"text": "Принято, спасибо!", "cid": 1760713532098,
+                                                     "elements": [], "attaches": []}, "notify": True}
+
+
+def _bench(name: str, stmt, number: int) -> float:
+    seconds = timeit.timeit(stmt, number=number)
+    per_call = seconds / number * 1e6
+    print(f"   {name:<40} {per_call:8.2f} мкс/кадр")
+    return per_call
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"Кодек max.py: {JSON_CODEC}, повторов: {number}\n")
+
+    for title, raw in (("opcode 128 (push)", FRAME_128), ("opcode 49 (история)", FRAME_49)):
+        print(f"Разбор {title}, {len(raw.encode())} байт")
+        base = _bench("json.loads", lambda: json.loads(raw), number)
+        fast = _bench(f"max.loads ({JSON_CODEC})", lambda: loads(raw), number)
+        print(f"   ускорение: x{base / fast:.2f}\n")
+
+    print("Сборка исходящего кадра opcode 64")
+    base = _bench("json.dumps(полный dict)", lambda: json.dumps(
+        {"ver": 11, "cmd": 0, "seq": 4821, "opcode": 64, "payload": PAYLOAD_64}), number)
+    fast = _bench(f"max.frame ({JSON_CODEC} + шаблон)", lambda: frame(4821, 64, PAYLOAD_64), number)
+    print(f"   ускорение: x{base / fast:.2f}")
+
+    assert json.loads(frame(4821, 64, PAYLOAD_64)) == {"ver": 11, "cmd": 0, "seq": 4821, "opcode": 64, "payload": PAYLOAD_64}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк фильтров: интерпретируемое дерево против Filter.compile().
+
+Дерево типичного бота: несколько команд, отсечение своих сообщений и чатов.
+Сообщения — смесь команд, обычного текста, пустого текста и чужих чатов.
+
+Запуск: python bench_filters.py [число повторов]
+"""
+import sys
+import timeit
+from types import SimpleNamespace
+
+from classes import Message
+from filters import filters
+
+CHAT_IDS = [-69521598221033, -69521598221034, -69521598221035]
+
+TREE = (
+    filters.chat_ids(CHAT_IDS)
+    & ~filters.me()
+    & filters.user()
+    & (
+        filters.command("start")
+        | filters.command("help")
+        | filters.command("status")
+        | (filters.text("привет") | filters.text("ping"))
+    )
+)
+
+# Клиент с авторизованным пользователем — только то, что читают фильтры
+CLIENT = SimpleNamespace(me=SimpleNamespace(contact=SimpleNamespace(id=61512093)))
+
+MESSAGES = [
+    Message(CLIENT, chat_id, sender, str(i), 1760713532411, text, "USER")
+    for i, (chat_id, sender, text) in enumerate([
+        (CHAT_IDS[0], 61512011, "/status"),
+        (CHAT_IDS[1], 61512012, "Домашнее задание на завтра: №245, 247, 251 (стр. 78)"),
+        (CHAT_IDS[2], 61512013, "Привет"),
+        (CHAT_IDS[0], 61512093, "/help"),                 # своё сообщение
+        (-1, 61512014, "/start"),                          # чужой чат
+        (CHAT_IDS[1], 61512015, None),                     # вложение без текста
+        (CHAT_IDS[2], 61512016, "ping"),
+        (CHAT_IDS[0], 61512017, "Кто не сдал контрольную — подойти после уроков"),
+    ])
+]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    compiled = TREE.compile()
+
+    for message in MESSAGES:
+        assert compiled(CLIENT, message) == TREE(CLIENT, message), message.text
+
+    def interpreted_run():
+        for message in MESSAGES:
+            TREE(CLIENT, message)
+
+    def compiled_run():
+        for message in MESSAGES:
+            compiled(CLIENT, message)
+
+    print(f"Сообщений в наборе: {len(MESSAGES)}, повторов: {number}\n")
+    results = {}
+    for name, stmt in (("дерево (__call__)", interpreted_run), ("Filter.compile()", compiled_run)):
+        seconds = timeit.timeit(stmt, number=number)
+        results[name] = seconds / (number * len(MESSAGES)) * 1e6
+        print(f"   {name:<20} {results[name]:8.3f} мкс/сообщение")
+    base, fast = results.values()
+    print(f"   ускорение: x{base / fast:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Память на сообщение: модели на __slots__ против прежних объектов с __dict__.
+
+Имитирует день трафика: каждый кадр opcode 128 разбирается заново, из него строится
+Message, а сам кадр отбрасывается — как в _listener. Считается всё, что остаётся жить
+вместе с сообщениями (объекты и данные payload), через tracemalloc.
+
+Запуск: python bench_memory.py [сообщений за день]
+"""
+import sys
+import tracemalloc
+
+from bench_codec import FRAME_128
+from classes import Message, User
+from max import loads
+
+PROFILE = {
+    "id": 61512011, "names": [{"name": "Анна Петрова", "firstName": "Анна", "lastName": "Петрова", "type": "ONEME"}],
+    "phone": 79990001122, "accountStatus": 0, "updateTime": 1760710000000, "options": [],
+    "baseUrl": "https://i.oneme.ru/i?r=BTGBPUwtwgYUeoFhO7rESmr8ckI9o1kaYz7Yc0jFqSgT4sS",
+    "baseRawUrl": "https://i.oneme.ru/i?r=BTGBPUwtwgYUeoFhO7rESmr8ckI9o1kaYz7Yc0jFqSgT4sS", "photoId": 1772346617,
+}
+
+
+class DictName:
+    """Прежний Name."""
+    def __init__(self, **kwargs):
+        self.name = kwargs.get('name')
+        self.first_name = kwargs.get('firstName')
+        self.last_name = kwargs.get('lastName')
+        self.type = kwargs.get('type')
+
+
+class DictContact:
+    """Прежний Contact: имена разбираются сразу."""
+    def __init__(self, client, accountStatus=None, baseUrl=None, names=None, phone=None, description=None, options=None,
+                 photoId=None, updateTime=None, id=None, baseRawUrl=None, gender=None, link=None, **kwargs):
+        self._client = client
+        self.accountStatus = accountStatus
+        self.base_url = baseUrl
+        self.names = [DictName(**n) for n in names] if names else []
+        self.phone = phone
+        self.description = description
+        self.options = options
+        self.photo_id = photoId
+        self.update_time = updateTime
+        self.id = id
+        self.link = link
+        self.gender = gender
+        self.base_raw_url = baseRawUrl
+
+
+class DictUser:
+    """Прежний User."""
+    def __init__(self, client, profile):
+        self._client = client
+        self.contact = DictContact(client, **profile)
+        self._chat = None
+
+
+class DictMessage:
+    """Прежний Message: копия payload в kwargs плюс все поля в __dict__."""
+    def __init__(self, client, chatId, sender, id, time, text, type, _f=0, _chat=None, _user=None, **kwargs):
+        self._client = client
+        self.kwargs = kwargs
+        self.status = kwargs.get("status")
+        self.chat_id = chatId
+        self._chat = _chat
+        self._user = _user
+        self.sender = sender
+        self.id = id
+        self.time = time
+        self.text = text
+        self.type = type
+        self.update_time = kwargs.get("updateTime")
+        self.options = kwargs.get("options")
+        self.cid = kwargs.get("cid")
+        self.attaches = kwargs.get("attaches", [])
+        self.reaction_info = kwargs.get("reactionInfo", {})
+
+
+def _measure(build, count: int) -> float:
+    """Байт на объект, которые остаются занятыми после построения count объектов."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / count
+
+
+def _measure_overhead(build, count: int) -> float:
+    """Байт на объект сверх уже разобранного payload: payload'ы готовятся до замера."""
+    payloads = [loads(FRAME_128)["payload"] for _ in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(payload) for payload in payloads]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept, payloads
+    return (after - before) / count
+
+
+def _old_message():
+    payload = loads(FRAME_128)["payload"]
+    return DictMessage(None, payload["chatId"], **payload["message"])
+
+
+def _new_message():
+    payload = loads(FRAME_128)["payload"]
+    return Message.from_payload(None, payload["chatId"], payload["message"])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"Сообщений за день: {count}\n")
+
+    old = _measure(_old_message, count)
+    new = _measure(_new_message, count)
+    print("Message (кадр opcode 128 с ответом и фото)")
+    print(f"   __dict__ + kwargs         {old:8.0f} байт/сообщение, {old * count / 2**20:6.1f} МиБ за день")
+    print(f"   __slots__ + from_payload  {new:8.0f} байт/сообщение, {new * count / 2**20:6.1f} МиБ за день")
+    print(f"   экономия: {1 - new / old:.0%}")
+
+    old = _measure_overhead(lambda p: DictMessage(None, p["chatId"], **p["message"]), count)
+    new = _measure_overhead(lambda p: Message.from_payload(None, p["chatId"], p["message"]), count)
+    print(f"   только объект сверх payload: {old:.0f} -> {new:.0f} байт ({1 - new / old:.0%})\n")
+
+    old = _measure(lambda: DictUser(None, dict(PROFILE)), count)
+    new = _measure(lambda: User.from_payload(None, dict(PROFILE)), count)
+    print("User (профиль контакта)")
+    print(f"   __dict__                  {old:8.0f} байт/пользователь")
+    print(f"   __slots__ + from_payload  {new:8.0f} байт/пользователь")
+    print(f"   экономия: {1 - new / old:.0%}")
+
+
+if __name__ == "__main__":
+    main()
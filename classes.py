@@ -1,6 +1,9 @@
-import json, time
+import inspect, json, logging, threading, time
+from collections import OrderedDict, deque
 from typing import Literal
 
+_log = logging.getLogger(__name__)
+
 EMOJIS = Literal[
     '❤️','👍','🤣','🔥','💯','😍','🎉','⚡',
     '🤩','🤘','😎','🙄','😐','😁','🤪','😉',
@@ -14,6 +17,8 @@ EMOJIS = Literal[
 
 # region Name
 class Name:
+    __slots__ = ("name", "first_name", "last_name", "type")
+
     def __init__(self, **kwargs):
         """
         Represents a name structure for a contact.
@@ -26,19 +31,28 @@ class Name:
         self.last_name = kwargs.get('lastName')
         self.type = kwargs.get('type')
 
+    # region from_payload()
+    @classmethod
+    def from_payload(cls, data: dict) -> "Name":
+        """Builds a name from a raw `names` entry."""
+        return cls(**data)
+
 # region Contact
 class Contact:
+    __slots__ = ("_client", "accountStatus", "base_url", "_names", "phone", "description", "options",
+                 "photo_id", "update_time", "id", "link", "gender", "base_raw_url")
+
     def __init__(self, client, accountStatus = None, baseUrl = None, names = None, phone = None, description = None, options = None, photoId = None, updateTime = None, id = None, baseRawUrl = None, gender = None, link = None, **kwargs):
         """
         Represents a contact with detailed profile information.
 
         This class encapsulates contact details, including status, URLs, names (as `Name` objects),
-        phone number, description, and other metadata.
+        phone number, description, and other metadata. `names` are turned into `Name` objects on first access.
         """
         self._client = client
         self.accountStatus = accountStatus
         self.base_url = baseUrl
-        self.names = [Name(**n) for n in names] if names else []
+        self._names = names or []
         self.phone = phone
         self.description = description
         self.options = options
@@ -48,6 +62,38 @@ class Contact:
         self.link = link
         self.gender = gender
         self.base_raw_url = baseRawUrl
+
+    # region from_payload()
+    @classmethod
+    def from_payload(cls, client, data: dict) -> "Contact":
+        """Builds a contact from a raw profile/contact dict."""
+        self = cls.__new__(cls)
+        self._client = client
+        self.accountStatus = data.get("accountStatus")
+        self.base_url = data.get("baseUrl")
+        self._names = data.get("names") or []
+        self.phone = data.get("phone")
+        self.description = data.get("description")
+        self.options = data.get("options")
+        self.photo_id = data.get("photoId")
+        self.update_time = data.get("updateTime")
+        self.id = data.get("id")
+        self.link = data.get("link")
+        self.gender = data.get("gender")
+        self.base_raw_url = data.get("baseRawUrl")
+        return self
+
+    # region names
+    @property
+    def names(self) -> list[Name]:
+        names = self._names
+        if names and not isinstance(names[0], Name):
+            names = self._names = [Name.from_payload(n) for n in names]
+        return names
+
+    @names.setter
+    def names(self, names: list[Name]):
+        self._names = names
     
     # region add()
     def add(self):
@@ -67,12 +113,14 @@ class Contact:
 
 # region User
 class User:
+    __slots__ = ("_client", "contact", "_chat")
+
     def __init__(self, client, profile, _f=0):
         """
         Represents a user with a contact profile.
 
         This class wraps a `Contact` object created from a profile dictionary, typically
-        received from the server.
+        received from the server. The private chat with the user (`chat`) is resolved on first access.
         """
         self._client = client
         
@@ -84,50 +132,267 @@ class User:
         
         # Ensure required fields exist
         if 'id' not in profile_data:
-            print(f"[WARNING] Profile missing 'id' field. Available keys: {list(profile_data.keys())}")
-            print(f"[WARNING] Profile data: {profile_data}")
+            _log.warning("Profile missing 'id' field. Available keys: %s", list(profile_data.keys()))
+            _log.debug("Profile data: %s", profile_data)
             raise ValueError(f"Profile missing required 'id' field")
             
-        self.contact = Contact(client, **profile_data)
-        _id = client.me.contact.id if client.me else profile_data.get("id")
-        if not _f:
-            self.chat = Chat(self._client, profile_data.get("id", 0) ^ _id)
+        self.contact = Contact.from_payload(client, profile_data)
+        self._chat = None
+
+    # region from_payload()
+    @classmethod
+    def from_payload(cls, client, profile: dict) -> "User":
+        """
+        Builds a user from a raw profile/contact dict.
+
+        Raises:
+            ValueError: If the profile has no `id`.
+        """
+        if "id" not in profile:
+            raise ValueError(f"Profile missing required 'id' field")
+        self = cls.__new__(cls)
+        self._client = client
+        self.contact = Contact.from_payload(client, profile)
+        self._chat = None
+        return self
+
+    # region chat
+    @property
+    def chat(self) -> "Chat":
+        """
+        Private chat with the user. For the authenticated user itself this is an empty chat with ID 0.
+
+        Raises:
+            RuntimeError: On `AsyncMaxClient` if the user didn't come from the client, which resolves it.
+        """
+        if self._chat is None:
+            me = self._client.me
+            _id = me.contact.id if me else self.contact.id
+            chat = self._client.get_chat(self.contact.id ^ _id)
+            if inspect.isawaitable(chat):
+                # never cache the coroutine: every later access would get it
+                chat.close()
+                raise RuntimeError(f"User {self.contact.id} chat is not resolved: use `await client.get_user(id=...)` on an async client")
+            self._chat = chat
+        return self._chat
+
+    @chat.setter
+    def chat(self, chat: "Chat"):
+        self._chat = chat
+
+# region UserCache
+class UserCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 3600.0):
+        """
+        Identity map of users by contact ID, shared by everything in the client that resolves users.
+
+        There is at most one `User` object per ID. When a profile is loaded again, `put()` returns the cached
+        object, and replaces its `contact` only if the server `updateTime` changed, so references held
+        elsewhere (messages, handlers) stay current. Entries older than `ttl` seconds count as misses and
+        get reloaded; past `max_size` the least recently used entries are evicted.
+
+        Usage:
+            ```python
+            user = client.users.get(123456)    # None if unknown or expired
+            print(client.users.stats)          # {'hits': ..., 'misses': ..., ...}
+            ```
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, list] = OrderedDict()  # id -> [User, loaded at]
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "refreshed": 0, "evicted": 0}
+
+    # region get()
+    def get(self, id: int) -> User|None:
+        """
+        Returns the cached user, or None if there is none or it expired.
+
+        Args:
+            id (int): Contact ID.
+        """
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if time.monotonic() - entry[1] > self.ttl:
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(id)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    # region put()
+    def put(self, user: User) -> User:
+        """
+        Stores a freshly loaded user.
+
+        Args:
+            user (User): The user built from the server response.
 
-        if profile_data.get("id") != _id:
-            pass
+        Returns:
+            User: The canonical object for this ID, which may be an already cached one.
+        """
+        id = user.contact.id
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None:
+                cached = entry[0]
+                if cached.contact.update_time != user.contact.update_time or user.contact.update_time is None:
+                    cached.contact = user.contact
+                    self.stats["refreshed"] += 1
+                entry[1] = now
+                self._entries.move_to_end(id)
+                return cached
+
+            self._entries[id] = [user, now]
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evicted"] += 1
+            return user
+
+    # region invalidate()
+    def invalidate(self, id: int):
+        """Forgets a user, e.g. after a contact change push."""
+        with self._lock:
+            self._entries.pop(id, None)
+
+    def __contains__(self, id: int) -> bool:
+        """True if the user is cached and not expired. Doesn't count in `stats`."""
+        entry = self._entries.get(id)
+        return entry is not None and time.monotonic() - entry[1] <= self.ttl
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
 # region Chat
 class Chat:
-    def __init__(self, client, chat_id):
+    __slots__ = ("_client", "id", "history_size", "_messages", "_seeded", "_lock")
+
+    def __init__(self, client, chat_id, _messages=None, history_size: int = 50):
         """
         Represents a chat in the messaging system.
 
-        This class associates a chat with a client instance and its unique ID.
+        This class associates a chat with a client instance and its unique ID. Clients keep one `Chat`
+        per chat ID. Its recent messages (`messages`) are a ring buffer of up to `history_size` messages:
+        seeded by a single opcode 49 request on first access (not here) and then kept current by
+        live opcode 128 pushes, so reading recent history costs no further requests.
+        `_messages` lets a client pass already fetched history instead.
         """
-        if chat_id == 0:
-            return
         self._client = client
 
         self.id: int = chat_id
-        self.link = f"https://web.max.ru/{chat_id}"
-
-        seq = client.seq
-        client.websocket.send(json.dumps({"ver":11,"cmd":0,"seq":seq,"opcode":49,"payload":{"chatId":chat_id,"from":int(time.time()*1000),"forward":0,"backward":30,"getMessages":True}}))
-        while True:
-            r = client.websocket.recv()
-            recv = json.loads(r)
-            if recv["seq"] == seq and recv["opcode"] == 49:
-                break
-            else:
-                pass
-        
-        payload = recv["payload"]
-        if not recv["opcode"] in [150]:
-            _ = []
-            for msg in payload["messages"]:
-                m = Message(client, 0, **msg, _f=1)
-                _.append(m)
-            self.messages: list[Message] = _
+        self.history_size = history_size
+        self._messages: deque[Message]|None = None
+        self._seeded = False
+        self._lock = threading.Lock()
+        if _messages is not None:
+            self._seed(_messages)
+
+    # region link
+    @property
+    def link(self) -> str:
+        return f"https://web.max.ru/{self.id}"
+
+    # region messages
+    @property
+    def messages(self) -> list["Message"]:
+        """
+        Recent messages of the chat, oldest first. Fetched with one request on first access, then updated live.
+        On `AsyncMaxClient` the history must be loaded first (`await client.get_chat()` or `await chat.aload_history()`).
+        """
+        if not self._seeded:
+            self.load_history()
+        return list(self._messages)
+
+    # region history_loaded
+    @property
+    def history_loaded(self) -> bool:
+        """True once the buffer exists, i.e. live pushes for this chat are being recorded."""
+        return self._messages is not None
+
+    # region load_history()
+    def load_history(self):
+        """
+        Seeds the history buffer with one opcode 49 request. Live pushes arriving meanwhile are kept.
+
+        Raises:
+            RuntimeError: On `AsyncMaxClient`, which needs `aload_history()`.
+        """
+        if inspect.iscoroutinefunction(self._client._request):
+            raise RuntimeError(f"Chat {self.id} history is not loaded: use `await chat.aload_history()` on an async client")
+        self._start_recording()
+        if not self.id:
+            self._seed([])
+            return
+        recv = self._client._request(49, self._history_request())
+        self._seed_payload(recv["payload"])
+
+    # region aload_history()
+    async def aload_history(self):
+        """`load_history()` for `AsyncMaxClient`, whose requests are coroutines."""
+        self._start_recording()
+        if not self.id:
+            self._seed([])
+            return
+        recv = await self._client._request(49, self._history_request())
+        self._seed_payload(recv["payload"])
+
+    def _history_request(self) -> dict:
+        return {"chatId":self.id,"from":int(time.time()*1000),"forward":0,"backward":self.history_size,"getMessages":True}
+
+    def _seed_payload(self, payload: dict):
+        self._seed([Message.from_payload(self._client, self.id, msg, _chat=self) for msg in payload.get("messages", [])])
+
+    # region find_message()
+    def find_message(self, message_id) -> "Message|None":
+        """
+        Looks a message up in the history buffer. Never makes a request.
+
+        Args:
+            message_id: The message ID.
+
+        Returns:
+            Message | None: The latest known version of the message, or None if it is not in the buffer.
+        """
+        with self._lock:
+            for msg in reversed(self._messages or ()):
+                if msg.id == message_id:
+                    return msg
+        return None
+
+    # region _start_recording()
+    def _start_recording(self):
+        """Internal worker. Creates the buffer, so live pushes are kept from now on."""
+        with self._lock:
+            if self._messages is None:
+                self._messages = deque(maxlen=self.history_size)
+
+    # region _seed()
+    def _seed(self, messages: list["Message"]):
+        """Internal worker. Puts fetched history before the live messages already buffered."""
+        with self._lock:
+            live = list(self._messages or ())
+            known = {msg.id for msg in live}
+            fetched = sorted((msg for msg in messages if msg.id not in known), key=lambda msg: msg.time or 0)
+            self._messages = deque(fetched + live, maxlen=self.history_size)
+            self._seeded = True
+
+    # region _push()
+    def _push(self, msg: "Message"):
+        """Internal worker. Records a live message; a newer version of a buffered message (edit, delete) replaces it."""
+        with self._lock:
+            buffer = self._messages
+            if buffer is None:
+                return
+            for i in range(len(buffer) - 1, -1, -1):
+                if buffer[i].id == msg.id:
+                    buffer[i] = msg
+                    return
+            buffer.append(msg)
 
     # region pin()
     def pin(self):
@@ -142,32 +407,111 @@ class Chat:
         # {"ver":11,"cmd":0,"seq":seq,"opcode":48,"payload":{"chatIds":[chatid]}}
         pass
 
+# payload keys kept in Message slots rather than in Message.kwargs
+_MESSAGE_SLOT_FIELDS = frozenset(("sender", "id", "time", "text", "type", "status"))
+
 # region Message
 class Message:
-    def __init__(self, client, chatId: str, sender: str, id, time, text, type, _f=0, **kwargs):
+    __slots__ = ("_client", "_raw", "status", "chat_id", "_chat", "_user",
+                 "sender", "id", "time", "text", "type", "hits")
+
+    def __init__(self, client, chatId: str, sender: str, id, time, text, type, _f=0, _chat=None, _user=None, **kwargs):
         """
         Represents a message in a chat.
 
         This class encapsulates message details, including the sender, content, and metadata,
         and provides methods to interact with the message (e.g., reply, delete, edit).
+        `chat` and `user` are resolved on first access through the client's shared caches, so building
+        a message costs no requests; `_chat` and `_user` let a client pass already resolved objects.
+        Rarely used fields (`attaches`, `reaction_info`, `options`, ...) are read from the raw payload on access.
+        Clients build messages with `Message.from_payload()`.
         """
         self._client = client
-        self.kwargs = kwargs
+        self._raw = kwargs
         self.status = kwargs.get("status")
 
-        if not _f:
-            self.chat = Chat(client, chatId)
+        self.chat_id = chatId
+        self._chat = _chat
+        self._user = _user
         self.sender = sender
         self.id = id
         self.time = time
         self.text = text
         self.type = type
-        self.update_time = kwargs.get("updateTime")
-        self.options = kwargs.get("options")
-        self.cid = kwargs.get("cid")
-        self.attaches = kwargs.get("attaches", [])
-        self.reaction_info = kwargs.get("reactionInfo", {})
-        self.user: User = client.get_user(id=sender, _f=1)
+        self.hits = ()  # set by filters.keywords / filters.regex_set
+
+    # region from_payload()
+    @classmethod
+    def from_payload(cls, client, chat_id: int, raw: dict, _chat=None, _user=None) -> "Message":
+        """Builds a message from a raw `message` dict (opcode 128 push, opcode 49 history, replies)."""
+        self = cls.__new__(cls)
+        self._client = client
+        # only the fields not stored in slots, and no None values: a much smaller dict than the payload
+        self._raw = {k: v for k, v in raw.items() if v is not None and k not in _MESSAGE_SLOT_FIELDS}
+        self.status = raw.get("status")
+        self.chat_id = chat_id
+        self._chat = _chat
+        self._user = _user
+        self.sender = raw.get("sender")
+        self.id = raw.get("id")
+        self.time = raw.get("time")
+        self.text = raw.get("text")
+        self.type = raw.get("type")
+        self.hits = ()
+        return self
+
+    # region raw fields
+    @property
+    def kwargs(self) -> dict:
+        """The raw message payload, without the fields available as attributes."""
+        return self._raw
+
+    @property
+    def payload(self) -> dict:
+        """
+        The message payload as received: `kwargs` plus the fields kept as attributes.
+        Built on each access; this is what raw-payload filters (`filters.raw`) see.
+        """
+        payload = dict(self._raw)
+        for key in _MESSAGE_SLOT_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                payload[key] = value
+        return payload
+
+    @property
+    def update_time(self) -> int|None:
+        return self._raw.get("updateTime")
+
+    @property
+    def options(self):
+        return self._raw.get("options")
+
+    @property
+    def cid(self) -> int|None:
+        return self._raw.get("cid")
+
+    @property
+    def attaches(self) -> list[dict]:
+        return self._raw.get("attaches") or []
+
+    @property
+    def reaction_info(self) -> dict:
+        return self._raw.get("reactionInfo") or {}
+
+    # region chat
+    @property
+    def chat(self) -> Chat:
+        if self._chat is None:
+            self._chat = self._client.get_chat(self.chat_id)
+        return self._chat
+
+    # region user
+    @property
+    def user(self) -> User:
+        if self._user is None:
+            self._user = self._client.get_user(id=self.sender, _f=1)
+        return self._user
     
     # region reply()
     def reply(self, text: str, **kwargs) -> "Message":
@@ -268,14 +612,29 @@ class Message:
 
 # region Reaction
 class Reaction:
+    __slots__ = ("reaction", "count")
+
     def __init__(self, reaction: str, count: int):
         self.reaction = reaction
         self.count = count
 
+    # region from_payload()
+    @classmethod
+    def from_payload(cls, data: dict) -> "Reaction":
+        return cls(data.get("reaction"), data.get("count"))
+
 # region Reactions
 class Reactions:
+    __slots__ = ("counters", "your_reaction", "total_count")
+
     def __init__(self, **kwargs):
         reaction_info = kwargs.get('reactionInfo', {})
-        self.counters = [Reaction(**c) for c in reaction_info.get('counters', [])]
+        self.counters = [Reaction.from_payload(c) for c in reaction_info.get('counters', [])]
         self.your_reaction = reaction_info.get('yourReaction')
         self.total_count = reaction_info.get('totalCount')
+
+    # region from_payload()
+    @classmethod
+    def from_payload(cls, payload: dict) -> "Reactions":
+        """Builds reactions from a payload holding `reactionInfo` (opcode 178 reply)."""
+        return cls(**payload)
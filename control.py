@@ -0,0 +1,198 @@
+"""
+Управление пересылкой: состояние живёт в памяти main.py, а starter.py присылает
+команды по локальному каналу (Unix-сокет, на Windows — 127.0.0.1).
+
+Желаемое состояние хранит starter.py в forward_control.json (пишет только он, при
+каждой команде); main.py читает файл один раз при старте, до client.run(), так что
+пауза переживает и перезапуск бота, и перезагрузку. На горячем пути файлов нет.
+
+Протокол — словари через multiprocessing.connection:
+    {"cmd": "pause"}                     -> пауза всей пересылки
+    {"cmd": "pause", "chat_id": -123}    -> пауза одного чата
+    {"cmd": "resume", ...}               -> то же, обратно
+    {"cmd": "set", "enabled": ..., "paused_chats": [...]}  -> полный снимок (после перезапуска)
+    {"cmd": "status"} / {"cmd": "stats"} -> состояние и счётчики
+Ответ всегда словарь с ключом "ok".
+"""
+import json
+import logging
+import os
+import socket
+import threading
+from collections import Counter
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from typing import Callable, Dict, Iterable
+
+from titles import write_json_atomic
+
+log = logging.getLogger("control")
+
+FORWARD_STATE_FILE = "forward_control.json"
+
+CONTROL_ADDRESS_ENV = "CONTROL_ADDRESS"
+_DEFAULT_SOCKET = "forward_control.sock"
+_DEFAULT_PORT = 48765
+
+
+def default_address():
+    """Адрес канала: путь к Unix-сокету, где он есть, иначе порт на localhost."""
+    value = os.getenv(CONTROL_ADDRESS_ENV)
+    if hasattr(socket, "AF_UNIX"):
+        return value or _DEFAULT_SOCKET
+    if value and value.isdigit():
+        return ("127.0.0.1", int(value))
+    return ("127.0.0.1", _DEFAULT_PORT)
+
+
+class ForwardState:
+    """
+    Флаг пересылки и чаты на паузе. На горячем пути только чтение атрибутов —
+    множество на паузе не меняется на месте, а подменяется новым frozenset.
+    """
+
+    def __init__(self, enabled: bool = True, paused_chats: Iterable[int] = ()):
+        self.enabled = enabled
+        self.paused_chats = frozenset(paused_chats)
+        # счётчики по чатам; меняются только через record(), читаются через stats()
+        self.forwarded = Counter()
+        self.skipped = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str = FORWARD_STATE_FILE) -> "ForwardState":
+        """Состояние из файла starter.py; нет файла или он битый — пересылка включена."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(bool(data.get("enabled", True)), (int(c) for c in data.get("paused_chats", ())))
+        except FileNotFoundError:
+            return cls()
+        except (OSError, ValueError, TypeError) as e:
+            log.warning("Не удалось прочитать %s: %s", path, e)
+            return cls()
+
+    def save(self, path: str = FORWARD_STATE_FILE):
+        """Сохраняет состояние атомарно (temp-файл + os.replace). Вызывает только starter.py."""
+        write_json_atomic(path, self.snapshot())
+
+    def allows(self, chat_id: int) -> bool:
+        return self.enabled and chat_id not in self.paused_chats
+
+    def record(self, chat_id: int, forwarded: bool):
+        with self._lock:
+            (self.forwarded if forwarded else self.skipped)[chat_id] += 1
+
+    def pause(self, chat_id: int | None = None):
+        with self._lock:
+            if chat_id is None:
+                self.enabled = False
+            else:
+                self.paused_chats = self.paused_chats | {chat_id}
+
+    def resume(self, chat_id: int | None = None):
+        with self._lock:
+            if chat_id is None:
+                self.enabled = True
+            else:
+                self.paused_chats = self.paused_chats - {chat_id}
+
+    def set(self, enabled: bool, paused_chats: Iterable[int] = ()):
+        with self._lock:
+            self.enabled = bool(enabled)
+            self.paused_chats = frozenset(paused_chats)
+
+    def snapshot(self) -> Dict:
+        return {"enabled": self.enabled, "paused_chats": sorted(self.paused_chats)}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            forwarded, skipped = Counter(self.forwarded), Counter(self.skipped)
+        return {
+            **self.snapshot(),
+            "forwarded": sum(forwarded.values()),
+            "skipped": sum(skipped.values()),
+            "per_chat": {
+                chat_id: {"forwarded": forwarded[chat_id], "skipped": skipped[chat_id]}
+                for chat_id in set(forwarded) | set(skipped)
+            },
+        }
+
+
+class ControlServer:
+    """
+    Принимает команды в фоновом потоке и применяет их к ForwardState.
+    Дополнительные команды добавляются через register(): обработчик получает
+    словарь запроса и возвращает словарь ответа.
+    """
+
+    def __init__(self, state: ForwardState, address=None, authkey: bytes | None = None):
+        self.state = state
+        self.address = address or default_address()
+        self.authkey = authkey
+        self._listener = None
+        self._handlers: Dict[str, Callable[[Dict], Dict]] = {
+            "pause": lambda req: (state.pause(req.get("chat_id")), state.snapshot())[1],
+            "resume": lambda req: (state.resume(req.get("chat_id")), state.snapshot())[1],
+            "set": lambda req: (state.set(req.get("enabled", True), req.get("paused_chats", ())), state.snapshot())[1],
+            "status": lambda req: state.snapshot(),
+            "stats": lambda req: state.stats(),
+        }
+
+    def register(self, cmd: str, handler: Callable[[Dict], Dict]):
+        self._handlers[cmd] = handler
+
+    def start(self):
+        # сокет от прошлого запуска (процесс упал) мешает bind
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self._listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._serve, name="ControlServer", daemon=True).start()
+        log.info("Канал управления: %s", self.address)
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def handle(self, request: Dict) -> Dict:
+        handler = self._handlers.get(request.get("cmd"))
+        if handler is None:
+            return {"ok": False, "error": f"неизвестная команда: {request.get('cmd')}"}
+        try:
+            return {"ok": True, **handler(request)}
+        except Exception as e:
+            log.exception("Ошибка команды %s", request.get("cmd"))
+            return {"ok": False, "error": str(e)}
+
+    def _serve(self):
+        while True:
+            listener = self._listener
+            if listener is None:
+                return
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                if self._listener is None:
+                    # listener закрыт в stop()
+                    return
+                # обрыв во время рукопожатия, неверный authkey и т.п. — не роняем поток
+                log.warning("Отклонено подключение к каналу управления: %s", e)
+                continue
+            with conn:
+                try:
+                    while True:
+                        conn.send(self.handle(conn.recv()))
+                except (EOFError, OSError):
+                    pass
+
+
+def send_command(cmd: str, address=None, authkey: bytes | None = None, **params) -> Dict | None:
+    """Отправляет команду запущенному main.py. None — если канал недоступен (бот не запущен)."""
+    try:
+        with Client(address or default_address(), authkey=authkey) as conn:
+            conn.send({"cmd": cmd, **params})
+            return conn.recv()
+    except (OSError, EOFError, AuthenticationError) as e:
+        log.debug("Канал управления недоступен: %s", e)
+        return None
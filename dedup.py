@@ -0,0 +1,126 @@
+"""
+Дедупликация пересылки по водяным знакам (high-water mark) на чат.
+
+ID сообщений в MAX растут внутри чата, поэтому на чат достаточно помнить
+наибольший принятый ID и небольшое окно последних ID — для сообщений,
+пришедших не по порядку (догоняющий opcode 49 после переподключения, пуши
+во время загрузки истории). Всё, что ниже окна, уже было переслано.
+
+Состояние периодически сохраняется на диск (temp-файл + os.replace), так что
+перезапуск main.py из starter.py не приводит к повторной пересылке.
+"""
+import atexit
+import bisect
+import json
+import logging
+import threading
+import time
+from typing import Dict, List
+
+from titles import write_json_atomic
+
+log = logging.getLogger("dedup")
+
+DEDUP_STATE_FILE = "dedup_state.json"
+
+
+class Watermarks:
+    def __init__(self, path: str = DEDUP_STATE_FILE, window: int = 64, flush_interval: float = 2.0):
+        self.path = path
+        self.window = window
+        self.flush_interval = flush_interval
+        # chat_id -> отсортированный список последних принятых ID (не длиннее window);
+        # последний элемент и есть водяной знак чата
+        self._recent: Dict[int, List[int]] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._thread = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning("Не удалось прочитать %s: %s", self.path, e)
+            return
+        self._recent = {int(chat_id): sorted(ids)[-self.window:] for chat_id, ids in data.items()}
+
+    def seen(self, chat_id: int, message_id) -> bool:
+        """
+        True — если сообщение уже обработано: оно есть в окне чата или старее заполненного окна.
+        Ничего не отмечает, см. mark().
+        """
+        mid = self._as_int(message_id)
+        if mid is None:
+            return False
+        with self._lock:
+            recent = self._recent.get(chat_id)
+            if not recent or mid > recent[-1]:
+                return False
+            i = bisect.bisect_left(recent, mid)
+            if i < len(recent) and recent[i] == mid:
+                return True
+            # старее окна: такое сообщение уже обрабатывали до него
+            return i == 0 and len(recent) >= self.window
+
+    def mark(self, chat_id: int, message_id):
+        """
+        Отмечает сообщение обработанным. Вызывается только когда оно уже надёжно сохранено
+        (закоммичено в outbox), иначе падение между отметкой и записью потеряет его.
+        """
+        mid = self._as_int(message_id)
+        if mid is None:
+            return
+        with self._lock:
+            recent = self._recent.setdefault(chat_id, [])
+            i = bisect.bisect_left(recent, mid)
+            if i < len(recent) and recent[i] == mid:
+                return
+            recent.insert(i, mid)
+            if len(recent) > self.window:
+                del recent[0]
+            self._dirty = True
+        if self._thread is None:
+            self.start()
+
+    @staticmethod
+    def _as_int(message_id) -> int | None:
+        # нечисловой ID водяным знаком не сравнить — такие сообщения считаются новыми
+        try:
+            return int(message_id)
+        except (TypeError, ValueError):
+            return None
+
+    def high(self, chat_id: int) -> int | None:
+        recent = self._recent.get(chat_id)
+        return recent[-1] if recent else None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="Watermarks", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Сохраняет окна всех чатов, если с прошлого сохранения что-то изменилось."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {str(chat_id): list(ids) for chat_id, ids in self._recent.items()}
+            self._dirty = False
+        try:
+            write_json_atomic(self.path, data)
+        except OSError as e:
+            log.warning("Не удалось сохранить %s: %s", self.path, e)
+            with self._lock:
+                self._dirty = True
@@ -1,3 +1,17 @@
+import re
+from collections import deque
+
+# Cost classes used by Filter.compile() to order predicates, cheapest first
+_COST_CHEAP = 0   # attribute comparisons: type, sender, chat
+_COST_TEXT = 1    # needs the lowercased text
+_COST_CUSTOM = 2  # arbitrary user code
+
+def _TRUE(client, message, text):
+    return True
+
+def _FALSE(client, message, text):
+    return False
+
 class Filter:
     def __call__(self, client, message) -> bool:
         """
@@ -27,6 +41,80 @@ class Filter:
         """
         return True
 
+    def check_raw(self, client, chat_id: int, raw: dict) -> bool|None:
+        """
+        Evaluates the filter on a raw opcode 128 payload, before any `Message` is built.
+
+        The client calls this first for every incoming message. If every handler's filter returns False
+        the message is dropped without constructing `Message`/`Chat`/`User` objects or making any requests.
+        A definite True/False must agree with `__call__`; return None when the raw payload is not enough
+        to decide (the default), then `__call__` decides on the built `Message`.
+
+        Args:
+            client (MaxClient): The client instance handling the message.
+            chat_id (int): The `chatId` of the push.
+            raw (dict): The raw `message` dict of the push (`sender`, `type`, `status`, `text`, ...).
+
+        Returns:
+            bool | None: True/False if decided, None if undecided.
+        """
+        return None
+
+    def check_chat(self, client, chat_id: int) -> bool|None:
+        """
+        Evaluates the filter on the chat ID alone, before the frame is even parsed.
+
+        If every handler's filter returns False the frame is dropped unparsed. Same contract as
+        `check_raw`: a definite answer must agree with `__call__`, None means undecided (the default).
+
+        Args:
+            client (MaxClient): The client instance handling the message.
+            chat_id (int): The `chatId` read from the raw frame.
+
+        Returns:
+            bool | None: True/False if decided, None if undecided.
+        """
+        return None
+
+    def chat_scope(self) -> frozenset[int]|None:
+        """
+        The chat IDs outside of which this filter can never pass, or None if it can pass in any chat.
+
+        The client uses it to index handlers by chat, so a message is only checked against handlers
+        whose filters can match in its chat (plus the unscoped ones). Only `chat_id` and combinations
+        of it with `&`/`|` have a scope.
+
+        Returns:
+            frozenset[int] | None: The chat IDs, or None if unscoped.
+        """
+        return None
+
+    def compile(self) -> 'CompiledFilter':
+        """
+        Compiles the filter tree into a single closure.
+
+        Nested `&`/`|` are flattened, `any()` is folded away, cheap predicates (type, sender, chat)
+        are moved before text predicates, and the lowercased message text is computed once per
+        message instead of once per `text`/`command` filter. Filters are assumed to have no side
+        effects, since the order they run in changes. `on_message` compiles filters automatically.
+
+        Returns:
+            CompiledFilter: A filter with the same result as this one.
+
+        Usage:
+            ```python
+            f = (filters.command("start") | filters.command("help")) & ~filters.me()
+            fast = f.compile()
+            fast(client, message)  # same as f(client, message)
+            ```
+        """
+        cost, fn, uses_text = self._compile()
+        return CompiledFilter(self, fn, uses_text)
+
+    def _compile(self) -> tuple:
+        """Internal worker. Returns (cost class, fn(client, message, lowered_text), uses the text)."""
+        return _COST_CUSTOM, lambda client, message, text: self(client, message), False
+
     def __and__(self, other: 'Filter') -> 'AndFilter':
         """
         Combines this filter with another using logical AND.
@@ -85,6 +173,25 @@ class AndFilter(Filter):
     def __call__(self, client, message) -> bool:
         return all(f(client, message) for f in self.filters)
 
+    def check_raw(self, client, chat_id, raw):
+        return self._combine([f.check_raw(client, chat_id, raw) for f in self.filters])
+
+    def check_chat(self, client, chat_id):
+        return self._combine([f.check_chat(client, chat_id) for f in self.filters])
+
+    def chat_scope(self):
+        scopes = [scope for f in self.filters if (scope := f.chat_scope()) is not None]
+        return frozenset.intersection(*scopes) if scopes else None
+
+    def _compile(self):
+        return _compile_all(self, AndFilter, _TRUE, _FALSE)
+
+    @staticmethod
+    def _combine(results):
+        if False in results:
+            return False
+        return True if None not in results else None
+
 class OrFilter(Filter):
     def __init__(self, *filters: Filter):
         self.filters = filters
@@ -92,6 +199,25 @@ class OrFilter(Filter):
     def __call__(self, client, message) -> bool:
         return any(f(client, message) for f in self.filters)
 
+    def check_raw(self, client, chat_id, raw):
+        return self._combine([f.check_raw(client, chat_id, raw) for f in self.filters])
+
+    def check_chat(self, client, chat_id):
+        return self._combine([f.check_chat(client, chat_id) for f in self.filters])
+
+    def chat_scope(self):
+        scopes = [f.chat_scope() for f in self.filters]
+        return None if None in scopes else frozenset().union(*scopes)
+
+    def _compile(self):
+        return _compile_all(self, OrFilter, _FALSE, _TRUE)
+
+    @staticmethod
+    def _combine(results):
+        if True in results:
+            return True
+        return False if None not in results else None
+
 class NotFilter(Filter):
     def __init__(self, filter: Filter):
         self.filter = filter
@@ -99,6 +225,112 @@ class NotFilter(Filter):
     def __call__(self, client, message) -> bool:
         return not self.filter(client, message)
 
+    def check_raw(self, client, chat_id, raw):
+        result = self.filter.check_raw(client, chat_id, raw)
+        return None if result is None else not result
+
+    def check_chat(self, client, chat_id):
+        result = self.filter.check_chat(client, chat_id)
+        return None if result is None else not result
+
+    def _compile(self):
+        cost, fn, uses_text = self.filter._compile()
+        if fn is _TRUE or fn is _FALSE:
+            return _COST_CHEAP, _FALSE if fn is _TRUE else _TRUE, False
+        return cost, lambda client, message, text: not fn(client, message, text), uses_text
+
+def _compile_all(filter: Filter, kind: type, neutral, absorbing) -> tuple:
+    """
+    Internal worker. Compiles an `&` (kind=AndFilter) or `|` (kind=OrFilter) into one short-circuit closure.
+
+    `neutral` parts (True for `&`) are dropped, an `absorbing` part (False for `&`) decides the whole
+    thing, the rest run cheapest first.
+    """
+    stack, parts = list(reversed(filter.filters)), []
+    while stack:
+        f = stack.pop()
+        if type(f) is kind:
+            stack.extend(reversed(f.filters))
+            continue
+        cost, fn, uses_text = f._compile()
+        if fn is absorbing:
+            return _COST_CHEAP, absorbing, False
+        if fn is not neutral:
+            parts.append((cost, fn, uses_text))
+    if not parts:
+        return _COST_CHEAP, neutral, False
+
+    parts.sort(key=lambda part: part[0])  # stable: same-cost filters keep their order
+    cost = parts[-1][0]
+    uses_text = any(part[2] for part in parts)
+    fns = tuple(part[1] for part in parts)
+    is_and = kind is AndFilter
+
+    if len(fns) == 1:
+        return cost, fns[0], uses_text
+    if len(fns) == 2:
+        a, b = fns
+        if is_and:
+            return cost, lambda client, message, text: a(client, message, text) and b(client, message, text), uses_text
+        return cost, lambda client, message, text: a(client, message, text) or b(client, message, text), uses_text
+
+    if is_and:
+        def run(client, message, text):
+            for fn in fns:
+                if not fn(client, message, text):
+                    return False
+            return True
+    else:
+        def run(client, message, text):
+            for fn in fns:
+                if fn(client, message, text):
+                    return True
+            return False
+    return cost, run, uses_text
+
+class CompiledFilter(Filter):
+    def __init__(self, source: Filter, fn, uses_text: bool):
+        """
+        A filter tree compiled by `Filter.compile()`.
+
+        Calls go to one closure; `check_raw`/`check_chat`/`chat_scope` are answered by the source tree.
+
+        Attributes:
+            source (Filter): The filter this was compiled from.
+            run (Callable[[MaxClient, Message], bool]): The compiled closure.
+        """
+        self.source = source
+        if fn is _TRUE or fn is _FALSE:
+            constant = fn is _TRUE
+            def run(client, message):
+                return constant
+        elif uses_text:
+            def run(client, message):
+                text = message.text
+                return fn(client, message, text.lower() if text else None)
+        else:
+            def run(client, message):
+                return fn(client, message, None)
+        self.run = run
+
+    def __call__(self, client, message) -> bool:
+        return self.run(client, message)
+
+    def check_raw(self, client, chat_id, raw):
+        return self.source.check_raw(client, chat_id, raw)
+
+    def check_chat(self, client, chat_id):
+        return self.source.check_chat(client, chat_id)
+
+    def chat_scope(self):
+        return self.source.chat_scope()
+
+    def compile(self):
+        return self
+
+    def _compile(self):
+        return self.source._compile()
+
 class text(Filter):
     def __init__(self, text: str):
         """
@@ -125,6 +357,14 @@ class text(Filter):
         """
         return message.text.lower() == self.text if message.text else False
 
+    def check_raw(self, client, chat_id, raw):
+        text = raw.get("text")
+        return text.lower() == self.text if text else False
+
+    def _compile(self):
+        target = self.text
+        return _COST_TEXT, lambda client, message, text: text == target, True
+
 class command(Filter):
     def __init__(self, command: str, prefix: str = "/"):
         """
@@ -152,6 +392,14 @@ class command(Filter):
         """
         return message.text.lower().startswith(self.command) if message.text else False
 
+    def check_raw(self, client, chat_id, raw):
+        text = raw.get("text")
+        return text.lower().startswith(self.command) if text else False
+
+    def _compile(self):
+        prefix = self.command
+        return _COST_TEXT, lambda client, message, text: text is not None and text.startswith(prefix), True
+
 class user_id(Filter):
     def __init__(self, user_id: str):
         """
@@ -178,6 +426,13 @@ class user_id(Filter):
         """
         return message.sender == self.user_id
 
+    def check_raw(self, client, chat_id, raw):
+        return raw.get("sender") == self.user_id
+
+    def _compile(self):
+        user_id = self.user_id
+        return _COST_CHEAP, lambda client, message, text: message.sender == user_id, False
+
 class me(Filter):
     def __init__(self):
         """
@@ -205,6 +460,14 @@ class me(Filter):
             raise ValueError("No authenticated user found. Please authenticate first.")
         return message.sender == client.me.contact.id
 
+    def check_raw(self, client, chat_id, raw):
+        if not client.me or not client.me.contact.id:
+            return None
+        return raw.get("sender") == client.me.contact.id
+
+    def _compile(self):
+        return _COST_CHEAP, lambda client, message, text: self(client, message), False
+
 class _any(Filter):
     def __init__(self):
         """
@@ -226,6 +489,15 @@ class _any(Filter):
             bool: Always True.
         """
         return True
+
+    def check_raw(self, client, chat_id, raw):
+        return True
+
+    def check_chat(self, client, chat_id):
+        return True
+
+    def _compile(self):
+        return _COST_CHEAP, _TRUE, False
     
 class user(Filter):
     def __init__(self):
@@ -254,6 +526,310 @@ class user(Filter):
             raise ValueError("No authenticated user found. Please authenticate first.")
         return message.type == "USER"
 
+    def check_raw(self, client, chat_id, raw):
+        return raw.get("type") == "USER"
+
+    def _compile(self):
+        return _COST_CHEAP, lambda client, message, text: self(client, message), False
+
+class raw(Filter):
+    def __init__(self, predicate):
+        """
+        A filter that runs a predicate on the raw message payload.
+
+        Such a filter is decided before any `Message` is built, so messages it rejects cost no requests at all.
+
+        Args:
+            predicate (Callable[[int, dict], bool]): Called with the chat ID and the raw message dict
+                (`sender`, `id`, `time`, `text`, `type`, `status`, `attaches`, ...).
+
+        Usage:
+            ```python
+            monitored = filters.raw(lambda chat_id, m: chat_id in CHAT_IDS and m.get("status") != "REMOVED")
+            ```
+        """
+        self.predicate = predicate
+
+    def __call__(self, client, message) -> bool:
+        """
+        Runs the predicate on the message payload (`Message.payload`), the same dict `check_raw` gets.
+
+        Args:
+            client (MaxClient): The client instance handling the message.
+            message (Message): The message to evaluate.
+
+        Returns:
+            bool: The predicate result.
+        """
+        return bool(self.predicate(message.chat_id, message.payload))
+
+    def check_raw(self, client, chat_id, raw):
+        return bool(self.predicate(chat_id, raw))
+
+class chat_id(Filter):
+    def __init__(self, *chat_ids: int):
+        """
+        A filter that matches messages from the given chats.
+
+        Handlers with this filter are indexed by chat ID, so they cost nothing for messages from other chats
+        and those messages are dropped before parsing if no other handler wants them.
+
+        Args:
+            *chat_ids (int | Iterable[int]): Chat IDs, or iterables of them.
+
+        Attributes:
+            chat_ids (frozenset[int]): The chat IDs to match.
+
+        Usage:
+            ```python
+            @client.on_message(filters.chat_id(-69521598221033))
+            def school(client, message): ...
+
+            @client.on_message(filters.chat_ids(MAX_CHAT_IDS) & ~filters.me())
+            def bridge(client, message): ...
+            ```
+        """
+        ids = set()
+        for chat in chat_ids:
+            if isinstance(chat, (int, str)):
+                ids.add(int(chat))
+            else:
+                ids.update(int(c) for c in chat)
+        self.chat_ids = frozenset(ids)
+
+    def __call__(self, client, message) -> bool:
+        """
+        Checks if the message is from one of the chats.
+
+        Args:
+            client (MaxClient): The client instance handling the message.
+            message (Message): The message to evaluate.
+
+        Returns:
+            bool: True if the message chat ID is one of the chat IDs, False otherwise.
+        """
+        return message.chat_id in self.chat_ids
+
+    def check_raw(self, client, chat_id, raw):
+        return chat_id in self.chat_ids
+
+    def check_chat(self, client, chat_id):
+        return chat_id in self.chat_ids
+
+    def chat_scope(self):
+        return self.chat_ids
+
+    def _compile(self):
+        chat_ids = self.chat_ids
+        return _COST_CHEAP, lambda client, message, text: message.chat_id in chat_ids, False
+
+class _Automaton:
+    def __init__(self, words: list[str]):
+        """
+        Aho–Corasick automaton over a fixed set of words.
+
+        Built once; `search()` then finds every occurrence of every word in a single pass over the text.
+        """
+        goto: list[dict[str, int]] = [{}]
+        fail = [0]
+        out: list[tuple[str, ...]] = [()]
+        for word in words:
+            node = 0
+            for ch in word:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    fail.append(0)
+                    out.append(())
+                node = nxt
+            out[node] += (word,)
+
+        pending = deque(goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, nxt in goto[node].items():
+                pending.append(nxt)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(ch, 0)
+                fail[nxt] = f if f != nxt else 0
+                out[nxt] += out[fail[nxt]]
+
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+
+    # region search()
+    def search(self, text: str):
+        """Yields (end index, word) for every occurrence, in text order."""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                for word in out[node]:
+                    yield i, word
+
+class keywords(Filter):
+    def __init__(self, words, whole_words: bool = False):
+        """
+        A filter that matches messages containing any of the keywords (case-insensitive).
+
+        All keywords are compiled into one Aho–Corasick automaton when the filter is created, so a message
+        is scanned once however many keywords there are. The keywords found are stored in `message.hits`
+        (in order of first occurrence) for the handler to route on.
+
+        Args:
+            words (Iterable[str]): The keywords or phrases.
+            whole_words (bool, optional): Only match keywords not surrounded by letters or digits. Defaults to False.
+
+        Attributes:
+            words (list[str]): The lowercase keywords.
+
+        Usage:
+            ```python
+            @client.on_message(filters.keywords(["контрольная", "родительское собрание", "дедлайн"]))
+            def alert(client, message):
+                if "дедлайн" in message.hits:
+                    ...
+            ```
+        """
+        self.words = list(dict.fromkeys(w.lower() for w in words if w))
+        self.whole_words = whole_words
+        self._automaton = _Automaton(self.words)
+
+    # region find()
+    def find(self, text: str|None) -> list[str]:
+        """
+        Finds the keywords in a text.
+
+        Args:
+            text (str | None): The text to scan.
+
+        Returns:
+            list[str]: The keywords found, each once, in order of first occurrence.
+        """
+        return self._find_lowered(text.lower()) if text else []
+
+    def _find_lowered(self, text: str) -> list[str]:
+        hits = {}
+        for end, word in self._automaton.search(text):
+            if word in hits:
+                continue
+            if self.whole_words:
+                start = end - len(word) + 1
+                if (start > 0 and text[start - 1].isalnum()) or (end + 1 < len(text) and text[end + 1].isalnum()):
+                    continue
+            hits[word] = None
+        return list(hits)
+
+    def __call__(self, client, message) -> bool:
+        """
+        Checks if the message text contains any keyword and stores the ones found in `message.hits`.
+
+        Args:
+            client (MaxClient): The client instance handling the message.
+            message (Message): The message to evaluate.
+
+        Returns:
+            bool: True if at least one keyword was found, False otherwise.
+        """
+        hits = self.find(message.text)
+        if hits:
+            message.hits = hits
+        return bool(hits)
+
+    def check_raw(self, client, chat_id, raw):
+        # a match still needs __call__ to fill message.hits
+        return None if self.find(raw.get("text")) else False
+
+    def _compile(self):
+        find = self._find_lowered
+
+        def run(client, message, text):
+            hits = find(text) if text else None
+            if hits:
+                message.hits = hits
+            return bool(hits)
+        return _COST_TEXT, run, True
+
+class regex_set(Filter):
+    def __init__(self, patterns, flags: int = re.IGNORECASE):
+        """
+        A filter that matches messages against a set of regular expressions at once.
+
+        The patterns are joined into one alternation with a named group per pattern, so the text is scanned
+        once. The patterns that matched are stored in `message.hits`. Matches are found left to right without
+        overlapping, so a pattern whose only match lies inside another pattern's match is not reported;
+        use `keywords` when every plain keyword has to be found. Patterns must not use numbered backreferences;
+        named groups are allowed, as long as no two patterns use the same group name.
+
+        Args:
+            patterns (Iterable[str]): The regular expressions.
+            flags (int, optional): Flags for all patterns. Defaults to re.IGNORECASE.
+
+        Attributes:
+            patterns (list[str]): The patterns, in the order given.
+
+        Usage:
+            ```python
+            @client.on_message(filters.regex_set([r"\\bдз\\b", r"контрольн\\w+", r"\\d{1,2}:\\d{2}"]))
+            def alert(client, message):
+                print(message.hits)
+            ```
+        """
+        self.patterns = list(patterns)
+        self._regex = re.compile("|".join(f"(?P<_{i}>{p})" for i, p in enumerate(self.patterns)), flags)
+        # group number of each pattern's wrapper group -> pattern; the wrapper closes last, so a match's
+        # `lastindex` is its wrapper even when the pattern has groups of its own
+        self._outer = {self._regex.groupindex[f"_{i}"]: p for i, p in enumerate(self.patterns)}
+
+    # region find()
+    def find(self, text: str|None) -> list[str]:
+        """
+        Finds the patterns that match a text.
+
+        Args:
+            text (str | None): The text to scan.
+
+        Returns:
+            list[str]: The matching patterns, each once, in order of first match.
+        """
+        if not text:
+            return []
+        hits = {}
+        for match in self._regex.finditer(text):
+            hits[self._outer[match.lastindex]] = None
+        return list(hits)
+
+    def __call__(self, client, message) -> bool:
+        """
+        Checks if any pattern matches the message text and stores the ones that did in `message.hits`.
+
+        Args:
+            client (MaxClient): The client instance handling the message.
+            message (Message): The message to evaluate.
+
+        Returns:
+            bool: True if at least one pattern matched, False otherwise.
+        """
+        hits = self.find(message.text)
+        if hits:
+            message.hits = hits
+        return bool(hits)
+
+    def check_raw(self, client, chat_id, raw):
+        text = raw.get("text")
+        return None if text and self._regex.search(text) else False
+
+    def _compile(self):
+        return _COST_TEXT, lambda client, message, text: self(client, message), False
+
 class filters:
     text = text
     command = command
@@ -261,3 +837,8 @@ class filters:
     me = me
     user = user
     any = _any
+    raw = raw
+    chat_id = chat_id
+    chat_ids = chat_id
+    keywords = keywords
+    regex_set = regex_set
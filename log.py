@@ -0,0 +1,139 @@
+"""
+Leveled, queue-backed logging and a sampled ring buffer of raw frames.
+
+Log calls only put a record on a queue; formatting and writing to stdout happen in a
+background thread, so a slow or full pipe never stalls the reader or the handlers.
+Raw frames are not logged at all: `FrameTrace` keeps the last N of them in memory and
+writes them out on demand or when the process crashes.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+# region setup_logging()
+def setup_logging(level: str | int | None = None, stream=None) -> logging.handlers.QueueListener:
+    """
+    Routes the root logger through a queue to a single writer thread.
+
+    Args:
+        level (str | int, optional): Root level. Defaults to the LOG_LEVEL environment variable, then INFO.
+        stream (optional): Where records are written. Defaults to sys.stdout.
+
+    Returns:
+        logging.handlers.QueueListener: The running listener (stopped automatically at exit).
+
+    Usage:
+        ```
+        setup_logging()                 # INFO and above to stdout
+        setup_logging("DEBUG")          # every message, including per-message details
+        ```
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO").upper())
+
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+# region FrameTrace
+class FrameTrace:
+    """
+    Ring buffer of the last received raw frames.
+
+    Recording is a counter increment and, for sampled frames, a deque append of the raw text,
+    so it is cheap enough to stay on in production.
+
+    Args:
+        size (int, optional): How many frames to keep. Defaults to 500.
+        sample (int, optional): Keep every `sample`-th frame; 1 keeps all of them, 0 disables recording. Defaults to 1.
+
+    Usage:
+        ```
+        client.trace = FrameTrace(size=2000, sample=10)
+        ...
+        path = client.trace.dump()     # writes frames-<time>.log and returns its path
+        ```
+    """
+
+    def __init__(self, size: int = 500, sample: int = 1):
+        self.frames: deque[tuple[float, str]] = deque(maxlen=size)
+        self.sample = sample
+        self.seen = 0
+
+    # region record()
+    def record(self, data: str):
+        """Called by the reader for every received frame."""
+        self.seen += 1
+        if self.sample and self.seen % self.sample == 0:
+            self.frames.append((time.time(), data))
+
+    # region dump()
+    def dump(self, path: str | None = None) -> str:
+        """
+        Writes the buffered frames, oldest first, one per line.
+
+        Args:
+            path (str, optional): Output file. Defaults to frames-<unix time>.log in the working directory.
+
+        Returns:
+            str: The path written.
+        """
+        path = path or f"frames-{int(time.time())}.log"
+        frames = list(self.frames)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"# {len(frames)} of {self.seen} frames, sample 1/{self.sample}\n")
+            for at, data in frames:
+                stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(at))
+                f.write(f"{stamp}.{int(at % 1 * 1000):03d} {data}\n")
+        return path
+
+    # region dump_on_crash()
+    def dump_on_crash(self):
+        """
+        Dumps the buffer when an exception escapes the main thread or any other thread.
+
+        The previous excepthooks still run afterwards, so the traceback is printed as before.
+        """
+        log = logging.getLogger(__name__)
+        sys_hook = sys.excepthook
+        thread_hook = threading.excepthook
+
+        def _dump(exc):
+            try:
+                log.error("Unhandled %s, last frames saved to %s", type(exc).__name__, self.dump())
+            except Exception as e:
+                log.error("Could not dump frames: %s", e)
+
+        def _sys_hook(exc_type, exc, tb):
+            _dump(exc)
+            sys_hook(exc_type, exc, tb)
+
+        def _thread_hook(args):
+            if args.exc_type is not SystemExit:
+                _dump(args.exc_value)
+            thread_hook(args)
+
+        sys.excepthook = _sys_hook
+        threading.excepthook = _thread_hook
@@ -1,19 +1,27 @@
 #newest version
 import os
 import time
-import json
-from threading import Lock
+import logging
+import signal
+import threading
 from html import escape
-from typing import Dict, Iterable, List, Set
+from typing import Callable, Dict, Iterable, List, Set
 
 from dotenv import load_dotenv
 
 from classes import Message
 from filters import filters
-from max import MaxClient as Client
+from max import Dispatcher, MaxClient as Client
+from log import FrameTrace, setup_logging
 from telegram import send_to_telegram, handle_telegram_commands
+from control import ControlServer, ForwardState
+from titles import store as chat_titles
+from dedup import Watermarks
+from outbox import Outbox
 
 load_dotenv()
+setup_logging()
+log = logging.getLogger("main")
 
 MAX_TOKEN = os.getenv("MAX_TOKEN")
 MAX_CHAT_IDS_STR = os.getenv("MAX_CHAT_IDS", "")
@@ -38,32 +46,85 @@ if not TG_CHAT_ID:
     config_errors.append("TG_CHAT_ID не найден в .env")
 
 if config_errors:
-    print("❌ Ошибки конфигурации:")
+    log.error("❌ Ошибки конфигурации:")
     for err in config_errors:
-        print(f"   - {err}")
-    print("\nПроверьте файл .env и убедитесь, что все переменные установлены.")
+        log.error("   - %s", err)
+    log.error("Проверьте файл .env и убедитесь, что все переменные установлены.")
     exit(1)
 
-print("✅ Конфигурация загружена успешно")
-print(f"   MAX_TOKEN: {MAX_TOKEN[:20]}...") 
-print(f"   MAX_CHAT_IDS: {MAX_CHAT_IDS}")
-print(f"   TG_BOT_TOKEN: {TG_BOT_TOKEN[:20]}...")
-print(f"   TG_CHAT_ID: {TG_CHAT_ID}")
+log.info("✅ Конфигурация загружена успешно")
+log.info("   MAX_TOKEN: %s...", MAX_TOKEN[:20])
+log.info("   MAX_CHAT_IDS: %s", MAX_CHAT_IDS)
+log.info("   TG_BOT_TOKEN: %s...", TG_BOT_TOKEN[:20])
+log.info("   TG_CHAT_ID: %s", TG_CHAT_ID)
 
 MONITOR_ID = os.getenv("MONITOR_ID")
 client = Client(MAX_TOKEN)
-FORWARD_STATE_FILE = "forward_state.json"
-CHAT_TITLES_FILE = "chat_titles.json"
+# после переподключения догоняем пропущенные сообщения только в отслеживаемых чатах
+client.catch_up_chats = set(MAX_CHAT_IDS)
+# последние сырые кадры держим в памяти (каждый FRAME_TRACE_SAMPLE-й) и сбрасываем в файл
+# при падении или по сигналу SIGUSR1: kill -USR1 <pid>
+client.trace = FrameTrace(
+    size=int(os.getenv("FRAME_TRACE_SIZE", "500")),
+    sample=int(os.getenv("FRAME_TRACE_SAMPLE", "1")),
+)
+client.trace.dump_on_crash()
+if hasattr(signal, "SIGUSR1"):
+    signal.signal(signal.SIGUSR1, lambda *_: log.info("Кадры сохранены в %s", client.trace.dump()))
+# флаг пересылки держим в памяти, starter.py меняет его через локальный канал управления;
+# начальное состояние (паузы до перезапуска) читаем из его файла один раз, до client.run()
+forward_state = ForwardState.load()
+control = ControlServer(forward_state, authkey=TG_BOT_TOKEN.encode())
+
+
+def _deliver(payload: Dict, parts_done: int, on_part: Callable[[int], None]) -> None:
+    """Доставка одной записи outbox; исключение — повтор позже с parts_done-й части (см. outbox.py)."""
+    send_to_telegram(
+        TG_BOT_TOKEN,
+        TG_CHAT_ID,
+        payload["caption"],
+        payload["attachments"],
+        TG_THREAD_ID,
+        MAX_TOKEN,
+        payload["sender_id"],
+        parts_done=parts_done,
+        on_part=on_part,
+        raise_on_retry=True,
+    )
+
+
+# готовые сообщения сначала попадают в SQLite, в телегу их отправляет отдельный поток:
+# медленный Telegram не тормозит приём, а недоставленное переживает перезапуск
+outbox = Outbox(_deliver, max_depth=int(os.getenv("OUTBOX_MAX_DEPTH", "1000")))
+
+
+def _stage(name: str, workers: int, queue_size: int) -> Dispatcher:
+    """Стадия пайплайна; размеры переопределяются через PIPELINE_<NAME>_WORKERS / _QUEUE."""
+    return Dispatcher(
+        workers=int(os.getenv(f"PIPELINE_{name.upper()}_WORKERS", workers)),
+        queue_size=int(os.getenv(f"PIPELINE_{name.upper()}_QUEUE", queue_size)),
+        name=f"Pipeline{name.capitalize()}",
+    )
+
+
+enrich_stage = _stage("enrich", 2, 64)
+render_stage = _stage("render", 1, 64)
+deliver_stage = _stage("deliver", 1, 64)
+# ingest — воркеры клиента, их запускает и останавливает сам client.run()
+PIPELINE = {"enrich": enrich_stage, "render": render_stage, "deliver": deliver_stage}
+control.register("stats", lambda req: {
+    **forward_state.stats(),
+    "stages": {
+        name: dict(stage.stats, depths=stage.depths)
+        for name, stage in {"ingest": client.dispatcher, **PIPELINE}.items()
+    },
+    "outbox": outbox.snapshot(),
+})
 
 
 # ===== ОПТИМИЗАЦИЯ: Простой кэш ========
-_user_name_cache = {}  # {user_id: name}
-_user_name_cache_lock = Lock()
-_chat_titles_cache = {}  # {chat_id: title} — загружается при старте
-_chat_titles_pending = {}  # {chat_id: title} — новые значения для сохранения
-_chat_titles_lock = Lock()
-_processed_message_ids = set()  # Кэш ID сообщений для дедупликации (последние 1000)
-_processed_messages_lock = Lock()
+# водяные знаки ID по чатам с окном для сообщений не по порядку; переживают перезапуск
+_watermarks = Watermarks(window=int(os.getenv("DEDUP_WINDOW", "64")))
 
 
 def _safe_escape(text: str | None) -> str:
@@ -79,44 +140,63 @@ def _get_contact_name(user) -> str:
 
 
 def _get_user_name_by_id(client: Client, user_id: int | None) -> str:
-    """Get user name with caching to minimize API calls."""
+    """Имя пользователя: справочник из синхронизации, затем общий кэш client.users, затем запрос."""
     if not user_id:
         return "Неизвестно"
-    
-    # Быстрая проверка кэша БЕЗ блокировки (для скорости)
-    if user_id in _user_name_cache:
-        return _user_name_cache[user_id]
-    
-    # API запрос только если нет в кэше
+
+    # Сначала справочник контактов из синхронизации при логине
+    name = client.directory.name(user_id)
+    if name:
+        return name
+
+    # get_user сам берёт пользователя из client.users и ходит в API только при промахе
     try:
-        user = client.get_user(id=user_id, _f=1)
-        result = _get_contact_name(user)
-        
-        # Сохраняем в кэш с блокировкой
-        with _user_name_cache_lock:
-            _user_name_cache[user_id] = result
-            # Ограничиваем размер кэша
-            if len(_user_name_cache) > 1000:
-                _user_name_cache.pop(next(iter(_user_name_cache)))
-        
-        return result
+        return _get_contact_name(client.get_user(id=user_id, _f=1))
     except Exception:
         return "Неизвестно"
 
 
-def _is_message_duplicate(message_id: str) -> bool:
-    """Проверяет, не был ли этот ID сообщения уже обработан (для дедупликации)."""
-    with _processed_messages_lock:
-        if message_id in _processed_message_ids:
-            return True
-        
-        _processed_message_ids.add(message_id)
-        
-        # Ограничиваем размер кэша последних 1000 сообщений
-        if len(_processed_message_ids) > 1000:
-            _processed_message_ids.pop()
-        
-        return False
+def _prefetch_user_names(client: Client, user_ids: Iterable[int | None]) -> None:
+    """
+    Загружает имена всех нужных сообщению пользователей одним запросом (opcode 32 со списком),
+    чтобы дальше _get_user_name_by_id брал их из client.users.
+    """
+    missing = {
+        uid for uid in user_ids
+        if uid and uid not in client.users and not client.directory.name(uid)
+    }
+    if not missing:
+        return
+    try:
+        client.get_users(missing)
+    except Exception:
+        pass
+
+
+def _collect_user_ids(message: Message, linked_message: Dict | None) -> Set[int]:
+    """Все ID пользователей, чьи имена понадобятся при рендеринге сообщения."""
+    ids = {message.sender}
+    attachments = list(message.attaches or [])
+    if isinstance(linked_message, dict):
+        ids.add(linked_message.get("sender"))
+        attachments.extend(linked_message.get("attaches") or [])
+    for attach in attachments:
+        if str(attach.get("_type") or attach.get("type") or "").upper() != "CONTROL":
+            continue
+        for key in ("initiatorId", "userId", "memberId", "contactId"):
+            ids.add(attach.get(key))
+        if isinstance(attach.get("userIds"), list):
+            ids.update(attach["userIds"])
+    ids.discard(None)
+    return ids
+
+
+def _is_message_duplicate(chat_id: int, message_id: str) -> bool:
+    """
+    Проверяет, не было ли сообщение уже обработано (для дедупликации). Только проверка:
+    отметка ставится в _enqueue_delivery/_render, когда сообщение уже в outbox или пересылать нечего.
+    """
+    return _watermarks.seen(chat_id, message_id)
 
 
 def detect_message_types(
@@ -142,7 +222,7 @@ def detect_message_types(
             or "UNKNOWN"
         )
         detected.add(str(attach_type).upper())
-        print(f"   └─ Обнаружено вложение: {attach_type}")
+        log.debug("   └─ Обнаружено вложение: %s", attach_type)
 
     return detected
 
@@ -296,21 +376,44 @@ def split_control_attachments(attachments: Iterable[Dict], resolve_user_name) ->
     return media, service_notes
 
 
-def build_outgoing_payload(client: Client, message: Message, chat_title: str = "") -> tuple[str, List[Dict], Set[str]]:
+def resolve_message_context(client: Client, message: Message) -> tuple[str | None, Dict]:
     """
-    Prepare caption, attachments and detected types for a message coming from MAX.
-    Handles forwards and replies so the context is visible in Telegram.
+    Стадия обогащения: находит пересланное/цитируемое сообщение и заранее загружает
+    имена всех нужных пользователей, чтобы рендеринг подписи уже не ходил в API.
+    Возвращает (тип ссылки, сообщение по ссылке).
     """
     link = message.kwargs.get("link") if isinstance(message.kwargs, dict) else {}
     link_type = link.get("type") if isinstance(link, dict) else None
     linked_message = link.get("message") if isinstance(link, dict) else {}
+    if link_type == "REPLY" and not linked_message and link.get("messageId"):
+        # сервер прислал только ID — берём сообщение из истории чата, без запроса
+        original = message.chat.find_message(link["messageId"])
+        if original is not None:
+            linked_message = {"sender": original.sender, "text": original.text, "attaches": original.attaches}
+
+    _prefetch_user_names(client, _collect_user_ids(message, linked_message))
+    return link_type, linked_message
+
+
+def build_outgoing_payload(
+    client: Client,
+    message: Message,
+    chat_title: str = "",
+    context: tuple[str | None, Dict] | None = None,
+) -> tuple[str, List[Dict], Set[str]]:
+    """
+    Prepare caption, attachments and detected types for a message coming from MAX.
+    Handles forwards and replies so the context is visible in Telegram.
+    `context` is the result of resolve_message_context(); it is resolved here when omitted.
+    """
+    link_type, linked_message = context if context is not None else resolve_message_context(client, message)
 
     text = message.text or ""
     attachments = list(message.attaches or [])
-    print(f"   📎 Всего вложений в сообщении: {len(attachments)}")
-    for idx, att in enumerate(attachments, 1):
-        att_type = att.get("_type") or att.get("type") or "UNKNOWN"
-        print(f"      [{idx}] {att_type}")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("   📎 Всего вложений в сообщении: %d", len(attachments))
+        for idx, att in enumerate(attachments, 1):
+            log.debug("      [%d] %s", idx, att.get("_type") or att.get("type") or "UNKNOWN")
     context_lines: List[str] = []
 
     # Handle forwarded messages: replace content with original and mark author.
@@ -363,119 +466,130 @@ def build_outgoing_payload(client: Client, message: Message, chat_title: str = "
 
 
 
-def _save_chat_title(chat_id: int, title: str) -> None:
+@client.on_connect
+def onconnect():
+    if client.me != None:
+        log.info("Имя: %s, Номер: %s | ID: %s", client.me.contact.names[0].name, client.me.contact.phone, client.me.contact.id)
+    # история отслеживаемых чатов: один запрос на чат, дальше буфер пополняется из пушей
+    for chat_id in MAX_CHAT_IDS:
+        chat = client.get_chat(chat_id)
+        if chat.history_loaded:
+            continue
+        try:
+            chat.load_history()
+        except Exception as e:
+            log.warning("Не удалось загрузить историю чата %s: %s", chat_id, e)
+
+
+def _is_not_removed(chat_id: int, raw: Dict) -> bool:
     """
-    Кэшируем человекочитаемое имя чата, чтобы потом показать его по команде в телеграм-боте.
+    Решает по сырому payload, нужно ли вообще собирать Message:
+    удалённые сообщения отбрасываются до запросов chat/user.
     """
-    if not title:
-        return
-    try:
-        data: Dict[str, str] = {}
-        if os.path.exists(CHAT_TITLES_FILE):
-            with open(CHAT_TITLES_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        key = str(chat_id)
-        if data.get(key) == title:
-            return
-        data[key] = title
-        with open(CHAT_TITLES_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception:
-        # Не ломаем пересылку, если не смогли сохранить
-        pass
+    return raw.get("status") != "REMOVED"
 
 
-def _get_chat_title(chat_id: int) -> str | None:
-    """
-    Получает сохранённое название чата из кэша.
-    """
-    try:
-        if os.path.exists(CHAT_TITLES_FILE):
-            with open(CHAT_TITLES_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return data.get(str(chat_id))
-    except Exception:
-        pass
-    return None
+# чужие чаты отсекает индекс обработчиков по chat id, ещё до разбора кадра
+# Пересылка идёт по стадиям: ingest (обработчик on_message, воркеры client.dispatcher)
+# → enrich (название чата, ссылка, имена — запросы к MAX) → render (подпись) → deliver (outbox).
+# Каждая стадия — Dispatcher со своими воркерами и ограниченными очередями по chat id,
+# поэтому порядок внутри чата сохраняется. Если медленная стадия заполнила очередь,
+# предыдущая ждёт на submit() — это видно в stats стадии как blocked/blocked_time.
+@client.on_message(filters.chat_ids(MAX_CHAT_IDS) & filters.raw(_is_not_removed))
+def onmessage(client: Client, message: Message):
+    # перед пересылкой проверяем флаг, который меняется командами в телеге
+    if not forward_state.allows(message.chat_id):
+        forward_state.record(message.chat_id, forwarded=False)
+        return
 
+    log.debug("📬 Сообщение из чата: %s | ID: %s", message.chat_id, message.id)
+    
+    # Проверяем на дубликаты
+    if _is_message_duplicate(message.chat_id, message.id):
+        log.debug("⚠️ Дубликат сообщения %s - пропускаем", message.id)
+        return
 
-def _is_forward_enabled() -> bool:
-    """
-    Читает состояние пересылки из файла, который обновляет starter.py (telegram_control_loop).
-    По умолчанию пересылка включена.
-    """
-    try:
-        with open(FORWARD_STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return bool(data.get("forward_enabled", True))
-    except Exception:
-        return True
+    enrich_stage.submit(message.chat_id, _enrich, message)
 
 
-def _load_monitored_chats() -> List[Dict]:
-    """
-    Загружает список мониторимых чатов из кэша chat_titles.json
-    """
-    try:
-        if os.path.exists(CHAT_TITLES_FILE):
-            with open(CHAT_TITLES_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return [
-                    {"id": chat_id, "name": title}
-                    for chat_id, title in data.items()
-                ]
-    except Exception:
-        pass
-    return []
+def _enrich(message: Message):
+    """Стадия enrich: всё, что требует запросов к MAX, до рендеринга."""
+    # Получаем название чата — сначала из кэша, потом используем имя отправителя
+    cached_title = chat_titles.get(message.chat.id)
+    if cached_title:
+        chat_title_text = cached_title
+        log.debug("Название из кэша: '%s'", chat_title_text)
+    elif client.directory.title(message.chat.id):
+        chat_title_text = client.directory.title(message.chat.id)
+        chat_titles.set(message.chat.id, chat_title_text)
+    else:
+        chat_title_text = _get_contact_name(message.user)
+        log.debug("Новое имя отправителя: '%s'", chat_title_text)
+        chat_titles.set(message.chat.id, chat_title_text)
+
+    context = resolve_message_context(client, message)
+    # отправитель нужен и подписи, и outbox — загружаем его здесь, а не в следующих стадиях
+    message.user
+    render_stage.submit(message.chat_id, _render, message, chat_title_text, context)
+
+
+def _render(message: Message, chat_title_text: str, context: tuple[str | None, Dict]):
+    """Стадия render: подпись и вложения для Telegram."""
+    caption, msg_attaches, detected_types = build_outgoing_payload(client, message, chat_title_text, context)
+
+    log.info("📨 Сообщение %s | Вложений: %d", message.id, len(msg_attaches) if msg_attaches else 0)
+    if msg_attaches and log.isEnabledFor(logging.DEBUG):
+        log.debug("   Вложения: %s", [a.get('_type', a.get('type', 'UNKNOWN')) for a in msg_attaches])
+    if caption or msg_attaches:
+        log.debug("✉️ Типы сообщения в MAX: %s", ', '.join(sorted(detected_types)) or 'UNKNOWN')
+        deliver_stage.submit(message.chat_id, _enqueue_delivery, message, caption, msg_attaches)
+    else:
+        # пересылать нечего — сохранять тоже нечего, отмечаем сразу
+        _watermarks.mark(message.chat_id, message.id)
 
 
-@client.on_connect
-def onconnect():
-    if client.me != None:
-        print(f"Имя: {client.me.contact.names[0].name}, Номер: {client.me.contact.phone} | ID: {client.me.contact.id}")
+def _enqueue_delivery(message: Message, caption: str, msg_attaches: List[Dict]):
+    """Стадия deliver: запись в outbox; при переполненном outbox ждёт отправки (backpressure)."""
+    outbox.put(
+        f"{message.chat_id}:{message.id}",
+        {"caption": caption, "attachments": msg_attaches or [], "sender_id": message.user.contact.id},
+    )
+    # водяной знак двигаем только после коммита в outbox: до этого сообщение можно потерять,
+    # а повтор после падения отсечёт ключ идемпотентности outbox
+    _watermarks.mark(message.chat_id, message.id)
+    forward_state.record(message.chat_id, forwarded=True)
 
 
-@client.on_message(filters.any())
-def onmessage(client: Client, message: Message):
-    # перед пересылкой проверяем флаг, который меняется командами в телеге
-    if not _is_forward_enabled():
-        return
+# starter.py останавливает бота через terminate() (SIGTERM); Ctrl+C — тот же путь
+_shutdown = threading.Event()
 
-    print(f"📬 Сообщение из чата: {message.chat.id} | ID: {message.id}")
-    
-    # Проверяем на дубликаты
-    if _is_message_duplicate(message.id):
-        print(f"⚠️ Дубликат сообщения {message.id} - пропускаем")
-        return
-    
-    if message.chat.id in MAX_CHAT_IDS and message.status != "REMOVED":
-        # Получаем название чата — сначала из кэша, потом используем имя отправителя
-        cached_title = _get_chat_title(message.chat.id)
-        if cached_title:
-            chat_title_text = cached_title
-            print(f"DEBUG: Название из кэша: '{chat_title_text}'")
-        else:
-            chat_title_text = _get_contact_name(message.user)
-            print(f"DEBUG: Новое имя отправителя: '{chat_title_text}'")
-            _save_chat_title(message.chat.id, chat_title_text)
-
-        caption, msg_attaches, detected_types = build_outgoing_payload(client, message, chat_title_text)
-
-        print(f"📨 Сообщение {message.id} | Вложений: {len(msg_attaches) if msg_attaches else 0}")
-        if msg_attaches:
-            print(f"   Вложения: {[a.get('_type', a.get('type', 'UNKNOWN')) for a in msg_attaches]}")
-        if caption or msg_attaches:
-            print(f"✉️ Типы сообщения в MAX: {', '.join(sorted(detected_types)) or 'UNKNOWN'}")
-            send_to_telegram(
-                TG_BOT_TOKEN,
-                TG_CHAT_ID,
-                caption,
-                msg_attaches,
-                TG_THREAD_ID,  # ← ДОБАВЛЕНО!
-                MAX_TOKEN,
-                message.user.contact.id,
-            )
 
+def _request_shutdown(signum, frame):
+    log.info("Получен сигнал %s, завершаем работу", signum)
+    _shutdown.set()
 
-client.run()
 
+signal.signal(signal.SIGTERM, _request_shutdown)
+signal.signal(signal.SIGINT, _request_shutdown)
+
+control.start()
+outbox.start()
+for stage in PIPELINE.values():
+    stage.start()
+try:
+    client.run()
+    # run() только запускает потоки клиента и сразу возвращается: ждём сигнала или конца listener.
+    # Ждём короткими отрезками, чтобы сигнал обрабатывался и на Windows
+    while not _shutdown.wait(0.5) and client.is_running:
+        pass
+finally:
+    # останавливаем по порядку. Сначала клиент перестаёт принимать пуши, а ingest и enrich
+    # дорабатывают уже принятое, пока соединение открыто (им нужны запросы к MAX: пользователи,
+    # ответы). Потом отключаемся, render и deliver дописывают всё в outbox; воркеры не демоны
+    client.drain()
+    enrich_stage.stop(wait=True)
+    client.stop()
+    render_stage.stop(wait=True)
+    deliver_stage.stop(wait=True)
+    outbox.stop()
+    control.stop()
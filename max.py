@@ -1,13 +1,376 @@
+import itertools
 import json
+import logging
+import queue
+import random
+import re
 import threading
 import time
 import ssl
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 from uuid import uuid4
 from classes import *
 from errors import *
+from log import FrameTrace
 import certifi
 from websockets.sync.client import connect
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import ConnectionClosed
+
+_log = logging.getLogger(__name__)
+
+# region codec
+# Fastest JSON library available, stdlib as a fallback. dumps() always returns str:
+# websockets sends bytes as binary frames, and the server expects text.
+try:
+    import orjson
+
+    JSON_CODEC = "orjson"
+    loads = orjson.loads
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    try:
+        import ujson
+
+        JSON_CODEC = "ujson"
+        loads = ujson.loads
+
+        def dumps(obj) -> str:
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+    except ImportError:
+        JSON_CODEC = "json"
+        loads = json.loads
+        _encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+        def dumps(obj) -> str:
+            return _encode(obj)
+
+# Per-opcode frame templates: only seq and the payload are serialized per request
+_FRAME_HEAD = '{"ver":11,"cmd":0,"seq":'
+_frame_tails: dict[int, str] = {}
+
+def frame(seq: int, opcode: int, payload: dict) -> str:
+    """Serializes an outgoing request frame."""
+    tail = _frame_tails.get(opcode)
+    if tail is None:
+        tail = _frame_tails[opcode] = ',"opcode":%d,"payload":' % opcode
+    return _FRAME_HEAD + str(seq) + tail + dumps(payload) + "}"
+
+# Header fields read from the raw text before a full parse (see MaxClient._skip_frame)
+_SNIFF_CMD = re.compile(r'"cmd"\s*:\s*(\d+)')
+_SNIFF_OPCODE = re.compile(r'"opcode"\s*:\s*(\d+)')
+# anchored to the payload's own chatId: a forwarded message's link.chatId must never match
+_SNIFF_CHAT_ID = re.compile(r'"payload"\s*:\s*\{\s*"chatId"\s*:\s*(-?\d+)')
+
+WS_URL = "wss://ws-api.oneme.ru/websocket"
+WS_HEADERS = [
+    ("Origin", "https://web.oneme.ru"),
+    ("Pragma", "no-cache"),
+    ("Cache-Control", "no-cache"),
+    ("User-Agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/117.0.0.0 Safari/537.36")
+]
+
+_ssl_ctx = None
+
+def _ssl_context() -> ssl.SSLContext:
+    """SSL context with the certifi bundle, built once and shared by every connection."""
+    global _ssl_ctx
+    if _ssl_ctx is None:
+        _ssl_ctx = ssl.create_default_context(cafile=certifi.where())
+    return _ssl_ctx
+
+# Outbound priorities, lower is sent first
+PRIORITY_HIGH = 0    # heartbeats and ping replies
+PRIORITY_NORMAL = 1  # regular requests
+PRIORITY_LOW = 2     # bulk requests (history, prefetch)
+
+# region class ContactLoader
+class ContactLoader:
+    def __init__(self, client, window: float = 0.01, max_batch: int = 100):
+        """
+        Coalesces opcode 32 contact lookups.
+
+        IDs requested within `window` seconds (from any number of threads) are sent as one `contactIds`
+        request of up to `max_batch` IDs, and concurrent requests for the same ID wait on the same result.
+        Loaded users are stored in the client's user cache (`client.users`).
+        """
+        self._client = client
+        self.window = window
+        self.max_batch = max_batch
+
+        self._lock = threading.Lock()
+        self._waiting: dict[int, Future] = {}
+        self._batch: list[int] = []
+        self.stats = {"requests": 0, "ids": 0, "coalesced": 0}
+
+    # region load()
+    def load(self, id: int, timeout: float|None = None) -> User:
+        """
+        Loads one user, batched with other lookups made at the same time.
+
+        Raises:
+            UserNotFound: If the server returned no such contact.
+        """
+        return self.load_many([id], timeout)[int(id)]
+
+    # region load_many()
+    def load_many(self, ids, timeout: float|None = None) -> dict[int, User]:
+        """
+        Loads several users, batched with other lookups made at the same time.
+
+        Returns:
+            dict[int, User]: Users by contact ID.
+
+        Raises:
+            UserNotFound: If the server returned no contact for one of the IDs.
+        """
+        timeout = (timeout or self._client.rpc_timeout) + self.window
+        return {id: fut.result(timeout) for id, fut in self.submit(ids).items()}
+
+    # region submit()
+    def submit(self, ids) -> dict[int, Future]:
+        """Queues IDs for the next batch without waiting. Returns a future of the `User` per contact ID."""
+        futures = {}
+        flush_now = False
+        with self._lock:
+            for id in ids:
+                id = int(id)
+                fut = self._waiting.get(id)
+                if fut is None:
+                    fut = self._waiting[id] = Future()
+                    self._batch.append(id)
+                    if len(self._batch) == 1:
+                        t = threading.Timer(self.window, self._flush)
+                        t.daemon = True
+                        t.start()
+                    elif len(self._batch) >= self.max_batch:
+                        flush_now = True
+                else:
+                    self.stats["coalesced"] += 1
+                futures[id] = fut
+        if flush_now:
+            self._flush()
+        return futures
+
+    # region _flush()
+    def _flush(self):
+        """Internal worker. Sends everything collected so far."""
+        with self._lock:
+            ids, self._batch = self._batch, []
+        for i in range(0, len(ids), self.max_batch):
+            self._load_chunk(ids[i:i + self.max_batch])
+
+    # region _load_chunk()
+    def _load_chunk(self, ids: list[int]):
+        self.stats["requests"] += 1
+        self.stats["ids"] += len(ids)
+        try:
+            payload = self._client._request(32, {"contactIds": ids})["payload"]
+            error = payload.get("error")
+            if error:
+                raise UserNotFound(error, payload.get("message", error))
+        except Exception as e:
+            with self._lock:
+                futures = [self._waiting.pop(id) for id in ids]
+            for fut in futures:
+                fut.set_exception(e)
+            return
+
+        contacts = {c.get("id"): c for c in payload.get("contacts", [])}
+        with self._lock:
+            futures = {id: self._waiting.pop(id) for id in ids}
+        for id, fut in futures.items():
+            contact = contacts.get(id)
+            if contact is None:
+                fut.set_exception(UserNotFound("not.found", f"Contact not found: {id}"))
+                continue
+            fut.set_result(self._client.users.put(User.from_payload(self._client, contact)))
+
+# region class Directory
+class Directory:
+    def __init__(self, client):
+        """
+        In-memory index of contact names and chat titles filled from the opcode 19 login response.
+
+        The first login asks for a full sync; reconnects pass the server `time` of the previous sync
+        as `contactsSync`/`chatsSync`, so only changes come back and get merged in.
+        Contacts from the sync also land in the client's user cache (`client.users`).
+        """
+        self._client = client
+        self.names: dict[int, str] = {}   # contact id -> name
+        self.titles: dict[int, str] = {}  # chat id -> title
+        self.contacts_sync = 0
+        self.chats_sync = 0
+
+    # region update()
+    def update(self, payload: dict):
+        """Merges contacts and chats from a login response payload."""
+        for contact in payload.get("contacts") or []:
+            if not contact.get("id"):
+                continue
+            usr = self._client.users.put(User.from_payload(self._client, contact))
+            if usr.contact.names:
+                self.names[usr.contact.id] = self._name_of(usr.contact.names[0])
+
+        me = self._client.me.contact.id if self._client.me else None
+        for chat in payload.get("chats") or []:
+            chat_id = chat.get("id")
+            if not chat_id:
+                continue
+            title = chat.get("title")
+            if not title and me and chat.get("type") == "DIALOG":
+                title = self.names.get(chat_id ^ me)
+            if title:
+                self.titles[chat_id] = title
+
+        sync_time = payload.get("time")
+        if sync_time:
+            self.contacts_sync = sync_time
+            self.chats_sync = sync_time
+
+    # region name()
+    def name(self, user_id: int) -> str|None:
+        """Name of a contact, or None if it wasn't in the sync."""
+        return self.names.get(user_id)
+
+    # region title()
+    def title(self, chat_id: int) -> str|None:
+        """Title of a chat, or None if it wasn't in the sync."""
+        return self.titles.get(chat_id)
+
+    @staticmethod
+    def _name_of(name: Name) -> str:
+        return name.name or " ".join(n for n in (name.first_name, name.last_name) if n)
+
+# region class Dispatcher
+class Dispatcher:
+    def __init__(self, workers: int = 4, queue_size: int = 256, name: str = "WebMaxDispatch"):
+        """
+        Runs handlers on a pool of worker threads, sharded by chat ID.
+
+        All work for one chat goes to the same worker, so handlers see a chat's messages in order
+        while different chats are handled in parallel. Each worker has a bounded queue: when it is
+        full, `submit()` blocks the caller (the listener), which is counted in `stats` as backpressure.
+        Exceptions raised by handlers are logged and counted, and never reach the listener.
+        With `workers=0` handlers run inline on the calling thread.
+
+        Latency is tracked per job: `wait_time` is time spent queued, `run_time` time spent running.
+        Several dispatchers can be chained into a pipeline; `name` labels the worker threads.
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.name = name
+        self._queues: list[queue.Queue] = []
+        self._threads: list[threading.Thread] = []
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "dispatched": 0,
+            "completed": 0,
+            "errors": 0,
+            "blocked": 0,         # submits that had to wait for a full queue
+            "blocked_time": 0.0,  # total time spent waiting, s
+            "max_queue_depth": 0,
+            "wait_time": 0.0,     # total time jobs sat in the queue, s
+            "run_time": 0.0,      # total time jobs ran, s
+            "max_run_time": 0.0,
+        }
+
+    # region start()
+    def start(self):
+        """Starts the worker threads. Called by `MaxClient.run()`."""
+        if self._threads:
+            return
+        self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._worker, args=(q,), name=f"{self.name}-{i}")
+            t.start()
+            self._threads.append(t)
+
+    # region stop()
+    def stop(self, wait: bool = False):
+        """
+        Lets the workers finish what is already queued, then ends them.
+
+        Args:
+            wait (bool): Block until the workers are done, so work they pass on to a downstream
+                dispatcher is submitted before that one is stopped.
+        """
+        for q in self._queues:
+            q.put(None)
+        threads, self._threads = self._threads, []
+        if wait:
+            for t in threads:
+                t.join()
+
+    # region submit()
+    def submit(self, chat_id: int, func, *args):
+        """
+        Queues `func(*args)` on the worker that owns `chat_id`.
+
+        Args:
+            chat_id (int): Shard key; work for the same chat runs in submission order.
+            func (callable): The work to run.
+        """
+        # stage workers of a pipeline submit concurrently, so every counter goes through the lock
+        with self._stats_lock:
+            self.stats["dispatched"] += 1
+        if not self._threads:
+            self._run(func, args, time.monotonic())
+            return
+
+        q = self._queues[hash(chat_id) % len(self._queues)]
+        item = (func, args, time.monotonic())
+        blocked = None
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            started = time.monotonic()
+            q.put(item)
+            blocked = time.monotonic() - started
+
+        depth = q.qsize()
+        with self._stats_lock:
+            if blocked is not None:
+                self.stats["blocked"] += 1
+                self.stats["blocked_time"] += blocked
+            if depth > self.stats["max_queue_depth"]:
+                self.stats["max_queue_depth"] = depth
+
+    # region depths
+    @property
+    def depths(self) -> list[int]:
+        """Current queue depth of every worker."""
+        return [q.qsize() for q in self._queues]
+
+    # region _worker()
+    def _worker(self, q: queue.Queue):
+        """Internal worker."""
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            self._run(*item)
+
+    # region _run()
+    def _run(self, func, args, queued: float):
+        """Internal worker. Runs one job, keeping its exception to itself."""
+        started = time.monotonic()
+        try:
+            func(*args)
+        except Exception:
+            _log.exception("Handler error")
+            key = "errors"
+        else:
+            key = "completed"
+        run_time = time.monotonic() - started
+        with self._stats_lock:
+            self.stats[key] += 1
+            self.stats["wait_time"] += started - queued
+            self.stats["run_time"] += run_time
+            if run_time > self.stats["max_run_time"]:
+                self.stats["max_run_time"] = run_time
 
 # region class MaxClient
 class MaxClient:
@@ -30,6 +393,7 @@ class MaxClient:
         # print("Loaded WebMaxLib")
 
         self._seq = 0
+        self._seq_lock = threading.Lock()
 
         self.phone_number = phone
         self.auth_token = token
@@ -41,19 +405,86 @@ class MaxClient:
         self._on_connect = None
         self._connected = False
         self._t = None
+        self._reader_t = None
+        self._writer_t = None
         self._t_stop = False
+        # False once drain() started: pushes are no longer queued for _listener
+        self._accepting = True
+
+        # seq -> Future of the reply; filled by _route()
+        self._pending: dict[int, Future] = {}
+        self._pending_lock = threading.Lock()
+        # unsolicited frames (opcode 128 pushes etc.) waiting for _listener
+        self._events = queue.Queue()
+        self.rpc_timeout = 15
+
+        # (priority, order, serialized frame, enqueued_at) waiting for _writer
+        self._outbox = queue.PriorityQueue(maxsize=1000)
+        self._outbox_order = itertools.count()
+        self._write_lock = threading.Lock()
+        self.writer_stats = {
+            "sent": 0,
+            "send_errors": 0,
+            "max_queue_depth": 0,
+            "avg_send_latency": 0.0,
+            "max_send_latency": 0.0,
+        }
 
         self.is_log_in = False
         self.me = None
         self.session_id = int(time.time()*1000)
 
+        # shared caches behind the lazy Message.chat / Message.user
+        self.users = UserCache()
+        self._chats: dict[int, Chat] = {}
+        self.contacts = ContactLoader(self)
+        self.directory = Directory(self)
+
         self.handlers = []
+        self.raw_handlers: dict[int, list] = {}
+        # chat id -> handlers that can match there, see _routes_for()
+        self._routes: dict[int, list] = {}
+        self._unrouted: list = []
+        self._routes_built = 0
+        # handlers run here, off the listener thread
+        self.dispatcher = Dispatcher()
+        self.prefilter_stats = {"passed": 0, "dropped": 0}
+        self.frame_stats = {"parsed": 0, "dropped": 0, "dropped_by_opcode": {}}
+        # last received raw frames, see log.FrameTrace
+        self.trace = FrameTrace()
+
+        # reconnect supervisor
+        self.reconnect_base_delay = 1
+        self.reconnect_max_delay = 60
+        self.catch_up_chats: set[int] = set()  # chats to catch up after a reconnect, all seen chats if empty
+        self.catch_up_page = 50
+        self._last_seen: dict[int, int] = {}  # chat id -> time of the newest message seen
+        self._recent_ids: OrderedDict = OrderedDict()  # _seen_key() of recently seen messages
+        self._recent_lock = threading.Lock()
+        self.reconnect_stats = {
+            "reconnects": 0,
+            "failed_attempts": 0,
+            "caught_up": 0,
+            "last_outage": 0.0,
+        }
+
+        # make-before-break handover, off by default
+        self.make_before_break = False
+        self.handover_rtt = 5.0          # heartbeat round trip (s) that triggers a handover
+        self.rotate_every: float|None = None  # scheduled handover interval (s)
+        self.handover_grace = 2.0        # how long to wait for replies on the old socket
+        self.heartbeat_rtt: float|None = None
+        self._connected_at = 0.0
+        self._dedupe_until = 0.0
+        self._handover_lock = threading.Lock()
+        self.handover_stats = {"handovers": 0, "failed": 0, "last_duration": 0.0}
 
     # region seq
     @property
     def seq(self):
-        current_seq = self._seq
-        self._seq += 1
+        with self._seq_lock:
+            current_seq = self._seq
+            self._seq += 1
         return current_seq
     
     # region cid
@@ -107,50 +538,86 @@ class MaxClient:
         """
         if self._connected:
             return
-        headers = [
-            ("Origin", "https://web.oneme.ru"),
-            ("Pragma", "no-cache"),
-            ("Cache-Control", "no-cache"),
-            ("User-Agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/117.0.0.0 Safari/537.36")
-        ]
-        ssl_ctx = ssl.create_default_context(cafile=certifi.where())
-        self.websocket = connect("wss://ws-api.oneme.ru/websocket", additional_headers=headers, ssl=ssl_ctx)
-        self.websocket.send(self.user_agent)
-        self.websocket.recv()
+        websocket = self._open()
 
         if _f:
+            self.websocket = websocket
             return
 
-        self.websocket.send(json.dumps({
-            "ver": 11,
-            "cmd": 0,
-            "seq": self.seq,
-            "opcode": 19, 
-            "payload": {
-                "interactive": True,
-                "token": self.auth_token,
-                "chatsSync": 0,
-                "contactsSync": 0,
-                "presenceSync": 0,
-                "draftsSync": 0,
-                "chatsCount": 40
-            }
-        }))
+        # like handover(): the socket stays private until login is done, so the writer can't send
+        # anything queued meanwhile (e.g. during a reconnect backoff) ahead of opcode 19
+        try:
+            self._apply_login(self._login(websocket))
+        except BaseException:
+            try:
+                websocket.close()
+            except:
+                pass
+            raise
+        with self._write_lock:
+            self.websocket = websocket
+        self._connected = True
+        self._connected_at = time.monotonic()
+
+        if self._on_connect:
+            self._on_connect()
+
+    # region _open()
+    def _open(self):
+        """Internal worker. Opens a new socket and sends the user agent."""
+        websocket = connect(WS_URL, additional_headers=WS_HEADERS, ssl=_ssl_context())
+        with self._write_lock:
+            websocket.send(self.user_agent)
+        websocket.recv()
+        return websocket
+
+    # region _login()
+    def _login(self, websocket) -> dict:
+        """
+        Internal worker. Logs in on the given socket and returns the opcode 19 reply.
 
-        response = json.loads(self.websocket.recv())
+        The socket is read directly, so this works on a socket the reader thread doesn't own yet;
+        anything else received meanwhile is passed to `_route()`.
+        """
+        seq = self.seq
+        data = frame(seq, 19, {
+            "interactive": True,
+            "token": self.auth_token,
+            "chatsSync": self.directory.chats_sync,
+            "contactsSync": self.directory.contacts_sync,
+            "presenceSync": 0,
+            "draftsSync": 0,
+            "chatsCount": 40
+        })
+        with self._write_lock:
+            websocket.send(data)
+
+        deadline = time.monotonic() + self.rpc_timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TimeoutError(f"No reply to opcode 19 (seq {seq}) in {self.rpc_timeout}s")
+            recv = loads(websocket.recv(timeout=left))
+            if recv.get("cmd", 0) != 0 and recv.get("seq") == seq and recv.get("opcode") == 19:
+                return recv
+            self._route(recv)
+
+    # region _apply_login()
+    def _apply_login(self, response: dict):
+        """Internal worker. Takes the profile and the directory sync from a login reply."""
         p = response.get('payload', {})
         
         # Debug: Log the response structure
         if 'profile' not in p:
-            print(f"[DEBUG] Response payload missing 'profile' key. Keys: {list(p.keys())}")
-            print(f"[DEBUG] Response status/opcode: {response.get('status')}/{response.get('opcode')}")
-            print(f"[DEBUG] Full response: {json.dumps(response, indent=2)[:500]}")  # First 500 chars
+            _log.warning("Response payload missing 'profile' key. Keys: %s", list(p.keys()))
+            _log.debug("Response status/opcode: %s/%s", response.get('status'), response.get('opcode'))
+            _log.debug("Full response: %.500s", json.dumps(response, indent=2))  # First 500 chars
             
             # Check for error messages
             if 'error' in response:
-                print(f"[ERROR] Server error: {response['error']}")
+                _log.error("Server error: %s", response['error'])
             if 'status' in response and response['status'] != 'ok':
-                print(f"[ERROR] Status not OK: {response['status']}")
+                _log.error("Status not OK: %s", response['status'])
             
             # If profile is missing but we have other data, attempt to handle gracefully
             if p:
@@ -158,13 +625,69 @@ class MaxClient:
             else:
                 raise KeyError("Payload is empty or malformed - authentication may have failed")
         else:
-            usr = User(self, p['profile'])
+            usr = User.from_payload(self, p['profile'])
         
         self.me = usr
-        self._connected = True
+        self.directory.update(p)
 
-        if self._on_connect:
-            self._on_connect()
+    # region handover()
+    def handover(self) -> bool:
+        """
+        Replaces the connection without a blind window (make-before-break).
+
+        A standby socket is opened and logged in while the current one keeps receiving. Then new
+        requests switch to the standby, replies to requests already sent on the old socket are awaited for up to
+        `handover_grace` seconds, and the old socket is closed. Pushes that arrive on both sockets during
+        the overlap are delivered once.
+
+        Called automatically from the heartbeat when `make_before_break` is enabled (slow heartbeat
+        or `rotate_every` elapsed), but can also be called directly, e.g. on an external hint.
+
+        Returns:
+            bool: True if the connection was replaced, False if it failed or another handover/reconnect is running.
+        """
+        if not self._connected or not self._handover_lock.acquire(blocking=False):
+            return False
+        try:
+            started = time.monotonic()
+            self._dedupe_until = started + self.handover_grace + 10
+            standby = None
+            try:
+                standby = self._open()
+                response = self._login(standby)
+            except Exception as e:
+                _log.warning("Handover failed: %s", e)
+                self.handover_stats["failed"] += 1
+                if standby is not None:
+                    try:
+                        standby.close()
+                    except:
+                        pass
+                return False
+
+            old = self.websocket
+            with self._write_lock:
+                self.websocket = standby
+                # only requests already sent on the old socket can be answered there; replies to
+                # anything sent on the standby are read once the reader moves over after old.close()
+                with self._pending_lock:
+                    in_flight = set(self._pending)
+            self._apply_login(response)
+            self._connected_at = time.monotonic()
+
+            deadline = time.monotonic() + self.handover_grace
+            while time.monotonic() < deadline and any(seq in self._pending for seq in in_flight):
+                time.sleep(0.05)
+            try:
+                old.close()
+            except:
+                pass
+
+            self.handover_stats["handovers"] += 1
+            self.handover_stats["last_duration"] = time.monotonic() - started
+            return True
+        finally:
+            self._handover_lock.release()
 
     # region disconnect()
     def disconnect(self):
@@ -185,9 +708,12 @@ class MaxClient:
             return
         if self.websocket:
             self.websocket.close()
-            self._seq = 0
+            with self._seq_lock:
+                self._seq = 0
         self._connected = False
         self.websocket = None
+        self._fail_pending(ConnectionError("Disconnected"))
+        self._drop_outbox()
 
     # region set_token()
     def set_token(self, token):
@@ -206,80 +732,424 @@ class MaxClient:
         """
         self.auth_token = token
 
+    # region _write()
+    def _write(self, data: str, priority: int = PRIORITY_NORMAL):
+        """
+        Internal worker. Queues a serialized frame for the writer thread.
+
+        Blocks while the outbound queue is full. Before `run()` (auth, login) the frame is written
+        directly instead.
+        """
+        if self._writer_t is None or not self._writer_t.is_alive():
+            with self._write_lock:
+                self.websocket.send(data)
+            return
+        self._outbox.put((priority, next(self._outbox_order), data, time.monotonic()))
+        depth = self._outbox.qsize()
+        if depth > self.writer_stats["max_queue_depth"]:
+            self.writer_stats["max_queue_depth"] = depth
+
+    # region _writer()
+    def _writer(self):
+        """Internal worker. The only place that writes the socket once the client is running."""
+        stats = self.writer_stats
+        while not self._t_stop:
+            try:
+                _, _, data, enqueued_at = self._outbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            if data is None:
+                break
+            try:
+                with self._write_lock:
+                    self.websocket.send(data)
+            except Exception as e:
+                stats["send_errors"] += 1
+                _log.error("Writer error: %s", e)
+                continue
+            latency = time.monotonic() - enqueued_at
+            stats["sent"] += 1
+            stats["avg_send_latency"] += (latency - stats["avg_send_latency"]) / stats["sent"]
+            if latency > stats["max_send_latency"]:
+                stats["max_send_latency"] = latency
+
+    # region _drop_outbox()
+    def _drop_outbox(self):
+        """Internal worker. Drops frames queued for a connection that is gone."""
+        while True:
+            try:
+                self._outbox.get_nowait()
+            except queue.Empty:
+                return
+
+    # region outbox_depth
+    @property
+    def outbox_depth(self) -> int:
+        """Number of frames waiting for the writer thread."""
+        return self._outbox.qsize()
+
+    # region is_running
+    @property
+    def is_running(self) -> bool:
+        """True while the listener thread started by `run()` is handling events."""
+        return self._t is not None and self._t.is_alive()
+
+    # region _send()
+    def _send(self, opcode: int, payload: dict, priority: int = PRIORITY_NORMAL) -> int:
+        """Sends a request without waiting for the reply. Returns its seq."""
+        seq = self.seq
+        self._write(frame(seq, opcode, payload), priority)
+        return seq
+
+    # region _request()
+    def _request(self, opcode: int, payload: dict, timeout: float|None = None, priority: int = PRIORITY_NORMAL) -> dict:
+        """
+        Sends a request and waits for the reply with the same seq.
+
+        While the reader thread is running, the reply is delivered to a per-seq future by `_route()`,
+        so requests may be issued concurrently from any thread (handlers included). Before `run()`
+        (auth, login) or from the reader thread itself the caller reads the socket directly, still
+        routing every other frame through `_route()` so no push is lost.
+
+        Args:
+            opcode (int): Request opcode.
+            payload (dict): Request payload.
+            timeout (float | None, optional): Seconds to wait. Defaults to `rpc_timeout`.
+            priority (int, optional): Outbound queue priority. Defaults to `PRIORITY_NORMAL`.
+
+        Returns:
+            dict: The whole reply frame.
+
+        Raises:
+            TimeoutError: If no reply arrived in time.
+            ConnectionError: If the connection was closed while waiting.
+        """
+        timeout = timeout or self.rpc_timeout
+        seq = self.seq
+        fut = Future()
+        fut.opcode = opcode
+        with self._pending_lock:
+            self._pending[seq] = fut
+        try:
+            self._write(frame(seq, opcode, payload), priority)
+            if self._reader_t is not None and self._reader_t.is_alive() and threading.current_thread() is not self._reader_t:
+                return fut.result(timeout)
+
+            deadline = time.monotonic() + timeout
+            while not fut.done():
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError
+                self._route(loads(self.websocket.recv(timeout=left)))
+            return fut.result()
+        except (FutureTimeout, TimeoutError):
+            raise TimeoutError(f"No reply to opcode {opcode} (seq {seq}) in {timeout}s") from None
+        finally:
+            with self._pending_lock:
+                self._pending.pop(seq, None)
+
+    # region _route()
+    def _route(self, recv: dict):
+        """Internal worker. Hands replies to waiting requests, queues everything else for _listener."""
+        if recv.get("cmd", 0) != 0:
+            with self._pending_lock:
+                fut = self._pending.get(recv.get("seq"))
+            if fut is not None and fut.opcode == recv.get("opcode") and not fut.done():
+                fut.set_result(recv)
+            # replies nobody waits for (heartbeat acks, timed out requests) are dropped
+            return
+        if not self._accepting:
+            return
+        if recv.get("opcode") == 128:
+            payload = recv.get("payload") or {}
+            first = self._mark_seen(payload.get("chatId"), payload.get("message") or {})
+            if not first and time.monotonic() < self._dedupe_until:
+                # the same push from both sockets during a handover
+                return
+        self._events.put(recv)
+
+    @staticmethod
+    def _seen_key(chat_id: int, raw: dict) -> tuple:
+        return (chat_id, raw.get("id"), raw.get("updateTime"), raw.get("status"))
+
+    # region _mark_seen()
+    def _mark_seen(self, chat_id: int, raw: dict) -> bool:
+        """
+        Internal worker. Remembers a message for catch-up. Returns False if this version was already seen.
+
+        The version (`updateTime`, `status`) is part of the key: an edit or a removal carries the same ID
+        and must not be mistaken for a duplicate of the original.
+        """
+        key = self._seen_key(chat_id, raw)
+        with self._recent_lock:
+            if key in self._recent_ids:
+                return False
+            self._recent_ids[key] = None
+            if len(self._recent_ids) > 5000:
+                self._recent_ids.popitem(last=False)
+            msg_time = raw.get("time") or 0
+            if msg_time > self._last_seen.get(chat_id, 0):
+                self._last_seen[chat_id] = msg_time
+        return True
+
+    # region _fail_pending()
+    def _fail_pending(self, exc: Exception):
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for fut in pending:
+            if not fut.done():
+                fut.set_exception(exc)
+
+    # region _skip_frame()
+    def _skip_frame(self, data) -> bool:
+        """
+        Internal worker. Decides from the raw text whether a frame can be dropped without parsing it.
+
+        Only pushes (`cmd` 0) are dropped: those with an opcode nobody handles, and opcode 128 pushes
+        whose `chatId` every handler filter rejects (`Filter.check_chat`) and whose chat history isn't
+        being kept (`Chat.history_loaded`). Replies are always parsed.
+        The header fields are looked up in the first bytes of the frame only, and `chatId` only right
+        at the start of `payload`; if they aren't there the frame is parsed as usual.
+        """
+        if not isinstance(data, str):
+            return False
+        head = data[:120]
+        cmd = _SNIFF_CMD.search(head)
+        opcode = _SNIFF_OPCODE.search(head)
+        if cmd is None or opcode is None or cmd.group(1) != "0":
+            return False
+
+        opcode = int(opcode.group(1))
+        if opcode == 128:
+            chat_id = _SNIFF_CHAT_ID.search(data, 0, 200)
+            if chat_id is None:
+                # chatId isn't the payload's first key: can't tell the chat without parsing
+                return False
+            chat_id = int(chat_id.group(1))
+            chat = self._chats.get(chat_id)
+            if chat is not None and chat.history_loaded:
+                return False
+            if any(filter.check_chat(self, chat_id) is not False for filter, _ in self._routes_for(chat_id)):
+                return False
+        elif opcode == 1 or opcode in self.raw_handlers:
+            return False
+
+        self.frame_stats["dropped"] += 1
+        by_opcode = self.frame_stats["dropped_by_opcode"]
+        by_opcode[opcode] = by_opcode.get(opcode, 0) + 1
+        return True
+
+    # region _routes_for()
+    def _routes_for(self, chat_id: int) -> list:
+        """
+        Internal worker. The handlers that can match in a chat, in registration order.
+
+        Handlers whose filter has a `chat_scope()` are indexed by chat ID, the rest apply everywhere,
+        so the lookup costs the same however many chats and scoped handlers there are.
+        """
+        if self._routes_built != len(self.handlers):
+            self._build_routes()
+        return self._routes.get(chat_id, self._unrouted)
+
+    # region _build_routes()
+    def _build_routes(self):
+        """Internal worker. Rebuilds the chat index after handlers were added."""
+        handlers = list(self.handlers)
+        scopes = [filter.chat_scope() for filter, _ in handlers]
+        routes = {}
+        for chat_id in set().union(*(scope for scope in scopes if scope is not None)):
+            routes[chat_id] = [h for h, scope in zip(handlers, scopes) if scope is None or chat_id in scope]
+        self._unrouted = [h for h, scope in zip(handlers, scopes) if scope is None]
+        self._routes = routes
+        self._routes_built = len(handlers)
+
+    # region _prefilter()
+    def _prefilter(self, chat_id: int, raw: dict) -> list:
+        """
+        Internal worker. Evaluates handler filters on the raw payload before any object is built.
+
+        Returns the handlers that may still match as `(decision, filter, func)`, where decision is
+        True (matched on the raw payload) or None (needs the full `Message`). An empty list means
+        the message is dropped.
+        """
+        candidates = []
+        for filter, func in self._routes_for(chat_id):
+            decision = filter.check_raw(self, chat_id, raw)
+            if decision is False:
+                continue
+            candidates.append((decision, filter, func))
+            if decision:
+                break
+        self.prefilter_stats["passed" if candidates else "dropped"] += 1
+        return candidates
+
     # region _hlprocessor()
-    def _hlprocessor(self, msg: Message):
+    def _hlprocessor(self, msg: Message, candidates: list|None = None):
         """Internal worker. Don't touch."""
-        for filter, func in self.handlers:
-            if filter(self, msg):
+        if candidates is None:
+            candidates = [(None, filter, func) for filter, func in self.handlers]
+        for decision, filter, func in candidates:
+            if decision or filter(self, msg):
                 func(self, msg)
                 return  
 
     def _heartbeat(self):
         """Отправляет пинг серверу каждые 25 секунд"""
-        while self._connected and not self._t_stop:
+        while not self._t_stop:
+            if self._connected:
+                started = time.monotonic()
+                try:
+                    self._request(1, {"interactive": False}, priority=PRIORITY_HIGH)
+                    self.heartbeat_rtt = time.monotonic() - started
+                except TimeoutError:
+                    self.heartbeat_rtt = float("inf")
+                except Exception as e:
+                    _log.warning("Heartbeat error: %s", e)
+
+                if self.make_before_break and self._connected:
+                    slow = self.heartbeat_rtt is not None and self.heartbeat_rtt > self.handover_rtt
+                    due = self.rotate_every is not None and time.monotonic() - self._connected_at > self.rotate_every
+                    if slow or due:
+                        self.handover()
+            time.sleep(25)
+
+    # region _reader()
+    def _reader(self):
+        """Internal worker. The only place that reads the socket once the client is running."""
+        # the reader stays on its socket until that one is closed: during a handover it keeps
+        # draining replies on the old socket, then moves to the new one
+        websocket = self.websocket
+        while not self._t_stop:
+            if websocket is None:
+                websocket = self.websocket
             try:
-                self.websocket.send(json.dumps({
-                    "ver": 11,
-                    "cmd": 0,
-                    "seq": self.seq,
-                    "opcode": 1,
-                    "payload": {"interactive": False}
-                }))
+                data = websocket.recv()
+                self.trace.record(data)
+                if self._skip_frame(data):
+                    continue
+                recv = loads(data)
+                self.frame_stats["parsed"] += 1
+            except ConnectionClosed:
+                if self._t_stop:
+                    break
+                if websocket is not self.websocket:
+                    # retired by handover(), carry on with the new socket
+                    websocket = self.websocket
+                    continue
+                self._reconnect()
+                websocket = self.websocket
+                continue
+
             except Exception as e:
-                print("Heartbeat error:", e)
-            time.sleep(25)
+                if self._t_stop or self.websocket is None:
+                    # disconnect()/session_exit() without stop(): nothing left to read
+                    break
+                _log.exception("Иная беда: %s", e)
+                time.sleep(1)
+                continue
 
+            self._route(recv)
 
-    # region _listener()
-    def _listener(self):
+    # region _reconnect()
+    def _reconnect(self):
+        """
+        Internal worker. Reconnects with jittered exponential backoff until it succeeds or the client stops.
+
+        After re-auth a catch-up pass is started in the background to replay what was missed.
+        """
+        disconnected_at = int(time.time()*1000)
+        started = time.monotonic()
+        self._connected = False
+        self._fail_pending(ConnectionError("Connection closed"))
+        self._drop_outbox()
+
+        attempt = 0
         while not self._t_stop:
             try:
-                recv = json.loads(self.websocket.recv())
-            except ConnectionClosedError:
-                self._connected = False
-                try:
-                    if self.websocket:
-                        self.websocket.close()
-                except:
-                    pass
-                time.sleep(3)
-                try:
-                    self.connect()
-                except Exception as ee:
-                    print("Не смог встать:", ee)
-                    time.sleep(5)
+                if self.websocket:
+                    self.websocket.close()
+            except:
+                pass
+            delay = min(self.reconnect_max_delay, self.reconnect_base_delay * 2 ** attempt)
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            try:
+                self.connect()
+            except Exception as ee:
+                _log.warning("Не смог встать: %s", ee)
+                self.reconnect_stats["failed_attempts"] += 1
+                attempt += 1
+                continue
 
-                else:
-                    break
+            self.reconnect_stats["reconnects"] += 1
+            self.reconnect_stats["last_outage"] = time.monotonic() - started
+            threading.Thread(target=self._catch_up, args=(disconnected_at,), name="WebMaxCatchUp", daemon=True).start()
+            return
 
+    # region _catch_up()
+    def _catch_up(self, disconnected_at: int):
+        """
+        Internal worker. Replays messages missed during an outage through the normal handlers.
+
+        For every chat in `catch_up_chats` (or every chat seen so far) history is paged forward with
+        opcode 49 from the last seen message time, or from the disconnect time for chats with no
+        message seen yet. Messages already received live are skipped.
+        """
+        chats = self.catch_up_chats or set(self._last_seen)
+        for chat_id in chats:
+            since = self._last_seen.get(chat_id, disconnected_at)
+            try:
+                while not self._t_stop and self._accepting:
+                    recv = self._request(49, {"chatId":chat_id,"from":since,"forward":self.catch_up_page,"backward":0,"getMessages":True}, priority=PRIORITY_LOW)
+                    page = recv["payload"].get("messages") or []
+                    newer = sorted((m for m in page if (m.get("time") or 0) > since), key=lambda m: m["time"])
+                    for raw in newer:
+                        if self._mark_seen(chat_id, raw):
+                            self._events.put({"ver": 11, "cmd": 0, "opcode": 128, "payload": {"chatId": chat_id, "message": raw}})
+                            self.reconnect_stats["caught_up"] += 1
+                    if len(page) < self.catch_up_page or not newer:
+                        break
+                    since = newer[-1]["time"]
             except Exception as e:
-                print("Иная беда:", e)
-                self._connected = False
-                time.sleep(5)
-                continue
+                _log.warning("Catch-up error in %s: %s", chat_id, e)
+
+    # region _listener()
+    def _listener(self):
+        while not self._t_stop:
+            recv = self._events.get()
+            if recv is None:
+                break
 
             opcode = recv.get("opcode")
             payload = recv.get("payload")
 
             match opcode:
                 case 1:
-                    self.websocket.send(json.dumps({
-                        "ver": 11,
-                        "cmd": 0,
-                        "seq": self.seq,
-                        "opcode": 1,
-                        "payload": {"interactive": False}
-                    }))
-                    self.websocket.recv()
+                    self._send(1, {"interactive": False}, PRIORITY_HIGH)
 
                 case 128:
-                    msg = Message(self, payload["chatId"], **payload["message"])
-                    self._hlprocessor(msg)
+                    chat_id = payload["chatId"]
+                    raw = payload["message"]
+                    msg = None
+                    chat = self._chats.get(chat_id)
+                    if chat is not None and chat.history_loaded:
+                        msg = Message.from_payload(self, chat_id, raw, _chat=chat)
+                        chat._push(msg)
+                    candidates = self._prefilter(chat_id, raw)
+                    if candidates:
+                        if msg is None:
+                            msg = Message.from_payload(self, chat_id, raw)
+                        self.dispatcher.submit(chat_id, self._hlprocessor, msg, candidates)
 
                 case _:
-                    pass
+                    funcs = self.raw_handlers.get(opcode)
+                    if funcs:
+                        chat_id = payload.get("chatId", 0) if isinstance(payload, dict) else 0
+                        for func in funcs:
+                            self.dispatcher.submit(chat_id, func, self, payload)
 
-            print(json.dumps(recv, ensure_ascii=False, indent=4))
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("Event opcode %s: %s", opcode, payload)
 
 
     # region run()
@@ -299,23 +1169,52 @@ class MaxClient:
         try:
             self.connect()
         except KeyError as e:
-            print(f"[ERROR] Failed to connect: Missing required field in server response: {e}")
-            print("[ERROR] This may indicate an authentication token issue or server problem.")
+            _log.error("Failed to connect: Missing required field in server response: %s", e)
+            _log.error("This may indicate an authentication token issue or server problem.")
             raise
         except Exception as e:
-            print(f"[ERROR] Connection failed: {e}")
+            _log.error("Connection failed: %s", e)
             raise
             
+        self._writer_t = threading.Thread(target=self._writer, name="WebMaxWriter", daemon=True)
+        self._writer_t.start()
+        self._reader_t = threading.Thread(target=self._reader, name="WebMaxReader")
+        self._reader_t.start()
+        self.dispatcher.start()
         self._t = threading.Thread(target=self._listener, name="WebMaxListener")
         self._t.start()
         threading.Thread(target=self._heartbeat, name="WebMaxHeartbeat", daemon=True).start()
+
+    # region drain()
+    def drain(self):
+        """
+        Stops taking new events from the server and waits until those already accepted are handled.
+
+        The connection stays open, so handlers still running can make requests. Call `stop()` afterwards.
+
+        Usage:
+            ```
+            client.drain()  # finish the queued messages
+            client.stop()
+            ```
+        """
+        self._accepting = False
+        # _listener handles everything queued before this marker, then exits
+        self._events.put(None)
+        if self._t is not None:
+            self._t.join()
+        self.dispatcher.stop(wait=True)
     
-    def stop(self):
+    def stop(self, wait: bool = False):
         """
         Stops the listener thread and disconnects from the server.
 
         This signals the listener to stop and closes the connection.
 
+        Args:
+            wait (bool): Block until the dispatcher has run the handlers already queued.
+                Do not pass it from inside a handler.
+
         Usage:
             ```
             # You can use only token or only phone if have one.
@@ -330,6 +1229,9 @@ class MaxClient:
         """
         self._t_stop = True
         self.disconnect()
+        self._events.put(None)
+        self._outbox.put((-1, -1, None, 0))
+        self.dispatcher.stop(wait=wait)
 
     # region _start_auth()
     def _start_auth(self, phone_number) -> dict:
@@ -349,35 +1251,19 @@ class MaxClient:
         if self.is_log_in:
             raise ValueError("Client is logged in now")
         
-        self.websocket.send(json.dumps({
-            "ver": 11,
-            "cmd": 0,
-            "seq": self.seq,
-            "opcode": 17,
-            "payload": {
-                "phone": phone_number,
-                "type": "START_AUTH",
-                "language": "ru"
-            }
-        }))
-
-        return json.loads(self.websocket.recv()) # experimental
+        return self._request(17, {
+            "phone": phone_number,
+            "type": "START_AUTH",
+            "language": "ru"
+        })
     
     # region _check_code()
     def _check_code(self, token, code) -> dict:
-        self.websocket.send(json.dumps({
-            "ver": 11,
-            "cmd": 0,
-            "seq": self.seq,
-            "opcode": 18,
-            "payload": {
-                "token": token,
-                "verifyCode": code,
-                "authTokenType": "CHECK_CODE"
-            }
-        }))
-
-        token_resp = json.loads(self.websocket.recv())
+        token_resp = self._request(18, {
+            "token": token,
+            "verifyCode": code,
+            "authTokenType": "CHECK_CODE"
+        })
         payload = token_resp['payload']
         error = token_resp['payload'].get("error", None)
 
@@ -425,7 +1311,7 @@ class MaxClient:
                 continue
 
         self.auth_token = payload['tokenAttrs']['LOGIN']['token']
-        usr = User(self, payload['profile'])
+        usr = User.from_payload(self, payload['profile'])
         self.me = usr
         return self.me
 
@@ -484,40 +1370,27 @@ class MaxClient:
             msg = client.send_message(12345678, "Replying to you!", reply_id=987654)
             ```
         """
-        seq = self.seq
         j = {
-            "ver":11,
-            "cmd":0,
-            "seq":seq,
-            "opcode":64,
-            "payload": {
-                "chatId":chat_id,
-                "message": {
-                    "text":text,
-                    "cid": self.cid,
-                    "elements":[],
-                    "attaches":[]
-                },
-                "notify": notify
-            }
+            "chatId":chat_id,
+            "message": {
+                "text":text,
+                "cid": self.cid,
+                "elements":[],
+                "attaches":[]
+            },
+            "notify": notify
         }
 
         if reply_id:
-            j["payload"]["message"]["link"] = {
+            j["message"]["link"] = {
                 "type": "REPLY",
                 "messageId": str(reply_id)
             }
 
-        self.websocket.send(json.dumps(j))
-        while True:
-            recv = json.loads(self.websocket.recv())
-            if recv["seq"] != seq:
-                pass
-            else:
-                break
+        recv = self._request(64, j)
         payload = recv["payload"]
         try:
-            msg = Message(self, payload["chatId"], **payload["message"])
+            msg = Message.from_payload(self, payload["chatId"], payload["message"])
         
             return msg
         except:
@@ -548,17 +1421,11 @@ class MaxClient:
             client.delete_message(12345678, ["1000120"], for_me=True)
             ```
         """
-        self.websocket.send(json.dumps({
-            "ver":11,
-            "cmd":0,
-            "seq":self.seq,
-            "opcode":66,
-            "payload": {
-                "chatId":chat_id,
-                "messageIds": message_ids,
-                "forMe": for_me
-            }
-        }))
+        self._send(66, {
+            "chatId":chat_id,
+            "messageIds": message_ids,
+            "forMe": for_me
+        })
 
     # region edit_message()
     def edit_message(self, chat_id: int, message_id: str|int, text: str):
@@ -585,72 +1452,110 @@ class MaxClient:
             updated_msg = client.edit_message(12345678, "12111121", "New text")
             ```
         """
-        seq = self.seq
-        self.websocket.send(json.dumps({
-            "ver": 11,
-            "cmd": 0,
-            "seq": seq,
-            "opcode": 67,
-            "payload": {
-                "chatId": chat_id,
-                "messageId": str(message_id),
-                "text": text,
-                "elements": [],
-                "attachments": []
-            }
-        }))
-
-        while True:
-            recv = json.loads(self.websocket.recv())
-            if recv["seq"] != seq:
-                pass
-            else:
-                break
+        recv = self._request(67, {
+            "chatId": chat_id,
+            "messageId": str(message_id),
+            "text": text,
+            "elements": [],
+            "attachments": []
+        })
         payload = recv["payload"]
-        msg = Message(self, chat_id, **payload["message"])
+        msg = Message.from_payload(self, chat_id, payload["message"])
         
         return msg
     
     # region pin_chat()
     def pin_chat(self, chat_id: int|str):
-        j = {
-            "ver": 11,
-            "cmd": 0,
-            "seq": self.seq,
-            "opcode": 22,
-            "payload": {
-                "settings": {
-                    "chats": {
-                        str(chat_id): {
-                            "favIndex": int(time.time()*1000)
-                        }
+        self._send(22, {
+            "settings": {
+                "chats": {
+                    str(chat_id): {
+                        "favIndex": int(time.time()*1000)
                     }
                 }
             }
-        }
-        self.websocket.send(json.dumps(j))
+        })
         return True
 
     # region unpin_chat()
     def unpin_chat(self, chat_id: int|str):
-        j = {
-            "ver": 11,
-            "cmd": 0,
-            "seq": self.seq,
-            "opcode": 22,
-            "payload": {
-                "settings": {
-                    "chats": {
-                        str(chat_id): {
-                            "favIndex": 0
-                        }
+        self._send(22, {
+            "settings": {
+                "chats": {
+                    str(chat_id): {
+                        "favIndex": 0
                     }
                 }
             }
-        }
-        self.websocket.send(json.dumps(j))
+        })
         return True
     
+    # region iter_history()
+    def iter_history(self, chat_id: int, since: int = 0, until: int|None = None, page_size: int = 100):
+        """
+        Iterates over a chat's history from newest to oldest, one opcode 49 page at a time.
+
+        Only the current page is held in memory and messages are built lazily (`Message.user` and
+        `Message.chat` make no requests unless accessed), so whole chats can be archived in constant memory.
+        Pages are requested at low priority, behind live traffic.
+
+        Args:
+            chat_id (int): The chat ID.
+            since (int, optional): Stop at messages older than this time (ms). Defaults to 0, the whole history.
+            until (int, optional): Start from this time (ms). Defaults to now.
+            page_size (int, optional): Messages per request. Defaults to 100.
+
+        Yields:
+            Message: Messages with `since <= time <= until`, newest first.
+
+        Usage:
+            ```python
+            for message in client.iter_history(chat_id, since=int(time.time()*1000) - 86400_000):
+                archive.write(f"{message.time}\t{message.sender}\t{message.text}\n")
+            ```
+        """
+        cursor = until if until is not None else int(time.time()*1000)
+        boundary: set = set()  # IDs already yielded at the cursor time, the next page repeats them
+        while cursor >= since:
+            recv = self._request(49, {"chatId":chat_id,"from":cursor,"forward":0,"backward":page_size,"getMessages":True}, priority=PRIORITY_LOW)
+            page = recv["payload"].get("messages") or []
+            page.sort(key=lambda raw: raw.get("time") or 0, reverse=True)
+
+            fresh = [raw for raw in page if not (raw.get("time") == cursor and raw.get("id") in boundary)]
+            if not fresh:
+                return
+            for raw in fresh:
+                if (raw.get("time") or 0) < since:
+                    return
+                yield Message.from_payload(self, chat_id, raw)
+
+            oldest = fresh[-1].get("time") or 0
+            if len(page) < page_size or oldest > cursor:
+                return
+            if oldest < cursor:
+                boundary = set()
+            boundary.update(raw.get("id") for raw in fresh if raw.get("time") == oldest)
+            cursor = oldest
+
+    # region get_chat()
+    def get_chat(self, chat_id: int) -> Chat:
+        """
+        Returns the `Chat` object for a chat ID, shared by all messages of that chat.
+
+        No request is made here; the chat history is fetched on first access to `Chat.messages`
+        and then kept current from live pushes.
+
+        Usage:
+            ```python
+            chat = client.get_chat(12345678)
+            print(len(chat.messages))
+            ```
+        """
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats.setdefault(chat_id, Chat(self, chat_id))
+        return chat
+
     # region get_user()
     def get_user(self, **kwargs):
         """
@@ -682,26 +1587,17 @@ class MaxClient:
         phone = kwargs.get('phone')
         chat_id = kwargs.get('chat_id')
         _f = kwargs.get("_f")
-        seq = self.seq
+
+        if chat_id and not id and not phone:
+            id = self.me.contact.id ^ chat_id
 
         if id:
-            j = {"ver":11,"cmd":0,"seq":seq,"opcode":32,"payload":{"contactIds":[id]}}
+            usr = self.users.get(int(id))
+            return usr if usr is not None else self.contacts.load(id)
         elif phone:
-            j = {"ver":11,"cmd":0,"seq":seq,"opcode":46,"payload":{"phone":str(phone)}}
-        elif chat_id:
-            id = self.me.contact.id ^ chat_id
-            j = {"ver":11,"cmd":0,"seq":seq,"opcode":32,"payload":{"contactIds":[id]}}
+            recv = self._request(46, {"phone":str(phone)})
         else:
             raise ValueError("no `id` or `phone` or `chat_id` provided")
-        
-        self.websocket.send(json.dumps(j))
-
-        while True:
-            recv = json.loads(self.websocket.recv())
-            if recv["seq"] != seq:
-                pass
-            else:
-                break
 
         payload = recv["payload"]
 
@@ -710,19 +1606,49 @@ class MaxClient:
         if error:
             raise UserNotFound(error, payload["message"]+f": {phone}")
 
-        if id:
-            contact = payload["contacts"][0]
-        if phone:
-            payload["contact"]["phone"] = phone
-            contact = payload["contact"]
+        payload["contact"]["phone"] = phone
+        contact = payload["contact"]
+
+        usr = User.from_payload(self, contact)
+        if usr.contact.id:
+            usr = self.users.put(usr)
+        return usr
+
+    # region get_users()
+    def get_users(self, ids) -> list[User]:
+        """
+        Retrieves several users at once with a single opcode 32 request for those not cached yet.
 
-        return User(self, contact, _f)
+        Args:
+            ids (Iterable[int]): Contact IDs.
+
+        Returns:
+            list[User]: Found users; IDs the server doesn't know are skipped.
+
+        Usage:
+            ```python
+            users = client.get_users([123456, 654321])
+            ```
+        """
+        users, missing = [], []
+        for id in {int(id) for id in ids if id}:
+            usr = self.users.get(id)
+            if usr is not None:
+                users.append(usr)
+            else:
+                missing.append(id)
+        timeout = self.rpc_timeout + self.contacts.window
+        for fut in self.contacts.submit(missing).values():
+            try:
+                users.append(fut.result(timeout))
+            except UserNotFound:
+                pass
+        return users
 
     # region session_exit()
     def session_exit(self):
         """Terminates active session token. **There no way back.**"""
-        j = {"ver":11,"cmd":0,"seq":self.seq,"opcode":20,"payload":{}}
-        self.websocket.send(json.dumps(j))
+        self._send(20, {})
         self.disconnect()
         return True
     
@@ -742,80 +1668,32 @@ class MaxClient:
             Reactions: An object containing information about the updated message reactions,
                     including counters for each emoji, your own reaction, and the total count.
         """
-        seq = self.seq
-        j = {"ver":11,"cmd":0,"seq":seq,"opcode":178,"payload":{"chatId":chat_id,"messageId":message_id,"reaction":{"reactionType":"EMOJI","id":reaction}}}
-        self.websocket.send(json.dumps(j))
-
-        while True:
-            recv = json.loads(self.websocket.recv())
-            if recv["seq"] != seq:
-                pass
-            else:
-                break
+        recv = self._request(178, {"chatId":chat_id,"messageId":message_id,"reaction":{"reactionType":"EMOJI","id":reaction}})
 
         payload = recv["payload"] # {"ver":11,"cmd":1,"seq":79,"opcode":178,"payload":{"reactionInfo":{"counters":[{"count":1,"reaction":"â¤ï¸"}],"yourReaction":"â¤ï¸","totalCount":1}}}
         
-        return Reactions(**payload)
+        return Reactions.from_payload(payload)
     
     # region contact_add()
     def contact_add(self, user_id: int):
-        seq = self.seq
-        j = {"ver":11, "cmd":0, "seq":seq, "opcode":34, "payload":{"contactId": user_id, "action": "ADD"}}
-        self.websocket.send(json.dumps(j))
-
-        while True:
-            recv = json.loads(self.websocket.recv())
-            if recv["seq"] != seq:
-                pass
-            else:
-                break
+        recv = self._request(34, {"contactId": user_id, "action": "ADD"})
         payload = recv["payload"]
 
-        return User(self, payload["contact"])
+        return User.from_payload(self, payload["contact"])
     
     # region contact_remove()
     def contact_remove(self, user_id: int):
-        seq = self.seq
-        j = {"ver":11, "cmd":0, "seq":seq, "opcode":34, "payload":{"contactId": user_id, "action": "REMOVE"}}
-        self.websocket.send(json.dumps(j))
-
-        while True:
-            recv = json.loads(self.websocket.recv())
-            if recv["seq"] != seq:
-                pass
-            else:
-                break
-            
+        self._request(34, {"contactId": user_id, "action": "REMOVE"})
         return True
     
     # region contact_block()
     def contact_block(self, user_id: int):
-        seq = self.seq
-        j = {"ver":11, "cmd":0, "seq":seq, "opcode":34, "payload":{"contactId": user_id, "action": "BLOCK"}}
-        self.websocket.send(json.dumps(j))
-
-        while True:
-            recv = json.loads(self.websocket.recv())
-            if recv["seq"] != seq:
-                pass
-            else:
-                break
-            
+        self._request(34, {"contactId": user_id, "action": "BLOCK"})
         return True
     
     # region contact_unblock()
     def contact_unblock(self, user_id: int):
-        seq = self.seq
-        j = {"ver":11, "cmd":0, "seq":seq, "opcode":34, "payload":{"contactId": user_id, "action": "UNBLOCK"}}
-        self.websocket.send(json.dumps(j))
-
-        while True:
-            recv = json.loads(self.websocket.recv())
-            if recv["seq"] != seq:
-                pass
-            else:
-                break
-            
+        self._request(34, {"contactId": user_id, "action": "UNBLOCK"})
         return True
                 
     # region @on_message()
@@ -842,11 +1720,32 @@ class MaxClient:
         ```
         """
         def decorator(func):
-            self.handlers.append((filters, func))
+            self.handlers.append((filters.compile(), func))
             return func
 
         return decorator
     
+    # region @on_opcode()
+    def on_opcode(self, opcode: int):
+        """
+        Decorator to register a handler for raw pushes with a given opcode (other than 1 and 128).
+
+        The handler gets the client and the push payload dict. Pushes with an opcode that has no
+        handler are dropped by the reader without being parsed.
+
+        Usage:
+        ```
+        @client.on_opcode(130)
+        def on_typing(client: Client, payload: dict):
+            print("typing in", payload.get("chatId"))
+        ```
+        """
+        def decorator(func):
+            self.raw_handlers.setdefault(opcode, []).append(func)
+            return func
+
+        return decorator
+
     #region @on_connect
     def on_connect(self, func):
         """
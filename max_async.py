@@ -0,0 +1,658 @@
+import asyncio
+import inspect
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from classes import *
+from errors import *
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed
+from max import Directory, MaxClient, WS_URL, WS_HEADERS, _ssl_context, frame, loads
+from log import FrameTrace
+
+_log = logging.getLogger(__name__)
+
+# region class AsyncMaxClient
+class AsyncMaxClient:
+    def __init__(self, token: str|None = None, phone: str|None = None):
+        """
+        Initializes a new instance of the AsyncMaxClient class.
+
+        Same API as `MaxClient`, but everything runs on one asyncio event loop: the reader, the heartbeat
+        and every request are coroutines, so any number of requests can be in flight at once and the client
+        can share a loop with other async code (e.g. an async Telegram sender).
+        Authentication by phone is not supported here, get the token with `MaxClient.auth()`.
+        Like the sync client it reconnects with jittered backoff after any connection loss, replays
+        missed messages (`catch_up_chats`) and keeps the login directory sync (`directory`).
+
+        Usage:
+            ```
+            client = AsyncMaxClient(token="token")
+            asyncio.run(client.run())
+            ```
+        """
+        self._seq = 0
+
+        self.phone_number = phone
+        self.auth_token = token
+        self.user_agent = self._generate_user_agent()
+
+        self.websocket = None
+
+        self._on_connect = None
+        self._connected = False
+        self._t_stop = False
+        self._tasks: set[asyncio.Task] = set()
+        self._stopped: asyncio.Event|None = None
+
+        # seq -> Future of the reply; filled by _route()
+        self._pending: dict[int, asyncio.Future] = {}
+        self.rpc_timeout = 15
+
+        self.is_log_in = False
+        self.me = None
+        self.session_id = int(time.time()*1000)
+
+        # shared with every message, see classes.UserCache
+        self.users = UserCache()
+        self._chats: dict[int, Chat] = {}
+        self.directory = Directory(self)
+
+        self.handlers = []
+        self.raw_handlers: dict[int, list] = {}
+        self._routes: dict[int, list] = {}
+        self._unrouted: list = []
+        self._routes_built = 0
+        self.prefilter_stats = {"passed": 0, "dropped": 0}
+        self.frame_stats = {"parsed": 0, "dropped": 0, "dropped_by_opcode": {}}
+        self.trace = FrameTrace()
+
+        # reconnect supervisor, same settings as MaxClient
+        self.reconnect_base_delay = 1
+        self.reconnect_max_delay = 60
+        self.catch_up_chats: set[int] = set()
+        self.catch_up_page = 50
+        self._last_seen: dict[int, int] = {}
+        self._recent_ids: OrderedDict = OrderedDict()
+        self._recent_lock = threading.Lock()
+        self.reconnect_stats = {
+            "reconnects": 0,
+            "failed_attempts": 0,
+            "caught_up": 0,
+            "last_outage": 0.0,
+        }
+
+    # region seq
+    @property
+    def seq(self):
+        current_seq = self._seq
+        self._seq += 1
+        return current_seq
+
+    cid = MaxClient.cid
+    marker = MaxClient.marker
+    _generate_user_agent = MaxClient._generate_user_agent
+    _prefilter = MaxClient._prefilter
+    _routes_for = MaxClient._routes_for
+    _build_routes = MaxClient._build_routes
+    _skip_frame = MaxClient._skip_frame
+    _seen_key = staticmethod(MaxClient._seen_key)
+    _mark_seen = MaxClient._mark_seen
+    on_opcode = MaxClient.on_opcode
+
+    # region connect()
+    async def connect(self):
+        """
+        Establishes a WebSocket connection to the server, sends the user agent and logs in with the token.
+
+        Usage:
+            ```
+            client = AsyncMaxClient(token="token")
+            await client.connect()
+            ```
+        """
+        if self._connected:
+            return
+        self.websocket = await connect(WS_URL, additional_headers=WS_HEADERS, ssl=_ssl_context())
+        await self.websocket.send(self.user_agent)
+        await self.websocket.recv()
+
+        self._spawn(self._reader())
+
+        response = await self._request(19, {
+            "interactive": True,
+            "token": self.auth_token,
+            "chatsSync": self.directory.chats_sync,
+            "contactsSync": self.directory.contacts_sync,
+            "presenceSync": 0,
+            "draftsSync": 0,
+            "chatsCount": 40
+        })
+        p = response.get('payload', {})
+
+        if 'profile' not in p:
+            if not p:
+                raise KeyError("Payload is empty or malformed - authentication may have failed")
+            _log.warning("Response payload missing 'profile' key. Keys: %s", list(p.keys()))
+            usr = User(self, p, 1)
+        else:
+            usr = User.from_payload(self, p['profile'])
+        usr.chat = self._chat_object(0)
+
+        self.me = usr
+        self.directory.update(p)
+        self._connected = True
+
+        if self._on_connect:
+            r = self._on_connect()
+            if inspect.isawaitable(r):
+                await r
+
+    # region disconnect()
+    async def disconnect(self):
+        """Closes the WebSocket connection and resets the client state."""
+        if not self._connected:
+            return
+        self._connected = False
+        if self.websocket:
+            await self.websocket.close()
+            self._seq = 0
+        self.websocket = None
+        self._fail_pending(ConnectionError("Disconnected"))
+
+    # region set_token()
+    def set_token(self, token):
+        """Sets the authentication token for the client."""
+        self.auth_token = token
+
+    # region _spawn()
+    def _spawn(self, coro) -> asyncio.Task:
+        """Internal worker. Starts a task and keeps a reference to it until it's done."""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    # region _send()
+    async def _send(self, opcode: int, payload: dict) -> int:
+        """Sends a request without waiting for the reply. Returns its seq."""
+        seq = self.seq
+        await self.websocket.send(frame(seq, opcode, payload))
+        return seq
+
+    # region _request()
+    async def _request(self, opcode: int, payload: dict, timeout: float|None = None) -> dict:
+        """
+        Sends a request and waits for the reply with the same seq.
+
+        Args:
+            opcode (int): Request opcode.
+            payload (dict): Request payload.
+            timeout (float | None, optional): Seconds to wait. Defaults to `rpc_timeout`.
+
+        Returns:
+            dict: The whole reply frame.
+
+        Raises:
+            TimeoutError: If no reply arrived in time.
+            ConnectionError: If the connection was closed while waiting.
+        """
+        timeout = timeout or self.rpc_timeout
+        seq = self.seq
+        fut = asyncio.get_running_loop().create_future()
+        fut.opcode = opcode
+        self._pending[seq] = fut
+        try:
+            await self.websocket.send(frame(seq, opcode, payload))
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No reply to opcode {opcode} (seq {seq}) in {timeout}s") from None
+        finally:
+            self._pending.pop(seq, None)
+
+    # region _route()
+    def _route(self, recv: dict):
+        """Internal worker. Hands replies to waiting requests, dispatches everything else."""
+        if recv.get("cmd", 0) != 0:
+            fut = self._pending.get(recv.get("seq"))
+            if fut is not None and fut.opcode == recv.get("opcode") and not fut.done():
+                fut.set_result(recv)
+            return
+
+        match recv.get("opcode"):
+            case 1:
+                self._spawn(self._send(1, {"interactive": False}))
+
+            case 128:
+                payload = recv.get("payload")
+                chat_id, raw = payload["chatId"], payload["message"]
+                self._mark_seen(chat_id, raw)
+                msg = None
+                chat = self._chats.get(chat_id)
+                if chat is not None and chat.history_loaded:
+                    msg = Message.from_payload(self, chat_id, raw, _chat=chat)
+                    chat._push(msg)
+                candidates = self._prefilter(chat_id, raw)
+                if candidates:
+                    self._spawn(self._dispatch(chat_id, raw, candidates, msg))
+
+            case opcode:
+                for func in self.raw_handlers.get(opcode, []):
+                    r = func(self, recv.get("payload"))
+                    if inspect.isawaitable(r):
+                        self._spawn(r)
+
+    # region _fail_pending()
+    def _fail_pending(self, exc: Exception):
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for fut in pending:
+            if not fut.done():
+                fut.set_exception(exc)
+
+    # region _dispatch()
+    async def _dispatch(self, chat_id: int, raw: dict, candidates: list, msg: Message|None = None):
+        """Internal worker. Builds the message (or completes the one already in the chat history) and runs the first matching handler."""
+        try:
+            if msg is None:
+                msg = await self._make_message(chat_id, raw)
+            else:
+                msg._user = await self.get_user(id=raw["sender"], _f=1)
+            for decision, filter, func in candidates:
+                if decision or filter(self, msg):
+                    r = func(self, msg)
+                    if inspect.isawaitable(r):
+                        await r
+                    return
+        except Exception as e:
+            if not self._t_stop:
+                _log.exception("Handler error: %s", e)
+
+    # region _make_message()
+    async def _make_message(self, chat_id: int, raw: dict, chat: Chat|None = None) -> Message:
+        """Internal worker. Resolves the chat and the sender concurrently, then builds the `Message`."""
+        if chat is None:
+            chat, user = await asyncio.gather(
+                self.get_chat(chat_id),
+                self.get_user(id=raw["sender"], _f=1),
+            )
+        else:
+            user = await self.get_user(id=raw["sender"], _f=1)
+        return Message.from_payload(self, chat_id, raw, _chat=chat, _user=user)
+
+    # region _heartbeat()
+    async def _heartbeat(self):
+        """Отправляет пинг серверу каждые 25 секунд"""
+        while not self._t_stop:
+            if self._connected:
+                try:
+                    await self._send(1, {"interactive": False})
+                except Exception as e:
+                    _log.warning("Heartbeat error: %s", e)
+            await asyncio.sleep(25)
+
+    # region _reader()
+    async def _reader(self):
+        """Internal worker. The only place that reads the socket."""
+        websocket = self.websocket
+        while not self._t_stop:
+            try:
+                data = await websocket.recv()
+                self.trace.record(data)
+                if self._skip_frame(data):
+                    continue
+                recv = loads(data)
+                self.frame_stats["parsed"] += 1
+            except ConnectionClosed:
+                # clean closes (server maintenance) reconnect too, only stop() ends the client
+                if self._t_stop or websocket is not self.websocket:
+                    return
+                self._spawn(self._reconnect())
+                return
+            except Exception as e:
+                if self._t_stop or self.websocket is None:
+                    return
+                _log.exception("Иная беда: %s", e)
+                await asyncio.sleep(1)
+                continue
+
+            self._route(recv)
+
+    # region _reconnect()
+    async def _reconnect(self):
+        """
+        Internal worker. Reconnects with jittered exponential backoff until it succeeds or the client stops.
+
+        After re-auth a catch-up pass replays what was missed, see `MaxClient._catch_up()`.
+        """
+        disconnected_at = int(time.time()*1000)
+        started = time.monotonic()
+        self._connected = False
+        self._fail_pending(ConnectionError("Connection closed"))
+
+        attempt = 0
+        while not self._t_stop:
+            try:
+                if self.websocket:
+                    await self.websocket.close()
+            except:
+                pass
+            delay = min(self.reconnect_max_delay, self.reconnect_base_delay * 2 ** attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            try:
+                await self.connect()
+            except Exception as ee:
+                _log.warning("Не смог встать: %s", ee)
+                self.reconnect_stats["failed_attempts"] += 1
+                attempt += 1
+                continue
+
+            self.reconnect_stats["reconnects"] += 1
+            self.reconnect_stats["last_outage"] = time.monotonic() - started
+            self._spawn(self._catch_up(disconnected_at))
+            return
+
+    # region _catch_up()
+    async def _catch_up(self, disconnected_at: int):
+        """Internal worker. Replays messages missed during an outage through the normal handlers."""
+        chats = self.catch_up_chats or set(self._last_seen)
+        for chat_id in chats:
+            since = self._last_seen.get(chat_id, disconnected_at)
+            try:
+                while not self._t_stop:
+                    recv = await self._request(49, {"chatId":chat_id,"from":since,"forward":self.catch_up_page,"backward":0,"getMessages":True})
+                    page = recv["payload"].get("messages") or []
+                    newer = sorted((m for m in page if (m.get("time") or 0) > since), key=lambda m: m["time"])
+                    for raw in newer:
+                        if self._seen_key(chat_id, raw) not in self._recent_ids:
+                            self._route({"ver": 11, "cmd": 0, "opcode": 128, "payload": {"chatId": chat_id, "message": raw}})
+                            self.reconnect_stats["caught_up"] += 1
+                    if len(page) < self.catch_up_page or not newer:
+                        break
+                    since = newer[-1]["time"]
+            except Exception as e:
+                _log.warning("Catch-up error in %s: %s", chat_id, e)
+
+    # region run()
+    async def run(self):
+        """
+        Connects and serves events until `stop()` is called.
+
+        Usage:
+            ```
+            client = AsyncMaxClient(token="token")
+            asyncio.run(client.run())
+            ```
+        """
+        self._t_stop = False
+        self._stopped = asyncio.Event()
+        await self.connect()
+        self._spawn(self._heartbeat())
+        await self._stopped.wait()
+
+    # region stop()
+    async def stop(self):
+        """Stops the client, cancels its tasks and disconnects from the server."""
+        self._t_stop = True
+        await self.disconnect()
+        for task in list(self._tasks):
+            if task is not asyncio.current_task():
+                task.cancel()
+        if self._stopped:
+            self._stopped.set()
+
+    # region send_message()
+    async def send_message(self, chat_id: int, text: str, reply_id: str|int = None, notify: bool = True):
+        """
+        Sends a text message to a specified chat. See `MaxClient.send_message()`.
+
+        Usage:
+            ```python
+            msg = await client.send_message(12345678, "Hello, world!")
+            ```
+        """
+        j = {
+            "chatId":chat_id,
+            "message": {
+                "text":text,
+                "cid": self.cid,
+                "elements":[],
+                "attaches":[]
+            },
+            "notify": notify
+        }
+
+        if reply_id:
+            j["message"]["link"] = {
+                "type": "REPLY",
+                "messageId": str(reply_id)
+            }
+
+        recv = await self._request(64, j)
+        payload = recv["payload"]
+        return await self._make_message(payload["chatId"], payload["message"])
+
+    # region delete_message()
+    async def delete_message(self, chat_id: int, message_ids: list[str], for_me: bool = False):
+        """Deletes one or more messages from a specified chat. See `MaxClient.delete_message()`."""
+        await self._send(66, {
+            "chatId":chat_id,
+            "messageIds": message_ids,
+            "forMe": for_me
+        })
+
+    # region edit_message()
+    async def edit_message(self, chat_id: int, message_id: str|int, text: str):
+        """Edits the text of an existing message. See `MaxClient.edit_message()`."""
+        recv = await self._request(67, {
+            "chatId": chat_id,
+            "messageId": str(message_id),
+            "text": text,
+            "elements": [],
+            "attachments": []
+        })
+        payload = recv["payload"]
+        return await self._make_message(chat_id, payload["message"])
+
+    # region pin_chat()
+    async def pin_chat(self, chat_id: int|str):
+        await self._send(22, {"settings": {"chats": {str(chat_id): {"favIndex": int(time.time()*1000)}}}})
+        return True
+
+    # region unpin_chat()
+    async def unpin_chat(self, chat_id: int|str):
+        await self._send(22, {"settings": {"chats": {str(chat_id): {"favIndex": 0}}}})
+        return True
+
+    # region iter_history()
+    async def iter_history(self, chat_id: int, since: int = 0, until: int|None = None, page_size: int = 100):
+        """
+        Iterates over a chat's history from newest to oldest, one page at a time. See `MaxClient.iter_history()`.
+
+        The lazy `Message.chat`/`Message.user` can't await here, so the chat is resolved once per call and
+        the senders of each page concurrently before it is yielded; the messages come fully resolved.
+
+        Usage:
+            ```python
+            async for message in client.iter_history(chat_id, page_size=200):
+                ...
+            ```
+        """
+        chat = await self.get_chat(chat_id)
+        cursor = until if until is not None else int(time.time()*1000)
+        boundary: set = set()
+        while cursor >= since:
+            recv = await self._request(49, {"chatId":chat_id,"from":cursor,"forward":0,"backward":page_size,"getMessages":True})
+            page = recv["payload"].get("messages") or []
+            page.sort(key=lambda raw: raw.get("time") or 0, reverse=True)
+
+            fresh = [raw for raw in page if not (raw.get("time") == cursor and raw.get("id") in boundary)]
+            if not fresh:
+                return
+            # full get_user (not _f): User.chat is resolved as well, so it isn't a coroutine either
+            senders = list({raw["sender"] for raw in fresh})
+            users = dict(zip(senders, await asyncio.gather(*(self.get_user(id=s) for s in senders))))
+            for raw in fresh:
+                if (raw.get("time") or 0) < since:
+                    return
+                yield Message.from_payload(self, chat_id, raw, _chat=chat, _user=users[raw["sender"]])
+
+            oldest = fresh[-1].get("time") or 0
+            if len(page) < page_size or oldest > cursor:
+                return
+            if oldest < cursor:
+                boundary = set()
+            boundary.update(raw.get("id") for raw in fresh if raw.get("time") == oldest)
+            cursor = oldest
+
+    # region _chat_object()
+    def _chat_object(self, chat_id: int) -> Chat:
+        """Internal worker. The shared `Chat` for an ID, without loading its history (no request)."""
+        if chat_id == 0:
+            return Chat(self, 0, _messages=[])
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats.setdefault(chat_id, Chat(self, chat_id))
+        return chat
+
+    # region get_chat()
+    async def get_chat(self, chat_id: int, count: int = 50) -> Chat:
+        """
+        Returns the chat with its recent messages, shared by all messages of that chat.
+
+        The first call fetches up to `count` messages with one request and resolves their senders
+        concurrently; after that the history is kept current from live pushes and no request is made.
+
+        Usage:
+            ```python
+            chat = await client.get_chat(12345678)
+            print(len(chat.messages))
+            ```
+        """
+        if chat_id == 0:
+            return self._chat_object(0)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats.setdefault(chat_id, Chat(self, chat_id, history_size=count))
+        if chat._seeded:
+            return chat
+
+        chat._start_recording()
+        recv = await self._request(49, chat._history_request())
+        raw_messages = recv["payload"].get("messages", [])
+
+        senders = list({m["sender"] for m in raw_messages})
+        users = dict(zip(senders, await asyncio.gather(*(self.get_user(id=s, _f=1) for s in senders))))
+        chat._seed([Message.from_payload(self, chat_id, m, _chat=chat, _user=users[m["sender"]]) for m in raw_messages])
+        return chat
+
+    # region get_user()
+    async def get_user(self, **kwargs):
+        """
+        Retrieves a user's profile by their ID, phone number or chat ID. See `MaxClient.get_user()`.
+
+        Usage:
+            ```python
+            user = await client.get_user(id=123456)
+            ```
+        """
+        id = kwargs.get('id')
+        phone = kwargs.get('phone')
+        chat_id = kwargs.get('chat_id')
+        _f = kwargs.get("_f")
+
+        if chat_id and not id and not phone:
+            id = self.me.contact.id ^ chat_id
+
+        usr = self.users.get(int(id)) if id else None
+        if usr is None:
+            if id:
+                recv = await self._request(32, {"contactIds":[id]})
+            elif phone:
+                recv = await self._request(46, {"phone":str(phone)})
+            else:
+                raise ValueError("no `id` or `phone` or `chat_id` provided")
+
+            payload = recv["payload"]
+
+            error = payload.get("error")
+
+            if error:
+                raise UserNotFound(error, payload["message"]+f": {phone}")
+
+            if id:
+                contact = payload["contacts"][0]
+            if phone:
+                payload["contact"]["phone"] = phone
+                contact = payload["contact"]
+
+            usr = User.from_payload(self, contact)
+            if usr.contact.id:
+                usr = self.users.put(usr)
+
+        if usr._chat is None:
+            # User.chat can't await, so it is always resolved here; with _f the private chat's history isn't fetched
+            chat_id = (usr.contact.id or 0) ^ self.me.contact.id
+            usr.chat = self._chat_object(chat_id) if _f else await self.get_chat(chat_id)
+        return usr
+
+    # region set_reaction()
+    async def set_reaction(self, chat_id, message_id, reaction: EMOJIS):
+        """Sets a reaction to a specific message in a chat. See `MaxClient.set_reaction()`."""
+        recv = await self._request(178, {"chatId":chat_id,"messageId":message_id,"reaction":{"reactionType":"EMOJI","id":reaction}})
+        return Reactions.from_payload(recv["payload"])
+
+    # region contact_add()
+    async def contact_add(self, user_id: int):
+        recv = await self._request(34, {"contactId": user_id, "action": "ADD"})
+        usr = User.from_payload(self, recv["payload"]["contact"])
+        usr.chat = self._chat_object(usr.contact.id ^ self.me.contact.id)
+        return usr
+
+    # region contact_remove()
+    async def contact_remove(self, user_id: int):
+        await self._request(34, {"contactId": user_id, "action": "REMOVE"})
+        return True
+
+    # region contact_block()
+    async def contact_block(self, user_id: int):
+        await self._request(34, {"contactId": user_id, "action": "BLOCK"})
+        return True
+
+    # region contact_unblock()
+    async def contact_unblock(self, user_id: int):
+        await self._request(34, {"contactId": user_id, "action": "UNBLOCK"})
+        return True
+
+    # region @on_message()
+    def on_message(self, filters):
+        """
+        Decorator to register a handler for a specific message type. Handlers may be plain functions or coroutines.
+
+        Usage:
+        ```
+        from max_async import AsyncMaxClient as Client
+        from filters import filters
+
+        client = Client("token")
+
+        @client.on_message(filters.command("hello"))
+        async def command_hello(client: Client, message: Message):
+            await message.reply("Max - самый забагованный мессенджер.")
+
+        asyncio.run(client.run())
+        ```
+        """
+        def decorator(func):
+            self.handlers.append((filters.compile(), func))
+            return func
+
+        return decorator
+
+    #region @on_connect
+    def on_connect(self, func):
+        """Registers a callback (plain function or coroutine) to be called upon successful connection."""
+        self._on_connect = func
+        return func
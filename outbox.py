@@ -0,0 +1,274 @@
+"""
+Надёжная очередь исходящих сообщений (outbox) между приёмом из MAX и отправкой в Telegram.
+
+Обработчик сообщений только кладёт готовую подпись и вложения в SQLite (режим WAL)
+и сразу возвращается. Отдельный поток доставки забирает записи по порядку и отправляет их.
+
+Гарантии:
+- put() возвращается, когда запись уже закоммичена. Вставки от нескольких
+  воркеров диспетчера собираются в одну транзакцию (group commit).
+- Доставка «хотя бы один раз»: запись удаляется только после успешной отправки.
+  Если процесс упадёт посреди отправки, после перезапуска из starter.py запись
+  уйдёт повторно. Сообщение из нескольких частей (альбом + видео + текст) помнит
+  в parts_done, сколько частей уже ушло, и повтор начинает со следующей.
+- Ключ идемпотентности (chat_id:message_id) не даёт поставить одно сообщение
+  в очередь дважды — ни пока оно ждёт, ни после отправки (ключи хранятся в delivered).
+- Если в очереди max_depth недоставленных записей, put() ждёт, пока sender её разгрузит
+  (место резервируется до передачи записи writer, так что параллельные put() его не превысят):
+  медленный Telegram тормозит стадии пайплайна перед outbox, а не раздувает базу.
+- Временная ошибка (сеть, 429, 5xx) повторяется с растущей паузой, не нарушая порядок.
+  После max_attempts неудач запись уходит в dead и больше не блокирует очередь.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Callable, Dict, List, Tuple
+
+log = logging.getLogger("outbox")
+
+OUTBOX_FILE = "outbox.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    parts_done INTEGER NOT NULL DEFAULT 0,
+    dead INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS delivered (
+    key TEXT PRIMARY KEY,
+    at REAL NOT NULL
+);
+"""
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # в WAL NORMAL не теряет закоммиченное при падении процесса, только при отключении питания
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class _Batch:
+    """Пачка вставок одной транзакции; put() ждут её done."""
+    __slots__ = ("items", "done", "inserted")
+
+    def __init__(self):
+        self.items: List[Tuple[str, str, float]] = []
+        self.done = threading.Event()
+        self.inserted: Dict[str, bool] = {}
+
+
+class Outbox:
+    def __init__(
+        self,
+        deliver: Callable[[Dict, int, Callable[[int], None]], None],
+        path: str = OUTBOX_FILE,
+        max_attempts: int = 8,
+        max_backoff: float = 300.0,
+        max_depth: int = 1000,
+        keep_delivered: float = 7 * 24 * 3600,
+    ):
+        """
+        deliver(payload, parts_done, on_part) отправляет одно сообщение, пропуская первые
+        parts_done частей, и вызывает on_part(n) после каждой отправленной части;
+        исключение означает «повторить позже».
+        """
+        self.deliver = deliver
+        self.path = path
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.max_depth = max_depth
+        self.keep_delivered = keep_delivered
+
+        self._batch = _Batch()
+        self._pending_lock = threading.Lock()
+        self._has_pending = threading.Event()
+        self._has_items = threading.Event()
+        self._running = False
+        # недоставленные записи в памяти, чтобы put() не считал их запросом к базе;
+        # включает места, зарезервированные put() до коммита
+        self._depth_cond = threading.Condition()
+        self.stats = {
+            "enqueued": 0, "duplicates": 0, "delivered": 0, "retries": 0, "dead": 0,
+            "throttled": 0, "throttled_time": 0.0,
+        }
+
+        with closing(_connect(self.path)) as conn:
+            conn.executescript(_SCHEMA)
+            # база от версии без parts_done
+            if "parts_done" not in {col[1] for col in conn.execute("PRAGMA table_info(outbox)")}:
+                conn.execute("ALTER TABLE outbox ADD COLUMN parts_done INTEGER NOT NULL DEFAULT 0")
+            self._depth = conn.execute("SELECT COUNT(*) FROM outbox WHERE dead = 0").fetchone()[0]
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        # после перезапуска в базе могут остаться недоставленные записи
+        self._has_items.set()
+        threading.Thread(target=self._writer, name="OutboxWriter", daemon=True).start()
+        threading.Thread(target=self._sender, name="OutboxSender", daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        with self._depth_cond:
+            self._depth_cond.notify_all()
+        self._has_pending.set()
+        self._has_items.set()
+
+    def put(self, key: str, payload: Dict, timeout: float = 30.0) -> bool:
+        """
+        Ставит сообщение в очередь и ждёт коммита его пачки.
+        Возвращает False, если запись с таким ключом уже была (в очереди или доставлена).
+        """
+        item = (key, json.dumps(payload, ensure_ascii=False), time.time())
+        with self._depth_cond:
+            if self._depth >= self.max_depth:
+                started = time.monotonic()
+                self._depth_cond.wait_for(lambda: self._depth < self.max_depth or not self._running)
+                self.stats["throttled"] += 1
+                self.stats["throttled_time"] += time.monotonic() - started
+            # резервируем место сразу: проверка и занятие под одной блокировкой;
+            # за дубликаты writer место вернёт
+            self._depth += 1
+        with self._pending_lock:
+            batch = self._batch
+            batch.items.append(item)
+        self._has_pending.set()
+        if not batch.done.wait(timeout):
+            raise TimeoutError("outbox: запись в базу не закоммичена вовремя")
+        return batch.inserted.get(key, False)
+
+    def _writer(self):
+        conn = _connect(self.path)
+        while self._running:
+            self._has_pending.wait()
+            with self._pending_lock:
+                batch, self._batch = self._batch, _Batch()
+                self._has_pending.clear()
+            if not batch.items:
+                continue
+            inserted = batch.inserted
+            while True:
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for key, payload, created in batch.items:
+                        if conn.execute("SELECT 1 FROM delivered WHERE key = ?", (key,)).fetchone():
+                            inserted[key] = False
+                            continue
+                        cur = conn.execute(
+                            "INSERT OR IGNORE INTO outbox (key, payload, created) VALUES (?, ?, ?)",
+                            (key, payload, created),
+                        )
+                        inserted[key] = cur.rowcount == 1
+                    conn.execute("COMMIT")
+                    break
+                except sqlite3.Error as e:
+                    log.error("Не удалось записать пачку в outbox: %s", e)
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    inserted.clear()
+                    time.sleep(1)
+            added = sum(inserted.values())
+            self.stats["enqueued"] += added
+            self.stats["duplicates"] += len(batch.items) - added
+            batch.done.set()
+            if added < len(batch.items):
+                with self._depth_cond:
+                    self._depth -= len(batch.items) - added
+                    self._depth_cond.notify_all()
+            if added:
+                self._has_items.set()
+        conn.close()
+
+    def _sender(self):
+        conn = _connect(self.path)
+        while self._running:
+            row = conn.execute(
+                "SELECT id, key, payload, attempts, parts_done FROM outbox WHERE dead = 0 ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                self._prune(conn)
+                # сброс после ожидания: следующий SELECT всё равно увидит запись, пришедшую между ними
+                self._has_items.wait(60)
+                self._has_items.clear()
+                continue
+
+            row_id, key, payload, attempts, parts_done = row
+
+            def on_part(n: int, row_id=row_id):
+                # autocommit: прогресс сохраняется сразу, повтор не отправит часть ещё раз
+                conn.execute("UPDATE outbox SET parts_done = ? WHERE id = ?", (n, row_id))
+
+            try:
+                self.deliver(json.loads(payload), parts_done, on_part)
+            except Exception as e:
+                attempts += 1
+                dead = attempts >= self.max_attempts
+                conn.execute(
+                    "UPDATE outbox SET attempts = ?, dead = ?, error = ? WHERE id = ?",
+                    (attempts, int(dead), f"{type(e).__name__}: {e}", row_id),
+                )
+                if dead:
+                    self.stats["dead"] += 1
+                    self._release()
+                    log.error("Сообщение %s не доставлено после %d попыток: %s", key, attempts, e)
+                    continue
+                self.stats["retries"] += 1
+                delay = min(getattr(e, "retry_after", None) or 2 ** attempts, self.max_backoff)
+                log.warning("Доставка %s не удалась (%s), повтор через %.1f с", key, e, delay)
+                time.sleep(delay)
+                continue
+
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            conn.execute("INSERT OR REPLACE INTO delivered (key, at) VALUES (?, ?)", (key, time.time()))
+            conn.execute("COMMIT")
+            self.stats["delivered"] += 1
+            self._release()
+        conn.close()
+
+    def _release(self):
+        with self._depth_cond:
+            self._depth -= 1
+            self._depth_cond.notify()
+
+    def _prune(self, conn: sqlite3.Connection):
+        conn.execute("DELETE FROM delivered WHERE at < ?", (time.time() - self.keep_delivered,))
+
+    def _query(self, sql: str):
+        # отдельное короткое соединение: читатели WAL не мешают writer и sender
+        with closing(_connect(self.path)) as conn:
+            return conn.execute(sql).fetchone()
+
+    def depth(self) -> int:
+        """Сколько записей ждёт доставки (без dead)."""
+        return self._query("SELECT COUNT(*) FROM outbox WHERE dead = 0")[0]
+
+    def oldest_age(self) -> float | None:
+        """Возраст самой старой недоставленной записи в секундах; None — очередь пуста."""
+        created = self._query("SELECT MIN(created) FROM outbox WHERE dead = 0")[0]
+        return None if created is None else time.time() - created
+
+    def snapshot(self) -> Dict:
+        depth, oldest, dead = self._query(
+            # SUM/MIN(CASE ...) вместо FILTER: тот есть только с SQLite 3.30
+            "SELECT COALESCE(SUM(CASE WHEN dead = 0 THEN 1 ELSE 0 END), 0),"
+            " MIN(CASE WHEN dead = 0 THEN created END),"
+            " COALESCE(SUM(CASE WHEN dead = 1 THEN 1 ELSE 0 END), 0) FROM outbox"
+        )
+        return {
+            **self.stats,
+            "depth": depth,
+            "oldest_age": None if oldest is None else round(time.time() - oldest, 1),
+            "dead_total": dead,
+        }
@@ -3,13 +3,15 @@ import time
 import sys, os
 import datetime
 import threading
-import json
 
 import requests
 from telegram import send_to_telegram, handle_telegram_commands
+from log import setup_logging
+from control import ForwardState, send_command
 from dotenv import load_dotenv
 
 load_dotenv()
+setup_logging()
 TG_BOT_TOKEN = os.getenv("TG_BOT_TOKEN")
 MONITOR_ID = os.getenv("MONITOR_ID")
 TG_CONTROL_ADMIN_ID = os.getenv("TG_CONTROL_ADMIN_ID")  # опционально ограничить по пользователю
@@ -20,6 +22,11 @@ if MAX_CHAT_IDS_ENV:
         MAX_CHAT_IDS = [int(x) for x in MAX_CHAT_IDS_ENV.split(",") if x.strip()]
     except Exception:
         MAX_CHAT_IDS = []
+# ключ канала управления — тот же, что у main.py (оба читают один .env)
+CONTROL_AUTHKEY = TG_BOT_TOKEN.encode() if TG_BOT_TOKEN else None
+# желаемое состояние пересылки; starter.py сохраняет его в файл при каждой команде,
+# main.py читает файл при старте и держит свою копию в памяти
+_forward_state = ForwardState.load()
 
 def run_with_restart():
     restart_alarm = False
@@ -31,6 +38,7 @@ def run_with_restart():
                 [sys.executable, "main.py"],
                 stderr=subprocess.PIPE,
                 text=True)
+            threading.Thread(target=_push_state_when_ready, args=(process,), name="ControlSync", daemon=True).start()
             if MONITOR_ID != "":
                 send_to_telegram(
                     TG_BOT_TOKEN,
@@ -62,35 +70,45 @@ def run_with_restart():
             print(f"[{datetime.datetime.now()}] Ошибка: {e}")
             time.sleep(3)
 
-def _set_forward_enabled(enabled: bool):
+def _push_state_when_ready(process, attempts: int = 60):
     """
-    Сохраняем флаг пересылки в файл, чтобы main.py мог его читать.
-    True -> включена, False -> выключена.
+    Ждёт, пока перезапущенный main.py поднимет канал управления, и отправляет ему
+    текущее состояние пересылки. Основной путь — main.py сам читает файл при старте;
+    это покрывает команды, пришедшие между чтением файла и запуском канала.
     """
-    state = {"forward_enabled": bool(enabled)}
-    with open("forward_state.json", "w", encoding="utf-8") as f:
-        json.dump(state, f)
+    for _ in range(attempts):
+        if process.poll() is not None:
+            return
+        if send_command("set", authkey=CONTROL_AUTHKEY, **_forward_state.snapshot()) is not None:
+            return
+        time.sleep(1)
 
 
-def _get_forward_enabled() -> bool:
-    try:
-        with open("forward_state.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return bool(data.get("forward_enabled", True))
-    except Exception:
-        return True
+def _apply_forward_command(cmd: str, chat_id: int | None = None) -> bool:
+    """
+    Меняет состояние пересылки (всей или одного чата) и сразу отправляет команду боту.
+    Возвращает False, если бот сейчас не запущен — состояние уйдёт ему при старте.
+    """
+    if cmd == "pause":
+        _forward_state.pause(chat_id)
+    else:
+        _forward_state.resume(chat_id)
+    _forward_state.save()
+    return send_command(cmd, authkey=CONTROL_AUTHKEY, chat_id=chat_id) is not None
 
 
 def telegram_control_loop():
     """
     Цикл опроса команд бота в Telegram.
     Работает в личных чатах и супергруппах, команды:
-      /pause  – остановить пересылку
-      /resume – возобновить пересылку
+      /pause [chat_id]  – остановить пересылку (всю или одного чата)
+      /resume [chat_id] – возобновить пересылку
       /status – показать состояние
+      /stats  – счётчики пересылки из запущенного бота
       /chats  – показать список отслеживаемых чатов
     Если задан TG_CONTROL_ADMIN_ID – принимает команды только от этого пользователя.
     Поддерживает темы в супергруппах.
+    Состояние пересылки уходит в main.py по каналу управления (control.py), без файлов.
     """
     if not TG_BOT_TOKEN:
         return
@@ -141,26 +159,27 @@ def telegram_control_loop():
                 # Извлекаем message_thread_id для ответа в тему супергруппы
                 thread_id = message.get("message_thread_id")
 
-                cmd = text.split()[0].lower()
+                parts = text.split()
+                cmd = parts[0].lower()
                 cmd = cmd.split("@")[0]
-                if cmd == "/pause":
-                    _set_forward_enabled(False)
-                    payload = {
-                        "chat_id": chat_id,
-                        "text": "⏸ Пересылка сообщений остановлена. Используйте /resume для запуска.",
-                    }
-                    if thread_id:
-                        payload["message_thread_id"] = thread_id
-                    requests.post(
-                        f"{api_url}/sendMessage",
-                        data=payload,
-                        timeout=10,
-                    )
-                elif cmd == "/resume":
-                    _set_forward_enabled(True)
+                if cmd in ("/pause", "/resume"):
+                    # /pause — вся пересылка, /pause <chat_id> — один чат
+                    try:
+                        target = int(parts[1]) if len(parts) > 1 else None
+                    except ValueError:
+                        target = None
+                    delivered = _apply_forward_command(cmd[1:], target)
+                    if cmd == "/pause":
+                        reply = (f"⏸ Пересылка из чата {target} остановлена." if target is not None
+                                 else "⏸ Пересылка сообщений остановлена. Используйте /resume для запуска.")
+                    else:
+                        reply = (f"▶️ Пересылка из чата {target} возобновлена." if target is not None
+                                 else "▶️ Пересылка сообщений возобновлена.")
+                    if not delivered:
+                        reply += "\nБот сейчас не запущен — состояние применится при старте."
                     payload = {
                         "chat_id": chat_id,
-                        "text": "▶️ Пересылка сообщений возобновлена.",
+                        "text": reply,
                     }
                     if thread_id:
                         payload["message_thread_id"] = thread_id
@@ -175,8 +194,10 @@ def telegram_control_loop():
                         chat_id,
                         text,
                         thread_id=thread_id,
-                        forward_enabled=_get_forward_enabled(),
+                        forward_enabled=_forward_state.enabled,
                         fallback_chat_ids=MAX_CHAT_IDS,
+                        paused_chats=_forward_state.paused_chats,
+                        stats_provider=lambda: send_command("stats", authkey=CONTROL_AUTHKEY),
                     )
                     if handled:
                         continue
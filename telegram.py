@@ -2,13 +2,17 @@
 import json
 import os
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterable, List, Optional
 import hashlib
+import logging
 import time
 
 import requests
 
-CHAT_TITLES_FILE = "chat_titles.json"
+from titles import store as chat_titles
+
+
+log = logging.getLogger("telegram")
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # 🎥 КЭШИРОВАНИЕ ВИДЕО (для пересылки с direct URL)
@@ -24,7 +28,7 @@ def _cache_video_url(video_id: str, url: str) -> None:
         "url": url,
         "timestamp": time.time()
     }
-    print(f"   💾 Ссылка на видео кэширована: {video_id[:16]}...")
+    log.debug("   💾 Ссылка на видео кэширована: %.16s...", video_id)
 
 
 def _get_cached_video_url(video_id: str) -> str | None:
@@ -58,39 +62,38 @@ def _get_authenticated_video_url(attach: Dict, max_token: str | None) -> str | N
         return None
     
     # Логируем структуру видео для отладки
-    print(f"   🔍 Анализирую структуру видео...")
+    log.debug("   🔍 Анализирую структуру видео...")
     attach_keys = list(attach.keys())
-    print(f"       Ключи: {attach_keys[:5]}{'...' if len(attach_keys) > 5 else ''}")
+    log.debug("       Ключи: %s%s", attach_keys[:5], '...' if len(attach_keys) > 5 else '')
     
     # Сначала пробуем найти готовую ссылку
     direct_url = _find_first_url(attach)
     if direct_url and isinstance(direct_url, str) and direct_url.startswith(("http://", "https://")):
-        print(f"       ✅ Найдена готовая ссылка: {direct_url[:50]}...")
+        log.debug("       ✅ Найдена готовая ссылка: %.50s...", direct_url)
         # Проверяем, может быть нужен токен
         if "token=" not in direct_url.lower() and max_token:
             # Добавляем токен если его нет
             separator = "&" if "?" in direct_url else "?"
             auth_url = f"{direct_url}{separator}token={max_token}"
-            print(f"       🔐 Добавлен MAX_TOKEN к URL")
+            log.debug("       🔐 Добавлен MAX_TOKEN к URL")
             return auth_url
         return direct_url
     
     # Если нет готовой ссылки, пробуем построить из компонентов
-    print(f"       📦 Пробую построить URL из компонентов...")
+    log.debug("       📦 Пробую построить URL из компонентов...")
     
     # Проверяем структуру file/preview
     file_data = attach.get("file") or attach.get("preview") or attach.get("data")
     if isinstance(file_data, dict):
-        file_keys = list(file_data.keys())
-        print(f"           file/preview ключи: {file_keys[:5]}")
+        log.debug("           file/preview ключи: %s", list(file_data)[:5])
         
         base_url = file_data.get("baseUrl") or file_data.get("base_url") or file_data.get("url")
         file_id = file_data.get("id") or attach.get("id") or attach.get("fileId")
         
         if base_url:
-            print(f"           📍 Найден baseUrl: {base_url[:50]}")
+            log.debug("           📍 Найден baseUrl: %.50s", base_url)
         if file_id:
-            print(f"           🏷️  Найден id/fileId: {file_id}")
+            log.debug("           🏷️  Найден id/fileId: %s", file_id)
         
         if base_url and file_id:
             url = f"{base_url}/{file_id}"
@@ -99,7 +102,7 @@ def _get_authenticated_video_url(attach: Dict, max_token: str | None) -> str | N
                 url = f"https://{url}"
             if max_token and "token=" not in url:
                 url = f"{url}?token={max_token}"
-            print(f"       🔨 Построена ссылка: {url[:50]}...")
+            log.debug("       🔨 Построена ссылка: %.50s...", url)
             return url
     
     # Последний вариант - проверяем есть ли простой id поле
@@ -107,30 +110,20 @@ def _get_authenticated_video_url(attach: Dict, max_token: str | None) -> str | N
         file_id = attach["id"]
         # Проверим, может это уже полная ссылка?
         if isinstance(file_id, str) and file_id.startswith(("http://", "https://")):
-            print(f"       ✅ Поле id содержит готовую ссылку")
+            log.debug("       ✅ Поле id содержит готовую ссылку")
             if max_token and "token=" not in file_id:
                 return f"{file_id}?token={max_token}"
             return file_id
     
-    print(f"       ❌ Не удалось получить прямую ссылку на видео")
+    log.warning("       ❌ Не удалось получить прямую ссылку на видео")
     return None
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 
 def _load_monitored_chats() -> List[Dict]:
-    """Загружает список мониторимых чатов из кэша chat_titles.json"""
-    try:
-        if os.path.exists(CHAT_TITLES_FILE):
-            with open(CHAT_TITLES_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return [
-                    {"id": chat_id, "name": title}
-                    for chat_id, title in data.items()
-                ]
-    except Exception:
-        pass
-    return []
+    """Список мониторимых чатов из общего хранилища названий (titles.py)"""
+    return chat_titles.chats()
 
 
 def handle_attach(attach: Dict) -> str:
@@ -247,13 +240,44 @@ def _guess_attach_kind(attach: Dict) -> str:
     return "unknown"
 
 
+class TelegramRetryError(Exception):
+    """Временная ошибка Bot API (429 или 5xx): сообщение стоит отправить ещё раз позже."""
+
+    def __init__(self, description: str, retry_after: float | None = None):
+        super().__init__(description)
+        self.retry_after = retry_after
+
+
+def _raise_if_retryable(result: Dict) -> None:
+    """Временные ошибки поднимаем исключением (для повтора из outbox), постоянные только логируются."""
+    code = result.get("error_code") or 0
+    if code == 429 or code >= 500:
+        retry_after = (result.get("parameters") or {}).get("retry_after")
+        raise TelegramRetryError(result.get("description", f"HTTP {code}"), retry_after)
+
+
+def _log_response(resp: requests.Response, raise_on_retry: bool = False) -> None:
+    """
+    Ошибки Bot API пишем всегда, успешные ответы — только на уровне DEBUG.
+    raise_on_retry — временную ошибку ещё и поднять как TelegramRetryError.
+    """
+    result = resp.json()
+    if not result.get("ok"):
+        log.warning("❌ Ошибка Telegram: %s", result)
+        if raise_on_retry:
+            _raise_if_retryable(result)
+    else:
+        log.debug("%s", result)
+
+
 def _add_thread(payload: Dict, TG_THREAD_ID: int | None) -> Dict:
     if TG_THREAD_ID:
         payload["message_thread_id"] = TG_THREAD_ID
     return payload
 
 
-def _send_text(TG_BOT_TOKEN: str, TG_CHAT_ID: int, text: str, TG_THREAD_ID: int | None):
+def _send_text(TG_BOT_TOKEN: str, TG_CHAT_ID: int, text: str, TG_THREAD_ID: int | None,
+               raise_on_retry: bool = False):
     if not text:
         return
     api_url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMessage"
@@ -266,7 +290,7 @@ def _send_text(TG_BOT_TOKEN: str, TG_CHAT_ID: int, text: str, TG_THREAD_ID: int
         TG_THREAD_ID,
     )
     resp = requests.post(api_url, data=payload)
-    print(resp.json())
+    _log_response(resp, raise_on_retry)
 
 
 def _send_media_group(
@@ -274,11 +298,12 @@ def _send_media_group(
     TG_CHAT_ID: int,
     media: List[Dict],
     TG_THREAD_ID: int | None,
+    raise_on_retry: bool = False,
 ):
     api_url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMediaGroup"
     payload = _add_thread({"chat_id": TG_CHAT_ID, "media": json.dumps(media)}, TG_THREAD_ID)
     resp = requests.post(api_url, data=payload)
-    print(resp.json())
+    _log_response(resp, raise_on_retry)
 
 
 def send_telegram_message(bot_token: str, chat_id: str, text: str, thread_id: int | None = None):
@@ -302,8 +327,13 @@ def handle_telegram_commands(
     thread_id: int | None = None,
     forward_enabled: bool = True,
     fallback_chat_ids: List[int] | None = None,
+    paused_chats: Iterable[int] = (),
+    stats_provider: Callable[[], Dict | None] | None = None,
 ) -> bool:
-    """Обработчик команд Telegram бота. Возвращает True если команда обработана."""
+    """
+    Обработчик команд Telegram бота. Возвращает True если команда обработана.
+    stats_provider запрашивает счётчики у запущенного main.py (None — бот не отвечает).
+    """
     message_text = message_text.strip()
 
     if message_text == "/status":
@@ -312,9 +342,42 @@ def handle_telegram_commands(
             "🤖 Бот включен\n"
             f"⏸️ Пересылка: {'🟢 включена' if forward_enabled else '🔴 ВЫКЛЮЧЕНА'}"
         )
+        if paused_chats:
+            status_text += "\n⏸️ Чаты на паузе: " + ", ".join(f"<code>{c}</code>" for c in sorted(paused_chats))
         send_telegram_message(bot_token, chat_id, status_text, thread_id)
         return True
 
+    elif message_text == "/stats":
+        stats = stats_provider() if stats_provider else None
+        if not stats or not stats.get("ok"):
+            stats_text = "<b>📊 Статистика:</b>\n\nБот не отвечает по каналу управления"
+        else:
+            lines = [
+                f"Переслано: {stats.get('forwarded', 0)}",
+                f"Пропущено (пауза): {stats.get('skipped', 0)}",
+            ]
+            for cid, counts in sorted(stats.get("per_chat", {}).items()):
+                lines.append(f"• <code>{cid}</code>: {counts.get('forwarded', 0)} / {counts.get('skipped', 0)}")
+            outbox = stats.get("outbox")
+            if outbox:
+                age = outbox.get("oldest_age")
+                lines.append(
+                    f"Outbox: в очереди {outbox.get('depth', 0)}"
+                    + (f", старейшему {age:.0f} с" if age is not None else "")
+                    + f", недоставлено {outbox.get('dead_total', 0)}"
+                )
+            for name, stage in (stats.get("stages") or {}).items():
+                done = (stage.get("completed", 0) + stage.get("errors", 0)) or 1
+                lines.append(
+                    f"{name}: очередь {sum(stage.get('depths') or [])}, "
+                    f"ожидание {stage.get('wait_time', 0) / done * 1000:.0f} мс, "
+                    f"работа {stage.get('run_time', 0) / done * 1000:.0f} мс, "
+                    f"блокировок {stage.get('blocked', 0)}, ошибок {stage.get('errors', 0)}"
+                )
+            stats_text = "<b>📊 Статистика:</b>\n\n" + "\n".join(lines)
+        send_telegram_message(bot_token, chat_id, stats_text, thread_id)
+        return True
+
     elif message_text == "/chats":
         monitored_chats = _load_monitored_chats()
         if not monitored_chats:
@@ -340,14 +403,34 @@ def send_to_telegram(
     TG_THREAD_ID: int | None = None,  # ← поддержка темы
     max_token: str | None = None,
     sender_id: int | None = None,
+    parts_done: int = 0,
+    on_part: Callable[[int], None] | None = None,
+    raise_on_retry: bool = False,
 ):
+    """
+    Одно сообщение MAX может уйти в Telegram несколькими запросами (альбомы, видео, стикеры...).
+    Части нумеруются по порядку; повтор из outbox передаёт parts_done и пропускает уже отправленные,
+    on_part(n) вызывается после успешной отправки части n.
+    raise_on_retry — только для outbox: 429/5xx поднимаются TelegramRetryError, чтобы запись
+    повторили позже. Остальные вызовы (оповещения starter.py) ошибку только логируют.
+    """
     attachments = attachments or []
+    part = 0
+
+    def _part(send: Callable, *args):
+        nonlocal part
+        part += 1
+        if part <= parts_done:
+            return
+        send(*args)
+        if on_part:
+            on_part(part)
 
     # ------------------------
     # 1) ОТПРАВКА ТЕКСТА
     # ------------------------
     if not attachments:
-        _send_text(TG_BOT_TOKEN, TG_CHAT_ID, caption, TG_THREAD_ID)
+        _part(_send_text, TG_BOT_TOKEN, TG_CHAT_ID, caption, TG_THREAD_ID, raise_on_retry)
         return
 
     # ------------------------
@@ -376,11 +459,11 @@ def send_to_telegram(
         if kind == "video" and (not url or not str(url).startswith(("http://", "https://"))):
             url = _get_authenticated_video_url(attach, max_token)
             if url:
-                print(f"   🔓 Видео: получена authenticated ссылка из MAX")
+                log.debug("   🔓 Видео: получена authenticated ссылка из MAX")
 
         if not url or not str(url).startswith(("http://", "https://")):
             categorized["unknown"].append(attach)
-            print(f"   ⚠️ Видео без ссылки: {attach_type}")
+            log.warning("   ⚠️ Видео без ссылки: %s", attach_type)
             continue
 
         if kind == "photo":
@@ -392,7 +475,7 @@ def send_to_telegram(
         elif kind == "voice":
             categorized["voices"].append({"url": url, "raw": attach})
         elif kind == "sticker":
-            print(f"   📌 Классифицировано как стикер: {kind}")
+            log.debug("   📌 Классифицировано как стикер: %s", kind)
             categorized["stickers"].append({"url": url, "raw": attach})
         elif kind == "document":
             categorized["documents"].append({"url": url, "raw": attach})
@@ -418,7 +501,7 @@ def send_to_telegram(
                 caption_left = ""
             media.append(m)
         if media:
-            _send_media_group(TG_BOT_TOKEN, TG_CHAT_ID, media, TG_THREAD_ID)
+            _part(_send_media_group, TG_BOT_TOKEN, TG_CHAT_ID, media, TG_THREAD_ID, raise_on_retry)
 
     # ------------------------
     # 4) ВИДЕО / АУДИО / ГОЛОС / ДОКУМЕНТЫ
@@ -427,42 +510,47 @@ def send_to_telegram(
         nonlocal caption_sent, caption_left
         for idx, item in enumerate(items):
             payload = _add_thread({"chat_id": TG_CHAT_ID}, TG_THREAD_ID)
-            
-            # ← НОВОЕ: Проверяем и оптимизируем URL для видео
-            media_url = item.get("url")
-            if field == "video" and media_url:
-                video_id = item["raw"].get("id") or hashlib.md5(media_url.encode()).hexdigest()
-                
-                # Пробуем кэш
-                cached_url = _get_cached_video_url(video_id)
-                if cached_url:
-                    print(f"   ♻️ Видео из кэша: {video_id}")
-                    media_url = cached_url
-                else:
-                    # Получаем authenticated URL если нужно
-                    auth_url = _get_authenticated_video_url(item["raw"], max_token)
-                    if auth_url:
-                        print(f"   🔐 Используем authenticated URL для видео")
-                        media_url = auth_url
-                        _cache_video_url(video_id, auth_url)
-            
-            payload[field] = media_url
 
             if supports_caption and not caption_sent and caption_left:
                 payload["caption"] = caption_left
                 payload["parse_mode"] = "HTML"
                 caption_sent = True
                 caption_left = ""
+
+            _part(_post_single, endpoint, field, item, payload)
+
+    def _post_single(endpoint: str, field: str, item: Dict, payload: Dict):
+        # ← НОВОЕ: Проверяем и оптимизируем URL для видео
+        media_url = item.get("url")
+        if field == "video" and media_url:
+            video_id = item["raw"].get("id") or hashlib.md5(media_url.encode()).hexdigest()
             
-            resp = requests.post(
-                f"https://api.telegram.org/bot{TG_BOT_TOKEN}/{endpoint}",
-                data=payload,
-            )
-            result = resp.json()
-            if not result.get("ok"):
-                print(f"   ❌ Ошибка Telegram: {result.get('description', 'Unknown error')}")
+            # Пробуем кэш
+            cached_url = _get_cached_video_url(video_id)
+            if cached_url:
+                log.debug("   ♻️ Видео из кэша: %s", video_id)
+                media_url = cached_url
             else:
-                print(f"   ✅ Видео успешно отправлено")
+                # Получаем authenticated URL если нужно
+                auth_url = _get_authenticated_video_url(item["raw"], max_token)
+                if auth_url:
+                    log.debug("   🔐 Используем authenticated URL для видео")
+                    media_url = auth_url
+                    _cache_video_url(video_id, auth_url)
+        
+        payload[field] = media_url
+
+        resp = requests.post(
+            f"https://api.telegram.org/bot{TG_BOT_TOKEN}/{endpoint}",
+            data=payload,
+        )
+        result = resp.json()
+        if not result.get("ok"):
+            log.warning("   ❌ Ошибка Telegram: %s", result.get('description', 'Unknown error'))
+            if raise_on_retry:
+                _raise_if_retryable(result)
+        else:
+            log.debug("   ✅ Видео успешно отправлено")
 
     def _send_sticker_from_url(sticker_data: Dict):
         """
@@ -473,10 +561,10 @@ def send_to_telegram(
         try:
             url = sticker_data.get("url")
             if not url:
-                print(f"⚠️ Нет URL для стикера: {sticker_data}")
+                log.warning("⚠️ Нет URL для стикера: %s", sticker_data)
                 return False
             
-            print(f"📥 Загружаю стикер: {url}")
+            log.debug("📥 Загружаю стикер: %s", url)
             
             # Загружаем файл с поддержкой редиректов
             headers = {
@@ -488,10 +576,10 @@ def send_to_telegram(
             # Проверяем Content-Type
             content_type = img_response.headers.get('Content-Type', '')
             content_len = len(img_response.content)
-            print(f"📊 Content-Type: {content_type}, Size: {content_len} bytes")
+            log.debug("📊 Content-Type: %s, Size: %d bytes", content_type, content_len)
             
             if not img_response.content or content_len == 0:
-                print(f"⚠️ Пустой файл стикера")
+                log.warning("⚠️ Пустой файл стикера")
                 return False
             
             # Отправляем как стикер через API
@@ -512,18 +600,18 @@ def send_to_telegram(
             files = {"sticker": (filename, img_response.content, mime_type)}
             payload = _add_thread({"chat_id": TG_CHAT_ID}, TG_THREAD_ID)
             
-            print(f"📤 Отправляю стикер в Telegram...")
+            log.debug("📤 Отправляю стикер в Telegram...")
             resp = requests.post(api_url, data=payload, files=files)
             result = resp.json()
             
             if result.get("ok"):
-                print(f"✅ Стикер успешно отправлен!")
+                log.debug("✅ Стикер успешно отправлен!")
             else:
-                print(f"❌ Ошибка Telegram: {result}")
+                log.warning("❌ Ошибка Telegram: %s", result)
             
             return result.get("ok", False)
         except Exception as e:
-            print(f"❌ Ошибка при отправке стикера: {type(e).__name__}: {e}")
+            log.error("❌ Ошибка при отправке стикера: %s: %s", type(e).__name__, e)
             return False
 
     _send_single("sendVideo", "video", categorized["videos"])
@@ -535,16 +623,16 @@ def send_to_telegram(
     # 5) СТИКЕРЫ (загружаем и отправляем как стикер Telegram)
     # ------------------------
     if categorized["stickers"]:
-        print(f"🎨 Стикеров для отправки: {len(categorized['stickers'])}")
+        log.debug("🎨 Стикеров для отправки: %d", len(categorized['stickers']))
         for idx, sticker_item in enumerate(categorized["stickers"], 1):
-            print(f"   [{idx}/{len(categorized['stickers'])}] Стикер: {sticker_item.get('url')}")
+            log.debug("   [%d/%d] Стикер: %s", idx, len(categorized['stickers']), sticker_item.get('url'))
         
         if caption_left and not caption_sent:
-            _send_text(TG_BOT_TOKEN, TG_CHAT_ID, caption_left, TG_THREAD_ID)
+            _part(_send_text, TG_BOT_TOKEN, TG_CHAT_ID, caption_left, TG_THREAD_ID, raise_on_retry)
             caption_sent = True
             caption_left = ""
         for sticker_item in categorized["stickers"]:
-            _send_sticker_from_url(sticker_item)
+            _part(_send_sticker_from_url, sticker_item)
 
     # ------------------------
     # 6) НЕИЗВЕСТНЫЕ ПРИЛОЖЕНИЯ
@@ -558,7 +646,7 @@ def send_to_telegram(
         if extra_text:
             extra_text += "\n\n"
         extra_text += "\n".join(suffix_lines)
-        _send_text(TG_BOT_TOKEN, TG_CHAT_ID, extra_text, TG_THREAD_ID)
+        _part(_send_text, TG_BOT_TOKEN, TG_CHAT_ID, extra_text, TG_THREAD_ID, raise_on_retry)
         caption_sent = True
         caption_left = ""
 
@@ -566,4 +654,4 @@ def send_to_telegram(
     # 7) ЕСЛИ ПОДПИСЬ ЕЩЕ НЕ УШЛА
     # ------------------------
     if caption_left and not caption_sent:
-        _send_text(TG_BOT_TOKEN, TG_CHAT_ID, caption_left, TG_THREAD_ID)
+        _part(_send_text, TG_BOT_TOKEN, TG_CHAT_ID, caption_left, TG_THREAD_ID, raise_on_retry)
@@ -0,0 +1,119 @@
+"""
+Хранилище названий чатов (chat_titles.json) с отложенной записью.
+
+Файл читается один раз, дальше названия отдаются из памяти. Новые названия
+копятся в pending и сбрасываются фоновым потоком пачкой: запись во временный
+файл и os.replace, чтобы читатель никогда не увидел наполовину записанный JSON.
+
+main.py пишет в хранилище, а telegram.py (в процессе starter.py) его читает —
+читатель перечитывает файл только когда у него сменился mtime.
+"""
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+log = logging.getLogger("titles")
+
+CHAT_TITLES_FILE = "chat_titles.json"
+
+
+def write_json_atomic(path: str, data) -> None:
+    """Пишет JSON во временный файл рядом с path и подменяет им path через os.replace."""
+    fd, tmp = tempfile.mkstemp(prefix=f".{os.path.basename(path)}-", suffix=".tmp",
+                               dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class TitleStore:
+    def __init__(self, path: str = CHAT_TITLES_FILE, flush_interval: float = 5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._titles: Dict[int, str] = {}
+        self._pending: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._thread = None
+        self._load()
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("Не удалось прочитать %s: %s", self.path, e)
+            return
+        with self._lock:
+            # несохранённые названия важнее файла
+            self._titles = {int(k): v for k, v in data.items()}
+            self._titles.update(self._pending)
+            self._mtime = mtime
+
+    def get(self, chat_id: int) -> str | None:
+        return self._titles.get(chat_id)
+
+    def set(self, chat_id: int, title: str):
+        """Запоминает название; на диск оно попадёт при следующем сбросе."""
+        if not title or self._titles.get(chat_id) == title:
+            return
+        with self._lock:
+            self._titles[chat_id] = title
+            self._pending[chat_id] = title
+        if self._thread is None:
+            self.start()
+
+    def chats(self) -> List[Dict]:
+        """Список {"id", "name"} для команды /chats; подхватывает записи другого процесса."""
+        self._load()
+        return [{"id": str(chat_id), "name": title} for chat_id, title in self._titles.items()]
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="TitleStore", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Пишет всё хранилище во временный файл рядом и атомарно подменяет им основной."""
+        with self._lock:
+            if not self._pending:
+                return
+            data = {str(k): v for k, v in self._titles.items()}
+            pending, self._pending = self._pending, {}
+        try:
+            write_json_atomic(self.path, data)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            # не ломаем пересылку; названия вернутся в pending до следующей попытки
+            log.warning("Не удалось сохранить %s: %s", self.path, e)
+            with self._lock:
+                for k, v in pending.items():
+                    self._pending.setdefault(k, v)
+
+
+# одно хранилище на процесс
+store = TitleStore()